@@ -3,6 +3,16 @@ from .tools import *
 from .oaconvolve import chunked_oaconvolve as oaconvolve
 from .upfirdn import upfirdn
 from .sliding_window import sliding_window
+from .ringrechunk import ring_rechunk
+from .transpose import transpose
+from .parallel import parallel_apply, threaded_apply, threaded_per_entry
+from .pipeline import pipeline, StageStats
+from .broadcast import BroadcastServer, broadcast, subscribe
+from .shm import yielding_chunks_to_shm, chunks_to_shm, IterableShmChunks
+from .dirstore import yielding_chunks_to_directory, chunks_to_directory, IterableDirectoryChunks, DirectoryCacheBackend
+from .cachemanager import CacheManager, CacheEntry, MemoryCache, IterableMemoryChunks
+from .fingerprint import fingerprint, ContentHash, ContentHashIterator
+from . import aio
 
 import types
 
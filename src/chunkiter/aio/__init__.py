@@ -0,0 +1,510 @@
+"""
+asyncio counterparts of the chunk iterator building blocks
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import uuid
+
+import numpy as np
+
+from ..functions import (_Rechunker, _Applier, _concatenate_rechunked, _decompress_into, _padding,
+  _STREAM_COMPRESSED, yielding_chunks_to_binaryfile as _yielding_chunks_to_binaryfile,
+  yielding_chunks_to_h5 as _yielding_chunks_to_h5)
+from ..sliding_window import _SlidingWindows
+
+__all__ = ['AsyncIterableBinaryFileChunks', 'from_iterable', 'rechunk', 'apply', 'tee', 'sliding_window',
+  'yielding_chunks_to_binaryfile', 'chunks_to_binaryfile', 'yielding_chunks_to_h5', 'chunks_to_h5']
+
+_END = object()
+
+_h5_executor = None
+def _get_h5_executor():
+  # PyTables is not thread-safe, so all HDF5 sinks share one thread
+  global _h5_executor
+  if _h5_executor is None: _h5_executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="chunkiter-h5")
+  return _h5_executor
+
+class _Feeder(object):
+  # iterator handing over pushed items, for driving generators that pull one item per yield
+  def __init__(self):
+    self.items = collections.deque()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if not len(self.items): raise StopIteration
+    return self.items.popleft()
+
+async def _drive(make_generator, data, inline=False, executor=None, after_step=None):
+  # runs a one-in-one-out synchronous generator (a sink) over an async iterator; each step
+  # of the generator runs in executor (the default executor if None) unless inline is set
+  loop = asyncio.get_running_loop()
+  feeder = _Feeder()
+  generator = make_generator(feeder)
+
+  async def step():
+    if inline: item = next(generator, _END)
+    else: item = await loop.run_in_executor(executor, next, generator, _END)
+    if after_step is not None: await after_step()
+    return item
+
+  try:
+    async for chunk in data:
+      feeder.items.append(chunk)
+      yield await step()
+    await step()
+  finally:
+    if inline: generator.close()
+    else: await loop.run_in_executor(executor, generator.close)
+
+class AsyncIterableBinaryFileChunks(object):
+  """Async iterable reading a version 2 binary chunk stream from an :class:`asyncio.StreamReader`.
+
+  The counterpart of :class:`~chunkiter.IterableBinaryFileChunks` for
+  asyncio, e.g. on the reader of :func:`asyncio.open_connection`.  Reads
+  raw, aligned and compressed streams written by
+  :func:`~chunkiter.yielding_chunks_to_binaryfile`; compressed chunks are
+  decompressed in the event loop.
+
+  Args:
+      reader (asyncio.StreamReader): Stream to read from.
+      identifier (str, optional): Identifier hash.  Auto-generated if not given.
+
+  Raises:
+      IOError: If the stream is not a version 2 chunkiter binary stream.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Deserialized chunk(s).
+
+  Example:
+      >>> reader, writer = await asyncio.open_connection("localhost", 12345)
+      >>> async for chunk in chunkiter.aio.AsyncIterableBinaryFileChunks(reader):
+      ...     print(chunk.shape)
+  """
+  def __init__(self, reader, identifier=None):
+    self.reader = reader
+    self.identifier = identifier if identifier is not None else str(uuid.uuid4())
+
+  async def _read(self, dtype, count=1):
+    return np.frombuffer(await self.reader.readexactly(np.dtype(dtype).itemsize*count), dtype).copy()
+
+  async def __aiter__(self):
+    magic = await self.reader.read(5)
+    if magic==b'': return
+    if magic!=b'CHUNK': raise IOError("not a version 2 chunkiter binary stream")
+
+    version, flags, n = (await self._read(np.int64, 3)).tolist()
+    if version!=2: raise IOError("unsupported chunkiter binary stream version {}".format(version))
+    pos = 5 + 3*8
+
+    dtypes = []
+    shapes = []
+    for i in range(n):
+      typestr_len = (await self._read(np.int64)).item()
+      dtypes.append(np.dtype((await self.reader.readexactly(typestr_len)).decode("ascii")))
+      ndim = (await self._read(np.int64)).item()
+      shapes.append(tuple((await self._read(np.int64, ndim)).tolist()))
+      pos += 8 + typestr_len + 8 + 8*ndim
+
+    while True:
+      try: rows = await self._read(np.int64, n)
+      except asyncio.IncompleteReadError as e:
+        if len(e.partial): raise
+        return
+      if rows[0]<0: return
+      pos += rows.nbytes
+
+      arrays = []
+      if flags&_STREAM_COMPRESSED:
+        sizes = (await self._read(np.int64, n)).tolist()
+        for rows_, size, dtype, shape in zip(rows.tolist(), sizes, dtypes, shapes):
+          array = np.empty((rows_,)+shape, dtype)
+          _decompress_into(await self.reader.readexactly(size), array)
+          arrays.append(array)
+      else:
+        for rows_, dtype, shape in zip(rows.tolist(), dtypes, shapes):
+          pad = _padding(pos, flags)
+          await self.reader.readexactly(pad)
+          array = np.frombuffer(bytearray(await self.reader.readexactly(rows_*dtype.itemsize*int(np.prod(shape)))), dtype).reshape((rows_,)+shape)
+          pos += pad + array.nbytes
+          arrays.append(array)
+
+      yield arrays[0] if len(arrays)==1 else tuple(arrays)
+
+async def from_iterable(iterable, executor=None):
+  """Iterate over a synchronous chunk iterable without blocking the event loop.
+
+  Each chunk is pulled in *executor* (the default executor if ``None``),
+  e.g. to read an :class:`~chunkiter.IterableH5Chunks` from asyncio code.
+
+  Args:
+      iterable: Synchronous iterable yielding chunks.
+      executor (concurrent.futures.Executor, None): Executor for pulling.
+
+  Yields:
+      The items of *iterable*.
+
+  Example:
+      >>> async for chunk in chunkiter.aio.from_iterable(chunkiter.IterableH5Chunks("test.h5")):
+      ...     print(chunk.shape)
+  """
+  loop = asyncio.get_running_loop()
+  iterator = iter(iterable)
+  while True:
+    item = await loop.run_in_executor(executor, next, iterator, _END)
+    if item is _END: return
+    yield item
+
+async def rechunk(data, chunk_size, overlap_size=0, padding=False, concatenate=np.concatenate, yield_remainder=True):
+  """Async :func:`~chunkiter.rechunk`, with the same parameters and output chunks.
+
+  Args:
+      data: Async iterator yielding np.ndarray chunks.
+
+  Yields:
+      np.ndarray or (int, np.ndarray): Rechunked array chunk.
+
+  Example:
+      >>> async for chunk in chunkiter.aio.rechunk(source, 1024, overlap_size=512):
+      ...     print(chunk.shape)
+  """
+  rechunker = _Rechunker(chunk_size, overlap_size)
+  async for chunk in data:
+    for views in rechunker.push(chunk):
+      for output in _concatenate_rechunked(views, chunk_size, padding, concatenate, yield_remainder): yield output
+  for views in rechunker.flush():
+    for output in _concatenate_rechunked(views, chunk_size, padding, concatenate, yield_remainder): yield output
+
+async def apply(bodyfun, data, yield_carry=False):
+  """Async :func:`~chunkiter.apply`, accepting the same body functions.
+
+  The body function runs in the event loop; offload heavy computations
+  with :func:`asyncio.to_thread` inside a pipeline stage if needed.
+
+  Args:
+      bodyfun (callable): Callback (auto-normalized by :func:`~chunkiter.normalize_bodyfun`).
+      data: Async iterator yielding chunks.
+      yield_carry (bool): If ``True``, yield ``(chunk, carry)`` tuples.
+
+  Yields:
+      np.ndarray or (np.ndarray, object): Processed chunks (optionally with carry).
+  """
+  applier = _Applier(bodyfun)
+  async for chunk in data:
+    chunk, carry = applier.push(chunk)
+    yield (chunk, carry) if yield_carry else chunk
+
+async def sliding_window(data, window, step, output_chunksize=None, padding=False, yield_remainder=True):
+  """Async :func:`~chunkiter.sliding_window`, with the same parameters and output chunks.
+
+  Args:
+      data: Async iterator yielding 1-D ``np.ndarray`` chunks.
+
+  Yields:
+      np.ndarray or (int, np.ndarray): 2-D array of windows.
+  """
+  windows = _SlidingWindows(window, step, output_chunksize, padding, yield_remainder)
+  async for chunk in data:
+    for output in windows.push(chunk): yield output
+  for output in windows.flush(): yield output
+
+class _Signal(object):
+  # wakes up all waiting tasks when notified
+  def __init__(self):
+    self.future = None
+
+  async def wait(self):
+    if self.future is None or self.future.done(): self.future = asyncio.get_running_loop().create_future()
+    await self.future
+
+  def notify(self):
+    if self.future is not None and not self.future.done(): self.future.set_result(None)
+
+def tee(data, n=2, max_buffer=1):
+  """Memory-bounded tee for async chunk iterators.
+
+  Like :func:`~chunkiter.tee`, at most *max_buffer* items are buffered, but
+  instead of raising when a consumer falls behind, the consumers ahead wait
+  for it.  The consumers must therefore be iterated concurrently (e.g. in
+  separate tasks); a consumer that is closed no longer holds back the others.
+
+  Args:
+      data: Source async iterator.
+      n (int): Number of output iterators.
+      max_buffer (int): Maximum number of buffered items.
+
+  Returns:
+      tuple: *n* async iterators.
+
+  Example:
+      >>> a, b = chunkiter.aio.tee(source)
+      >>> await asyncio.gather(consume(a), consume(b))
+  """
+  buffer = collections.deque()
+  buffer_start = 0 # offset of buffer[0]
+  next_offsets = [0]*n # per-consumer next offsets to yield
+  fetching = False
+  done = False
+  signal = _Signal()
+
+  def trim():
+    nonlocal buffer_start
+    while len(buffer) and min(next_offsets)>buffer_start:
+      buffer.popleft()
+      buffer_start += 1
+    signal.notify()
+
+  async def gen(i):
+    nonlocal fetching, done
+    try:
+      while True:
+        while next_offsets[i]-buffer_start>=len(buffer) and not done and (fetching or len(buffer)>=max_buffer):
+          await signal.wait()
+
+        if next_offsets[i]-buffer_start<len(buffer):
+          item = buffer[next_offsets[i]-buffer_start]
+        elif done:
+          return
+        else:
+          fetching = True
+          try: item = await anext(data, _END)
+          finally:
+            fetching = False
+            signal.notify()
+          if item is _END:
+            done = True
+            return
+          buffer.append(item)
+
+        next_offsets[i] += 1
+        trim()
+        yield item
+    finally:
+      next_offsets[i] = float("inf")
+      trim()
+
+  return tuple(gen(i) for i in range(n))
+
+async def yielding_chunks_to_binaryfile(data, file, **kwargs):
+  """Async :func:`~chunkiter.yielding_chunks_to_binaryfile`.
+
+  Writing to an :class:`asyncio.StreamWriter` (e.g. from
+  :func:`asyncio.open_connection`) happens in the event loop with flow
+  control; writing to a regular file is offloaded to the default executor.
+
+  Args:
+      data: Async iterator yielding ``np.ndarray`` chunks (or tuples thereof).
+      file: :class:`asyncio.StreamWriter` or writable binary file-like object.
+      **kwargs: Passed to :func:`~chunkiter.yielding_chunks_to_binaryfile`.
+          *version* defaults to 2, which :class:`AsyncIterableBinaryFileChunks`
+          reads.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Original chunks, unchanged.
+
+  Example:
+      >>> reader, writer = await asyncio.open_connection("localhost", 12345)
+      >>> await chunkiter.aio.chunks_to_binaryfile(source, writer, compression="lz4")
+  """
+  kwargs.setdefault("verbose", False)
+  kwargs.setdefault("version", 2)
+  if isinstance(file, asyncio.StreamWriter):
+    stream = _StreamFile(file)
+    make_generator = lambda feeder: _yielding_chunks_to_binaryfile(feeder, stream, **kwargs)
+    async for chunk in _drive(make_generator, data, inline=True, after_step=file.drain): yield chunk
+  else:
+    make_generator = lambda feeder: _yielding_chunks_to_binaryfile(feeder, file, **kwargs)
+    async for chunk in _drive(make_generator, data): yield chunk
+
+class _StreamFile(object):
+  # file-like adapter for an asyncio.StreamWriter; written data is copied, as the transport
+  # may keep it until it is sent
+  def __init__(self, writer):
+    self.writer = writer
+
+  def write(self, b):
+    self.writer.write(bytes(b))
+    return len(b)
+
+  def flush(self):
+    pass
+
+async def chunks_to_binaryfile(data, file, **kwargs):
+  """Consume an async iterator and write all chunks to binary format, see :func:`yielding_chunks_to_binaryfile`."""
+  async for chunk in yielding_chunks_to_binaryfile(data, file, **kwargs): pass
+
+async def yielding_chunks_to_h5(data, filename, **kwargs):
+  """Async :func:`~chunkiter.yielding_chunks_to_h5`.
+
+  Compression and writing are offloaded to a single thread shared by all
+  async HDF5 sinks, as PyTables must not be used from several threads at
+  the same time.
+
+  Args:
+      data: Async iterator yielding ``np.ndarray`` chunks (or tuples thereof).
+      filename (str or tuple): Output HDF5 filename(s).
+      **kwargs: Passed to :func:`~chunkiter.yielding_chunks_to_h5`.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Original chunks, unchanged.
+  """
+  make_generator = lambda feeder: _yielding_chunks_to_h5(feeder, filename, **kwargs)
+  async for chunk in _drive(make_generator, data, executor=_get_h5_executor()): yield chunk
+
+async def chunks_to_h5(data, filename, **kwargs):
+  """Consume an async iterator and write all chunks to HDF5, see :func:`yielding_chunks_to_h5`."""
+  async for chunk in yielding_chunks_to_h5(data, filename, **kwargs): pass
+
+
+# ============================================================
+# --- tests ---
+# ============================================================
+
+async def _aiter(chunks):
+  """Async iterator over a list, giving control to the event loop in between."""
+  for chunk in chunks:
+    await asyncio.sleep(0)
+    yield chunk
+
+async def _alist(data):
+  return [chunk async for chunk in data]
+
+def _split(rng, x, n):
+  return np.split(x, sorted(rng.choice(range(1, len(x)), size=n, replace=False)))
+
+def test_rechunk_matches_sync():
+  """Async rechunk yields exactly the chunks of the synchronous one."""
+  import numpy as np
+  from chunkiter import rechunk as sync_rechunk
+  rng = np.random.default_rng(42)
+  x = rng.standard_normal((100, 2))
+  chunks = _split(rng, x, 9)
+  for kwargs in [dict(), dict(overlap_size=3), dict(padding=True), dict(yield_remainder=False)]:
+    expected = list(sync_rechunk(iter(chunks), 7, **kwargs))
+    result = asyncio.run(_alist(rechunk(_aiter(chunks), 7, **kwargs)))
+    assert len(result) == len(expected)
+    for a, b in zip(result, expected):
+      if kwargs.get("padding"):
+        assert a[0] == b[0]
+        a, b = a[1], b[1]
+      assert np.array_equal(a, b)
+
+def test_apply_carry():
+  """Async apply passes counters and carries like the synchronous one."""
+  import numpy as np
+  def running_sum(chunk_i, chunk, carry):
+    carry = np.cumsum(chunk) + carry
+    return carry, carry[-1]
+  running_sum.has_carry = True
+  running_sum.has_counter = True
+  running_sum.initial_carry = 0
+  chunks = [np.array([1, 2, 3]), np.array([4, 5, 6])]
+  result = asyncio.run(_alist(apply(running_sum, _aiter(chunks))))
+  assert np.array_equal(np.concatenate(result), np.cumsum(np.concatenate(chunks)))
+
+def test_sliding_window_matches_sync():
+  """Async sliding_window yields exactly the windows of the synchronous one."""
+  import numpy as np
+  from chunkiter import sliding_window as sync_sliding_window
+  rng = np.random.default_rng(42)
+  x = rng.standard_normal(200)
+  chunks = _split(rng, x, 15)
+  expected = list(sync_sliding_window(iter(chunks), 10, 3, output_chunksize=7))
+  result = asyncio.run(_alist(sliding_window(_aiter(chunks), 10, 3, output_chunksize=7)))
+  assert len(result) == len(expected)
+  assert all(np.array_equal(a, b) for a, b in zip(result, expected))
+
+def test_tee_concurrent():
+  """Concurrent consumers of tee get all items with a bounded buffer."""
+  async def main():
+    a, b = tee(_aiter(list(range(20))), max_buffer=2)
+    return await asyncio.gather(_alist(a), _alist(b))
+  a, b = asyncio.run(main())
+  assert a == b == list(range(20))
+
+def test_tee_closed_consumer():
+  """A consumer that stops early does not block the others."""
+  async def main():
+    a, b = tee(_aiter(list(range(10))), max_buffer=3)
+    async for item in a:
+      if item == 2: break
+    await a.aclose()
+    return await _alist(b)
+  assert asyncio.run(main()) == list(range(10))
+
+def test_binary_stream_roundtrip():
+  """Chunks written to an asyncio stream are read back unchanged."""
+  import numpy as np
+  rng = np.random.default_rng(42)
+  chunks = [(rng.standard_normal((n, 3)), np.arange(n)) for n in [5, 0, 17]]
+
+  async def main(**kwargs):
+    received = []
+    async def handle(reader, writer):
+      received.extend([(a.copy(), b.copy()) async for a, b in AsyncIterableBinaryFileChunks(reader)])
+      writer.close()
+      done.set()
+    done = asyncio.Event()
+    server = await asyncio.start_server(handle, "localhost", 0)
+    reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+    await chunks_to_binaryfile(_aiter(chunks), writer, **kwargs)
+    writer.close()
+    await done.wait()
+    server.close()
+    return received
+
+  for kwargs in [dict(), dict(compression="lz4"), dict(index=True)]:
+    received = asyncio.run(main(**kwargs))
+    assert len(received) == len(chunks)
+    for (a, b), (c, d) in zip(received, chunks):
+      assert np.array_equal(a, c) and np.array_equal(b, d)
+
+def test_binaryfile_sync_reader():
+  """Files written by the async sink are readable by IterableBinaryFileChunks."""
+  import numpy as np
+  import io
+  from chunkiter import IterableBinaryFileChunks
+  chunks = [np.full(4, i) for i in range(5)]
+  f = io.BytesIO()
+  result = asyncio.run(_alist(yielding_chunks_to_binaryfile(_aiter(chunks), f)))
+  assert len(result) == 5
+  f.seek(0)
+  assert [c[0] for c in IterableBinaryFileChunks(f)] == list(range(5))
+
+def test_h5_sink():
+  """Chunks written by the async HDF5 sink are read back unchanged."""
+  import numpy as np
+  import os
+  import tempfile
+  from chunkiter import IterableH5Chunks
+  rng = np.random.default_rng(42)
+  chunks = [rng.standard_normal((10, 2)) for i in range(4)]
+  filenames = [os.path.join(tempfile.mkdtemp(), "test.h5") for i in range(2)]
+
+  async def main():
+    # two sinks running concurrently
+    await asyncio.gather(*(chunks_to_h5(_aiter(chunks), fn) for fn in filenames))
+  asyncio.run(main())
+
+  for fn in filenames:
+    result = list(IterableH5Chunks(fn))
+    assert all(np.array_equal(a, b) for a, b in zip(result, chunks))
+
+def test_from_iterable():
+  """Synchronous iterables are pulled without blocking the loop."""
+  assert asyncio.run(_alist(from_iterable(iter(range(5))))) == list(range(5))
+
+
+if __name__ == "__main__":
+  tests = [test_rechunk_matches_sync, test_apply_carry, test_sliding_window_matches_sync,
+           test_tee_concurrent, test_tee_closed_consumer, test_binary_stream_roundtrip,
+           test_binaryfile_sync_reader, test_h5_sink, test_from_iterable]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
@@ -0,0 +1,514 @@
+"""
+broadcasting a binary chunk stream to several subscribers
+"""
+
+import io
+import os
+import time
+import queue
+import socket
+import threading
+
+from ..functions import yielding_chunks_to_binaryfile, IterableBinaryFileChunks, _read_stream_header, _STREAM_ALIGNED
+
+__all__ = ['BroadcastServer', 'broadcast', 'subscribe']
+
+_POLICIES = ("block", "drop-oldest", "disconnect")
+
+def _listen(address):
+  # TCP for (host, port) tuples, Unix sockets for paths
+  if type(address)==tuple:
+    sock = socket.create_server(address)
+  else:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+    sock.listen()
+  return sock
+
+def _connect(address):
+  if type(address)==tuple:
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  else:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+  return sock
+
+class _Subscriber(object):
+  # one connected client: a bounded queue of messages and a thread sending them
+  def __init__(self, server, sock, header):
+    self.server = server
+    self.sock = sock
+    self.header = header # set once the stream header is known; sent before the first message
+    self.queue = queue.Queue(maxsize=server.queue_size)
+    self.closed = False
+    self.dropped = 0
+    self.thread = threading.Thread(target=self._worker, daemon=True)
+    self.thread.start()
+
+  def _worker(self):
+    header_sent = False
+    while True:
+      message = self.queue.get()
+      if message is None or self.closed: break
+      try:
+        if not header_sent:
+          self.sock.sendall(self.header)
+          header_sent = True
+        self.sock.sendall(message)
+      except OSError:
+        self.server._remove(self)
+        break
+    self.sock.close()
+
+  def _disconnect(self):
+    self.server._remove(self)
+    try: self.sock.shutdown(socket.SHUT_RDWR) # wakes the worker if it is stuck sending
+    except OSError: pass
+
+  def put(self, message, wait=False):
+    # with wait, the message is queued regardless of the policy, waiting up to the timeout of
+    # the server and disconnecting afterwards
+    if self.server.policy=="block" or wait:
+      t_end = time.monotonic()+self.server.timeout if wait and self.server.timeout is not None else None
+      while not self.closed:
+        try:
+          self.queue.put(message, timeout=0.1)
+          return
+        except queue.Full:
+          if t_end is not None and time.monotonic()>t_end: self._disconnect()
+      return
+
+    while not self.closed:
+      try:
+        self.queue.put_nowait(message)
+        return
+      except queue.Full:
+        pass
+
+      if self.server.policy=="disconnect":
+        self._disconnect()
+        return
+
+      try:
+        self.queue.get_nowait()
+        self.dropped += 1
+      except queue.Empty:
+        pass
+
+class BroadcastServer(object):
+  """Server that sends one binary chunk stream to any number of subscribers.
+
+  The server is a writable file-like object for
+  :func:`~chunkiter.yielding_chunks_to_binaryfile`: the bytes of each chunk
+  are collected until the writer flushes, and the resulting message is
+  queued unchanged for every subscriber, so the stream is serialized only
+  once.  Subscribers connecting in the middle of a stream first receive the
+  stream header and then start with the next chunk.  Subscribers read the
+  stream with :class:`~chunkiter.IterableBinaryFileChunks`, see
+  :func:`subscribe`.
+
+  Only streams of format version 2 without index can be broadcast: the
+  end marker of version 2 tells subscribers that the stream is complete,
+  and the padding of indexed streams depends on the position in the
+  stream, which differs for subscribers that joined late or dropped chunks.
+
+  Args:
+      address (tuple or str): ``(host, port)`` to listen on TCP, or a path
+          to listen on a Unix socket (removed again by :meth:`close`).  A
+          port of 0 picks a free port, see the ``address`` attribute.
+      queue_size (int): Maximum number of chunks queued per subscriber.
+      policy (str): What to do when the queue of a subscriber is full:
+          ``"block"`` waits until the subscriber has caught up (slowing
+          down the stream for all subscribers), ``"drop-oldest"`` discards
+          the oldest queued chunk of that subscriber, and ``"disconnect"``
+          closes its connection.  The end of the stream is queued
+          in any case, see *timeout*.
+      timeout (float, None): Maximum time in seconds to wait for a
+          subscriber with a full queue to make space for the end of the
+          stream, after which it is disconnected.  ``None`` waits as long
+          as it takes.
+
+  Raises:
+      ValueError: If *policy* is unknown, or (when writing) if the stream is
+          of version 1 or has an index.
+
+  Example:
+      >>> with chunkiter.BroadcastServer(("localhost", 12345), policy="drop-oldest") as server:
+      ...     server.wait(2) # until two subscribers are connected
+      ...     chunkiter.chunks_to_binaryfile(source, server, verbose=False, version=2)
+  """
+  def __init__(self, address, queue_size=16, policy="block", timeout=None):
+    if policy not in _POLICIES: raise ValueError("policy must be one of {}".format(", ".join(_POLICIES)))
+    self.queue_size = queue_size
+    self.policy = policy
+    self.timeout = timeout
+
+    self._sock = _listen(address)
+    self._sock.settimeout(0.1)
+    self.address = self._sock.getsockname()
+    self._unlink = None if type(address)==tuple else address
+
+    self._lock = threading.Condition()
+    self._subscribers = []
+    self._header = None
+    self._end = None
+    self._buffer = []
+    self._closed = False
+    self._thread = threading.Thread(target=self._accept, daemon=True)
+    self._thread.start()
+
+  def _accept(self):
+    while not self._closed:
+      try: sock, _ = self._sock.accept()
+      except socket.timeout: continue
+      except OSError: break
+
+      sock.settimeout(None)
+      if sock.family!=socket.AF_UNIX: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      with self._lock:
+        if self._closed:
+          sock.close()
+          break
+        self._subscribers.append(_Subscriber(self, sock, self._header))
+        self._lock.notify_all()
+
+  def _remove(self, subscriber):
+    with self._lock:
+      subscriber.closed = True
+      if subscriber in self._subscribers: self._subscribers.remove(subscriber)
+
+  @property
+  def subscribers(self):
+    """Number of connected subscribers."""
+    with self._lock:
+      return len(self._subscribers)
+
+  def wait(self, n=1, timeout=None):
+    """Wait until at least *n* subscribers are connected.
+
+    Args:
+        n (int): Number of subscribers.
+        timeout (float, None): Maximum waiting time in seconds.
+
+    Returns:
+        bool: ``False`` if the timeout expired.
+    """
+    with self._lock:
+      return self._lock.wait_for(lambda: len(self._subscribers)>=n, timeout)
+
+  def write(self, b):
+    self._buffer.append(bytes(b))
+    return len(b)
+
+  def flush(self):
+    if not len(self._buffer): return
+    message = b''.join(self._buffer)
+    self._buffer = []
+
+    with self._lock:
+      if self._header is None:
+        # split off the stream header, which late subscribers get first
+        if message[:5]!=b'CHUNK': raise ValueError("only binary streams of version 2 can be broadcast")
+        f = io.BytesIO(message)
+        f.read(5)
+        flags, dtypes, _, size = _read_stream_header(f)
+        if flags&_STREAM_ALIGNED: raise ValueError("indexed binary streams cannot be broadcast")
+        self._header, message = message[:size], message[size:]
+        self._end = b'\xff'*(8*len(dtypes)) # the end marker, all row counts -1
+        for subscriber in self._subscribers: subscriber.header = self._header
+      subscribers = list(self._subscribers)
+
+    # the end marker must not get the subscriber disconnected; drop-oldest makes space by dropping a chunk
+    wait = message==self._end and self.policy=="disconnect"
+    for subscriber in subscribers: subscriber.put(message, wait)
+
+  def close(self):
+    """Send the remaining queued data, then disconnect all subscribers and stop listening."""
+    self.flush()
+    with self._lock:
+      self._closed = True
+      subscribers = list(self._subscribers)
+    self._thread.join()
+    self._sock.close()
+    if self._unlink is not None: os.unlink(self._unlink)
+
+    for subscriber in subscribers:
+      subscriber.put(None, wait=True)
+      subscriber.thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def broadcast(iterator, address, queue_size=16, policy="block", subscribers=0, timeout=None, **kwargs):
+  """Broadcast chunks to subscribers while yielding them for further processing.
+
+  Runs a :class:`BroadcastServer` for the duration of the iteration and
+  writes the chunks to it with
+  :func:`~chunkiter.yielding_chunks_to_binaryfile`.
+
+  Args:
+      iterator: Iterator yielding ``np.ndarray`` chunks (or tuples thereof).
+      address (tuple or str): TCP ``(host, port)`` or Unix socket path.
+      queue_size (int): Maximum number of chunks queued per subscriber.
+      policy (str): ``"block"``, ``"drop-oldest"`` or ``"disconnect"``, see
+          :class:`BroadcastServer`.
+      subscribers (int): Wait for this many subscribers before the first chunk.
+      timeout (float, None): Maximum time to wait for the subscribers, and
+          at the end for each of them to take the end of the stream.
+      **kwargs: Passed to :func:`~chunkiter.yielding_chunks_to_binaryfile`,
+          e.g. *compression*.
+
+  Raises:
+      ValueError: If *version* 1 or *index* is requested.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Original chunks, unchanged.
+
+  Example:
+      >>> source = chunkiter.IterableH5Chunks("input.h5", "data")
+      >>> for chunk in chunkiter.broadcast(source, "/tmp/acquisition.sock"):
+      ...     pass  # chunks are sent to all subscribers and can also be processed here
+  """
+  kwargs.setdefault("version", 2)
+  if kwargs["version"]!=2 or kwargs.get("index", False):
+    raise ValueError("only binary streams of version 2 without index can be broadcast")
+  kwargs.setdefault("verbose", False)
+  with BroadcastServer(address, queue_size, policy, timeout) as server:
+    server.wait(subscribers, timeout)
+    yield from yielding_chunks_to_binaryfile(iterator, server, **kwargs)
+
+def subscribe(address, **kwargs):
+  """Connect to a :class:`BroadcastServer` and iterate over the broadcast chunks.
+
+  Args:
+      address (tuple or str): TCP ``(host, port)`` or Unix socket path.
+      **kwargs: Passed to :class:`~chunkiter.IterableBinaryFileChunks`,
+          e.g. *buffers* or *threads*.
+
+  Returns:
+      IterableBinaryFileChunks: Iterable over the chunks.  The iteration ends
+      with the end marker of the stream, and raises :class:`EOFError` if
+      the connection closes before, e.g. because the producer stopped early
+      or the server disconnected this subscriber.
+
+  Example:
+      >>> for chunk in chunkiter.subscribe(("localhost", 12345)):
+      ...     print(chunk.shape)
+  """
+  return IterableBinaryFileChunks(_connect(address).makefile("rb"), require_end=True, **kwargs)
+
+
+# ============================================================
+# --- tests ---
+# ============================================================
+
+def _serve(chunks, address, n, **kwargs):
+  """Broadcast *chunks* to *n* subscribers from a thread."""
+  ready = threading.Event()
+  server = BroadcastServer(address, **kwargs)
+
+  def run():
+    server.wait(n)
+    ready.set()
+    for chunk in yielding_chunks_to_binaryfile(iter(chunks), server, verbose=False, version=2): pass
+    server.close()
+
+  thread = threading.Thread(target=run, daemon=True)
+  thread.start()
+  return server, thread
+
+def test_tcp_two_subscribers():
+  """Both subscribers receive the complete stream."""
+  import numpy as np
+  rng = np.random.default_rng(42)
+  chunks = [rng.standard_normal((n, 3)) for n in [5, 0, 17, 1]]
+  server, thread = _serve(chunks, ("localhost", 0), 2)
+
+  results = [None, None]
+  def read(i):
+    results[i] = [c.copy() for c in subscribe(server.address)]
+  readers = [threading.Thread(target=read, args=(i,)) for i in range(2)]
+  for r in readers: r.start()
+  for r in readers: r.join()
+  thread.join()
+
+  for result in results:
+    assert len(result) == len(chunks)
+    for a, b in zip(result, chunks):
+      assert np.array_equal(a, b)
+
+def test_unix_tuples():
+  """Tuples of arrays over a Unix socket; the socket file is removed afterwards."""
+  import numpy as np
+  import tempfile
+  path = os.path.join(tempfile.mkdtemp(), "broadcast.sock")
+  chunks = [(np.arange(n), np.ones((n, 2), np.float32)) for n in [3, 4]]
+  server, thread = _serve(chunks, path, 1)
+
+  result = list(subscribe(path))
+  thread.join()
+  assert len(result) == 2
+  for (a, b), (c, d) in zip(result, chunks):
+    assert np.array_equal(a, c) and np.array_equal(b, d)
+  assert not os.path.exists(path)
+
+def test_late_subscriber():
+  """A subscriber joining mid-stream gets the header and the following chunks."""
+  import numpy as np
+  server = BroadcastServer(("localhost", 0))
+  first = subscribe(server.address)
+  server.wait(1)
+  chunks = [np.full(4, i) for i in range(6)]
+  stream = yielding_chunks_to_binaryfile(iter(chunks), server, verbose=False, version=2)
+  for i in range(3): next(stream)
+
+  late = subscribe(server.address)
+  server.wait(2)
+  for chunk in stream: pass
+  server.close()
+
+  assert [c[0] for c in first] == list(range(6))
+  assert [c[0] for c in late] == [3, 4, 5]
+
+def test_drop_oldest():
+  """A subscriber that does not read loses the oldest chunks, not the stream."""
+  import numpy as np
+  server = BroadcastServer(("localhost", 0), queue_size=2, policy="drop-oldest")
+  sock = _connect(server.address)
+  server.wait(1)
+  # chunks large enough to fill the socket buffers
+  chunks = [np.full(2**20, i, np.uint8) for i in range(40)]
+  for chunk in yielding_chunks_to_binaryfile(iter(chunks), server, verbose=False, version=2): pass
+
+  reader = IterableBinaryFileChunks(sock.makefile("rb"))
+  closer = threading.Thread(target=server.close)
+  closer.start()
+  received = [c[0] for c in reader]
+  closer.join()
+
+  assert 0 < len(received) < 40
+  assert received == sorted(received) and received[-1] == 39
+
+def test_disconnect():
+  """A subscriber that does not read is disconnected; the others get everything."""
+  import numpy as np
+  import time
+  server = BroadcastServer(("localhost", 0), queue_size=2, policy="disconnect")
+  slow = _connect(server.address)
+  server.wait(1)
+
+  received = []
+  def read():
+    for c in subscribe(server.address): received.append(c[0])
+  reader = threading.Thread(target=read)
+  reader.start()
+  server.wait(2)
+
+  def chunks():
+    for i in range(40):
+      yield np.full(2**20, i, np.uint8)
+      while len(received) <= i: time.sleep(0.001) # keep pace with the reading subscriber
+  for chunk in yielding_chunks_to_binaryfile(chunks(), server, verbose=False, version=2): pass
+  assert server.subscribers == 1
+  server.close()
+  reader.join()
+  slow.close()
+
+  assert received == list(range(40))
+
+def test_slow_subscriber_gets_end():
+  """The end of the stream reaches a slow subscriber whatever the policy, or it is disconnected after the timeout."""
+  import numpy as np
+  import time
+  chunks = [np.full(2**23, i, np.uint8) for i in range(3)] # larger than the socket buffers
+  server = BroadcastServer(("localhost", 0), queue_size=3, policy="disconnect")
+  client = subscribe(server.address)
+  server.wait(1)
+  for chunk in yielding_chunks_to_binaryfile(iter(chunks), server, verbose=False, version=2): pass
+  closer = threading.Thread(target=server.close)
+  closer.start()
+  time.sleep(0.3) # close() finds the queue full
+  assert [c[0] for c in client] == [0, 1, 2]
+  closer.join()
+
+  server = BroadcastServer(("localhost", 0), queue_size=3, policy="disconnect", timeout=0.2)
+  sock = _connect(server.address)
+  server.wait(1)
+  for chunk in yielding_chunks_to_binaryfile(iter(chunks), server, verbose=False, version=2): pass
+  t_start = time.monotonic()
+  server.close()
+  assert time.monotonic()-t_start < 5
+  sock.close()
+
+def test_compressed():
+  """Compressed streams are fanned out like raw ones."""
+  import numpy as np
+  chunks = [np.linspace(0, 1, 1000) for i in range(3)]
+  address = ("localhost", 0)
+  server = BroadcastServer(address)
+  client = subscribe(server.address, threads=2)
+  server.wait(1)
+  for chunk in yielding_chunks_to_binaryfile(iter(chunks), server, verbose=False, compression="zstd"): pass
+  server.close()
+  result = list(client)
+  assert len(result) == 3 and all(np.array_equal(a, b) for a, b in zip(result, chunks))
+
+def test_producer_stops_early():
+  """Subscribers get EOFError if the stream ends without its end marker."""
+  import numpy as np
+  server = BroadcastServer(("localhost", 0))
+  client = subscribe(server.address)
+  server.wait(1)
+  stream = yielding_chunks_to_binaryfile((np.full(4, i) for i in range(6)), server, verbose=False, version=2)
+  for i in range(3): next(stream)
+  stream.close()
+  server.close()
+
+  received = []
+  try:
+    for c in client: received.append(c[0])
+    assert False, "expected EOFError"
+  except EOFError:
+    pass
+  assert received == [0, 1, 2]
+
+def test_unsupported_streams():
+  """Indexed and version 1 streams cannot be broadcast."""
+  import numpy as np
+  for kwargs in (dict(index=True), dict(version=1)):
+    try:
+      next(broadcast(iter([np.ones(3)]), ("localhost", 0), **kwargs))
+      assert False, "expected ValueError"
+    except ValueError:
+      pass
+
+    with BroadcastServer(("localhost", 0)) as server:
+      try:
+        next(yielding_chunks_to_binaryfile(iter([np.ones(3)]), server, verbose=False, **kwargs))
+        assert False, "expected ValueError"
+      except ValueError:
+        pass
+
+def test_bad_policy():
+  """Unknown policies raise ValueError."""
+  try:
+    BroadcastServer(("localhost", 0), policy="drop-newest")
+    assert False, "expected ValueError"
+  except ValueError:
+    pass
+
+
+if __name__ == "__main__":
+  tests = [test_tcp_two_subscribers, test_unix_tuples, test_late_subscriber,
+           test_drop_oldest, test_disconnect, test_slow_subscriber_gets_end, test_compressed, test_producer_stops_early,
+           test_unsupported_streams, test_bad_policy]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
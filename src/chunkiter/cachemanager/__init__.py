@@ -0,0 +1,535 @@
+"""
+inspection and size-bounded pruning of cache directories, and an in-memory cache tier
+"""
+
+import os
+import time
+import threading
+import collections
+
+from .. import functions
+from ..functions import cache_backends
+
+__all__ = ['CacheManager', 'CacheEntry', 'MemoryCache', 'IterableMemoryChunks']
+
+CacheEntry = collections.namedtuple("CacheEntry", [
+  "path", "backend", "identifier", "version", "input_identifier",
+  "size", "last_used", "computation_time", "finished", "stale",
+], defaults=(False,))
+CacheEntry.__doc__ = """An entry of a cache directory, as listed by :meth:`CacheManager.entries`.
+
+Attributes:
+    path (str): Path of the file or directory.
+    backend (CacheBackend): Backend that wrote the entry.
+    identifier (str): First identifier passed to :func:`cache`.
+    version (str): Version passed with the identifier.
+    input_identifier (str): Hash of the other identifiers.
+    size (int): Size on disk in bytes.
+    last_used (float): Time of creation or the last cache hit.
+    computation_time (float): Seconds spent computing the result (0 if unknown).
+    finished (bool): Whether the computation has completed.
+    stale (bool): Whether the entry is left over from an interrupted
+        computation that is not running anymore: a partial result (*path*
+        ends with ``.partial``; its size includes the checkpoint), or a lock
+        file without result (*path* ends with ``.lock``, *backend* is
+        ``None``).
+"""
+
+def _backend(name):
+  # the cache backend writing entries of this name, or None
+  for backend in cache_backends.values():
+    if backend.suffix and name.endswith(backend.suffix): return backend
+  return None
+
+def _held(lock_path):
+  # whether a running computation of cache() holds the lock file; without fcntl, assume so
+  if not os.path.exists(lock_path): return False
+  if functions.fcntl is None: return True
+  lock = functions._FileLock(lock_path)
+  if not lock.acquire(blocking=False): return True
+  lock.release()
+  return False
+
+def _disk_size(path):
+  if not os.path.isdir(path): return os.path.getsize(path)
+  size = 0
+  for root, dirs, files in os.walk(path):
+    for f in files:
+      try: size += os.path.getsize(os.path.join(root, f))
+      except FileNotFoundError: pass # removed meanwhile, e.g. a temporary file
+  return size
+
+class CacheManager(object):
+  """Inspects a cache directory and prunes it to a byte budget.
+
+  Pass it as *cache_manager* to :func:`cache` (or set
+  ``chunkiter.functions.default_cache_manager``) to prune after every call.
+
+  Pruning first removes superseded entries: finished entries whose
+  identifier has a more recently used entry with a different version, and
+  lock files left without result.  Then, while the directory exceeds
+  *max_bytes*, the partial results of interrupted computations are removed,
+  oldest first (within the budget they are kept, so that the computation
+  can resume from its checkpoint), and then finished entries are evicted
+  in order of decreasing ``age/(1 + cost_weight*computation_time)``, where
+  ``age`` is the time in seconds since the last use, so that results which
+  took long to compute are kept longer than cheap ones of the same age.
+  Entries of running computations are never removed.
+
+  Args:
+      cachedir (str, None): Cache directory.  Defaults to ``"cache"``.
+      max_bytes (int, None): Byte budget; ``None`` for no limit.
+      cost_weight (float): Weight of the computation time in seconds in
+          the eviction order.  0 evicts in plain LRU order.
+      remove_superseded (bool): Remove superseded entries when pruning.
+
+  Example:
+      >>> manager = chunkiter.CacheManager("cache", max_bytes=50*1024**3)
+      >>> for entry in manager.entries():
+      ...     print(entry.identifier, entry.version, entry.size, entry.computation_time)
+      >>> fftdata = chunkiter.cache(source, "fft", source.identifier, cache_manager=manager)
+  """
+  def __init__(self, cachedir=None, max_bytes=None, cost_weight=1.0, remove_superseded=True):
+    self.cachedir = cachedir if cachedir is not None else functions.default_cachedir
+    self.max_bytes = max_bytes
+    self.cost_weight = cost_weight
+    self.remove_superseded = remove_superseded
+
+  def entries(self):
+    """List the entries of the cache directory.
+
+    Returns:
+        list of CacheEntry: Entries written by any of the ``cache_backends``,
+        and stale leftovers of interrupted computations, most recently used
+        first.
+    """
+    if not os.path.isdir(self.cachedir): return []
+
+    names = set(os.listdir(self.cachedir))
+    entries = []
+    for name in names:
+      stale = name.endswith(".partial") or name.endswith(".lock")
+      entry_name = name.rsplit(".", 1)[0] if stale else name
+      backend = _backend(entry_name)
+      if backend is None: continue
+
+      path = os.path.join(self.cachedir, name)
+      if stale:
+        # only leftovers that no running computation holds; a lock file with a
+        # partial result is listed with it, one with a result is still in use
+        if name.endswith(".lock") and (entry_name in names or entry_name+".partial" in names): continue
+        if _held(os.path.join(self.cachedir, entry_name+".lock")): continue
+
+      try:
+        attrs = backend.attrs(path) if not stale else {}
+        size = _disk_size(path)
+        if name.endswith(".partial") and name+".checkpoint" in names:
+          size += _disk_size(path+".checkpoint")
+        last_used = os.stat(path).st_mtime
+      except FileNotFoundError: continue # removed meanwhile
+
+      # entries written before the identifier was stored: parse the name
+      parts = entry_name[:-len(backend.suffix)].rsplit(".", 2)
+      if len(parts)<3: parts = [parts[0], "0", "0"]
+
+      entries.append(CacheEntry(
+        path = path,
+        backend = backend if not name.endswith(".lock") else None,
+        identifier = attrs.get("identifier", parts[0]),
+        version = attrs.get("version", parts[1]),
+        input_identifier = attrs.get("input_identifier", parts[2]),
+        size = size,
+        last_used = last_used,
+        computation_time = attrs.get("computation_time", 0.),
+        finished = bool(attrs.get("finished", False)),
+        stale = stale,
+      ))
+
+    entries.sort(key=lambda e: e.last_used, reverse=True)
+    return entries
+
+  def size(self):
+    """Return the total size of all entries in bytes."""
+    return sum(e.size for e in self.entries())
+
+  def superseded(self, entries=None):
+    """List finished entries whose identifier has a more recently used entry with a different version.
+
+    Args:
+        entries (list of CacheEntry, None): Entries to consider, by default
+            :meth:`entries`.
+
+    Returns:
+        list of CacheEntry: The superseded entries.
+    """
+    if entries is None: entries = self.entries()
+    current = {}
+    for e in sorted((e for e in entries if not e.stale), key=lambda e: e.last_used):
+      current[e.identifier] = e.version
+    return [e for e in entries if e.finished and not e.stale and e.version!=current[e.identifier]]
+
+  def remove(self, entry):
+    """Remove an entry from the cache directory.
+
+    The lock file of the entry is removed with it.  Stale leftovers are
+    removed together with their checkpoint, unless a computation has taken
+    them up again meanwhile.
+
+    Args:
+        entry (CacheEntry): Entry as listed by :meth:`entries`.
+    """
+    entry_path = entry.path.rsplit(".", 1)[0] if entry.stale else entry.path
+    if not entry.stale: entry.backend.remove(entry.path)
+
+    lock = functions._FileLock(entry_path+".lock")
+    if not lock.acquire(blocking=False): return
+    try:
+      if entry.stale and entry.backend is not None:
+        entry.backend.remove(entry.path)
+        if os.path.exists(entry.path+".checkpoint"): os.remove(entry.path+".checkpoint")
+      if not os.path.exists(entry_path) and not os.path.exists(entry_path+".partial"):
+        os.remove(entry_path+".lock")
+    finally:
+      lock.release()
+
+  def prune(self, max_bytes=None, keep=(), dry_run=False):
+    """Remove superseded entries and evict entries until the directory fits the budget.
+
+    Args:
+        max_bytes (int, None): Byte budget, by default the one given to the
+            constructor.
+        keep (iterable of str): Paths of entries that must not be removed.
+        dry_run (bool): Only return the entries that would be removed.
+
+    Returns:
+        list of CacheEntry: The removed entries.
+    """
+    if max_bytes is None: max_bytes = self.max_bytes
+    keep = [os.path.abspath(path) for path in keep]
+    entries = self.entries()
+    total = sum(e.size for e in entries)
+
+    removed = self.superseded(entries) if self.remove_superseded else []
+    removed = [e for e in removed if os.path.abspath(e.path) not in keep]
+    total -= sum(e.size for e in removed)
+
+    # lock files without result take no space, but add up
+    orphans = [e for e in entries if e.stale and e.backend is None]
+    removed += orphans
+
+    if max_bytes is not None and total>max_bytes:
+      now = time.time()
+      score = lambda e: (now-e.last_used)/(1+self.cost_weight*e.computation_time)
+      partials = [e for e in entries if e.stale and e.backend is not None]
+      candidates = [e for e in entries if e.finished and e not in removed and os.path.abspath(e.path) not in keep]
+      for e in sorted(partials, key=lambda e: e.last_used)+sorted(candidates, key=score, reverse=True):
+        if total<=max_bytes: break
+        removed.append(e)
+        total -= e.size
+
+    if not dry_run:
+      for e in removed: self.remove(e)
+    return removed
+
+def _nbytes(chunk):
+  return sum(c.nbytes for c in chunk) if type(chunk)==tuple else chunk.nbytes
+
+def _readonly_copy(chunk):
+  def copy(c):
+    c = c.copy()
+    c.flags.writeable = False
+    return c
+  return tuple(copy(c) for c in chunk) if type(chunk)==tuple else copy(chunk)
+
+class MemoryCache(object):
+  """In-memory tier in front of the on-disk cache, holding small results as lists of chunks.
+
+  Pass it as *memory_cache* to :func:`cache` (or set
+  ``chunkiter.functions.default_memory_cache``).  Results of up to
+  *max_entry_bytes* are kept in memory after they have been computed or
+  read completely once, and served from there by the iterables returned by
+  :func:`cache`; larger results are always read from disk.  When the
+  resident results exceed *max_bytes*, the least recently used ones are
+  dropped.
+
+  The resident chunks are shared by all consumers and are therefore
+  read-only.
+
+  Args:
+      max_bytes (int): Budget for all resident results, in bytes of chunk
+          data.
+      max_entry_bytes (int, None): Largest result to keep, by default
+          *max_bytes*.
+
+  Example:
+      >>> memory = chunkiter.MemoryCache(2*1024**3)
+      >>> fftdata = chunkiter.cache(source, "fft", source.identifier, memory_cache=memory)
+      >>> half = (c / 2 for c in fftdata)    # read from disk, kept in memory
+      >>> double = (c * 2 for c in fftdata)  # served from memory
+  """
+  def __init__(self, max_bytes, max_entry_bytes=None):
+    self.max_bytes = max_bytes
+    self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes
+    self._entries = collections.OrderedDict() # key -> (chunks, nbytes), least recently used first
+    self._lock = threading.Lock()
+
+  @property
+  def nbytes(self):
+    """Bytes of chunk data currently resident."""
+    with self._lock: return sum(nbytes for chunks, nbytes in self._entries.values())
+
+  def __contains__(self, key):
+    with self._lock: return key in self._entries
+
+  def get(self, key):
+    """Return the resident chunks for *key* as a list, or ``None``."""
+    with self._lock:
+      if key not in self._entries: return None
+      self._entries.move_to_end(key)
+      return self._entries[key][0]
+
+  def put(self, key, chunks):
+    """Make the list of read-only *chunks* resident under *key*, evicting others as needed.
+
+    Returns:
+        bool: Whether the chunks fit and were kept.
+    """
+    nbytes = sum(_nbytes(c) for c in chunks)
+    with self._lock:
+      self._entries.pop(key, None)
+      if nbytes>self.max_entry_bytes or nbytes>self.max_bytes: return False
+      total = sum(n for c, n in self._entries.values())
+      while total+nbytes>self.max_bytes:
+        total -= self._entries.popitem(last=False)[1][1]
+      self._entries[key] = (chunks, nbytes)
+      return True
+
+  def remove(self, key):
+    """Drop the chunks for *key*, if resident."""
+    with self._lock: self._entries.pop(key, None)
+
+  def clear(self):
+    """Drop all resident chunks."""
+    with self._lock: self._entries.clear()
+
+  def collect(self, key, iterator):
+    """Pass on the chunks of *iterator*, keeping read-only copies under *key* once it is exhausted, unless they grow too large."""
+    chunks = []
+    nbytes = 0
+    for chunk in iterator:
+      if chunks is not None:
+        nbytes += _nbytes(chunk)
+        if nbytes>self.max_entry_bytes: chunks = None
+        else: chunks.append(_readonly_copy(chunk))
+      yield chunk
+    if chunks is not None: self.put(key, chunks)
+
+  def wrap(self, key, iterable):
+    """Return an :class:`IterableMemoryChunks` serving *iterable* from memory once its chunks are resident under *key*."""
+    return IterableMemoryChunks(self, key, iterable)
+
+class IterableMemoryChunks(object):
+  """Iterable returned by :func:`cache` with a :class:`MemoryCache`, reading from memory where possible.
+
+  Iterates over the chunks resident in the memory cache if there are any,
+  and otherwise over the on-disk iterable, keeping the chunks in memory once
+  they have been read completely.  All other attributes, like
+  ``identifier`` and :meth:`~IterableH5Chunks.range`, are those of the
+  on-disk iterable, so it can be used in its place.
+
+  Args:
+      memory_cache (MemoryCache): The memory tier.
+      key (str): Key of the result in *memory_cache*.
+      iterable: On-disk iterable, e.g. :class:`IterableH5Chunks`.
+      reverse (bool): Whether *iterable* is reversed with respect to the
+          resident chunks.
+  """
+  def __init__(self, memory_cache, key, iterable, reverse=False):
+    self.memory_cache = memory_cache
+    self.key = key
+    self.iterable = iterable
+    self.reverse = reverse
+
+  def __getattr__(self, name):
+    if name=="iterable": raise AttributeError(name) # not initialized yet, e.g. while unpickling
+    return getattr(self.iterable, name)
+
+  def _resident(self):
+    chunks = self.memory_cache.get(self.key)
+    if chunks is None or not self.reverse: return chunks
+    flip = lambda c: tuple(x[::-1] for x in c) if type(c)==tuple else c[::-1]
+    return [flip(c) for c in reversed(chunks)]
+
+  def __iter__(self):
+    chunks = self._resident()
+    if chunks is not None: return iter(chunks)
+    if self.reverse: return iter(self.iterable)
+    return self.memory_cache.collect(self.key, self.iterable)
+
+  def __len__(self):
+    chunks = self.memory_cache.get(self.key)
+    return len(chunks) if chunks is not None else len(self.iterable)
+
+  def __getitem__(self, i):
+    chunks = self._resident()
+    return chunks[i] if chunks is not None else self.iterable[i]
+
+  def __reversed__(self):
+    return IterableMemoryChunks(self.memory_cache, self.key, reversed(self.iterable), not self.reverse)
+
+# --- tests ---
+
+def _fill(cachedir, identifier, version="0", rows=1000, seconds=0., **kwargs):
+  import numpy as np
+  from ..functions import cache
+  def source():
+    time.sleep(seconds)
+    for i in range(4): yield np.full((rows, 4), i, np.float64)
+  return cache(source(), (identifier, version), cachedir=cachedir, verbose=False, **kwargs)
+
+def test_entries():
+  """Entries report their identifier, version, size and computation time."""
+  import tempfile
+  with tempfile.TemporaryDirectory() as d:
+    _fill(d, "a.b", "1.0", seconds=0.05)
+    _fill(d, "c", backend="directory")
+    open(os.path.join(d, "unrelated.txt"), "w").close()
+
+    manager = CacheManager(d)
+    entries = {e.identifier: e for e in manager.entries()}
+    assert sorted(entries)==["a.b", "c"]
+    assert entries["a.b"].version=="1.0" and entries["a.b"].computation_time>=0.05
+    assert entries["c"].backend is cache_backends["directory"] and entries["c"].finished
+    assert manager.size()==sum(e.size for e in entries.values())>0
+
+def test_superseded():
+  """Older versions of an identifier are removed when a new version is computed."""
+  import tempfile
+  with tempfile.TemporaryDirectory() as d:
+    manager = CacheManager(d)
+    _fill(d, "a", "1", cache_manager=manager)
+    _fill(d, "b", "1", cache_manager=manager)
+    past = time.time()-10
+    for e in manager.entries(): os.utime(e.path, (past, past))
+    _fill(d, "a", "2", cache_manager=manager)
+    assert sorted((e.identifier, e.version) for e in manager.entries())==[("a", "2"), ("b", "1")]
+
+def test_budget():
+  """Over budget, old and cheap entries are evicted first, and the returned entry is kept."""
+  import tempfile
+  with tempfile.TemporaryDirectory() as d:
+    for name in ["old_cheap", "old_expensive", "new_cheap"]:
+      _fill(d, name, rows=20000, complevel=0)
+    manager = CacheManager(d, cost_weight=1.0)
+
+    # pretend that old_expensive took an hour to compute
+    expensive = [e for e in manager.entries() if e.identifier=="old_expensive"][0]
+    cache_backends["h5"].finish(expensive.path, dict(computation_time=3600.))
+    size = max(e.size for e in manager.entries())
+
+    now = time.time()
+    for e in manager.entries():
+      t = now-1000 if e.identifier.startswith("old") else now-10
+      os.utime(e.path, (t, t))
+
+    assert [e.identifier for e in manager.prune(max_bytes=3*size, dry_run=True)]==[]
+    assert [e.identifier for e in manager.prune(max_bytes=2*size, dry_run=True)]==["old_cheap"]
+    assert [e.identifier for e in manager.prune(max_bytes=size)]==["old_cheap", "new_cheap"]
+    assert [e.identifier for e in manager.entries()]==["old_expensive"]
+
+    manager.max_bytes = size
+    _fill(d, "newest", rows=20000, complevel=0, cache_manager=manager)
+    assert [e.identifier for e in manager.entries()]==["newest"]
+
+def test_stale_leftovers():
+  """Partial results of crashed computations count toward the budget and are pruned first, unless still running."""
+  import tempfile
+  import numpy as np
+  from ..functions import cache, _FileLock
+  def crashing():
+    for i in range(4): yield np.full((20000, 4), i, np.float64)
+    raise KeyboardInterrupt()
+  with tempfile.TemporaryDirectory() as d:
+    _fill(d, "done", rows=20000, complevel=0)
+    try: cache(crashing(), "crashed", cachedir=d, verbose=False, checkpoint_interval=0, complevel=0)
+    except KeyboardInterrupt: pass
+    open(os.path.join(d, "gone.0.0.h5.lock"), "w").close()
+
+    manager = CacheManager(d)
+    stale = [e for e in manager.entries() if e.stale]
+    assert sorted((e.identifier, e.backend is None) for e in stale)==[("crashed", False), ("gone", True)]
+    partial = [e for e in stale if e.backend is not None][0]
+    assert partial.path.endswith(".partial") and partial.size>os.path.getsize(partial.path)>0
+    assert manager.size()>2*20000*4*8
+
+    # a running computation holds the lock
+    lock = _FileLock(partial.path[:-len(".partial")]+".lock")
+    lock.acquire()
+    assert [e.identifier for e in manager.entries() if e.stale]==["gone"]
+    assert [e.identifier for e in manager.prune(max_bytes=0, dry_run=True)]==["gone", "done"]
+    lock.release()
+
+    size = manager.size()
+    assert [e.identifier for e in manager.prune(max_bytes=size-1)]==["gone", "crashed"]
+    assert [e.identifier for e in manager.entries()]==["done"]
+    assert sorted(os.listdir(d))==[os.path.basename(manager.entries()[0].path)+s for s in ("", ".lock")]
+
+def test_hit_updates_last_use():
+  """A cache hit counts as a use."""
+  import tempfile
+  with tempfile.TemporaryDirectory() as d:
+    path = _fill(d, "a").filename
+    os.utime(path, (0, 0))
+    _fill(d, "a")
+    assert time.time()-CacheManager(d).entries()[0].last_used<60
+
+def test_memory_cache():
+  """Small results are served from memory after their computation, transparently."""
+  import tempfile
+  import numpy as np
+  memory = MemoryCache(10*1024**2)
+  with tempfile.TemporaryDirectory() as d:
+    r = _fill(d, "small", memory_cache=memory)
+    disk = _fill(d, "small")
+    assert type(r)==IterableMemoryChunks and r.identifier==disk.identifier
+    assert r.key in memory and memory.nbytes==4*1000*4*8
+
+    chunks = list(r)
+    assert not any(c.flags.writeable for c in chunks) # resident, read-only
+    assert all((a==b).all() for a, b in zip(chunks, disk))
+    assert len(r)==4 and (r[2]==disk[2]).all()
+
+    rv = reversed(r)
+    assert rv.identifier==reversed(disk).identifier
+    assert all((a==b).all() for a, b in zip(rv, reversed(disk)))
+    assert (np.concatenate(list(r.range(500, 1500)))==np.concatenate(list(disk.range(500, 1500)))).all()
+
+    # a new process would read from disk first, and keep the chunks afterwards
+    memory.clear()
+    r = _fill(d, "small", memory_cache=memory)
+    assert r.key not in memory
+    assert sum(c.sum() for c in r)==sum(c.sum() for c in disk)
+    assert r.key in memory
+
+def test_memory_cache_eviction():
+  """Results larger than max_entry_bytes stay on disk, and the least recently used results are dropped."""
+  import tempfile
+  memory = MemoryCache(3*128000, max_entry_bytes=2*128000)
+  with tempfile.TemporaryDirectory() as d:
+    big = _fill(d, "big", rows=8000, memory_cache=memory) # 4 chunks of 256 kB
+    assert big.key not in memory and len(list(big))==4 and big.key not in memory
+
+    a = _fill(d, "a", rows=2000, memory_cache=memory) # 4 chunks of 64 kB
+    b = _fill(d, "b", rows=2000, memory_cache=memory)
+    assert a.key not in memory and b.key in memory
+    memory.put("x", [])
+    assert memory.get("x")==[] and memory.nbytes==256000
+
+if __name__ == "__main__":
+  tests = [test_entries, test_superseded, test_budget, test_stale_leftovers, test_hit_updates_last_use, test_memory_cache, test_memory_cache_eviction]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
@@ -0,0 +1,474 @@
+"""
+directory chunk store: one compressed file per chunk plus a JSON manifest
+"""
+
+import os
+import json
+import shutil
+import collections
+import concurrent.futures
+
+import numpy as np
+
+from ..functions import (
+  multihash, _ordered_map, _readinto, _writev, _stream_cparams, _compress_arrays, _decompress_into,
+  _IndexedChunks, CacheBackend, cache_backends,
+)
+
+__all__ = ['yielding_chunks_to_directory', 'chunks_to_directory', 'IterableDirectoryChunks', 'DirectoryCacheBackend']
+
+_MANIFEST = "manifest.json"
+_FORMAT = "chunkiter-directory"
+
+def _chunk_filename(path, i):
+  return os.path.join(path, "{:08d}.chunk".format(i))
+
+def _write_manifest(path, manifest):
+  # replace the manifest atomically, so that readers never see a partial one
+  tmp = os.path.join(path, _MANIFEST+".tmp")
+  with open(tmp, "w") as f: json.dump(manifest, f)
+  os.replace(tmp, os.path.join(path, _MANIFEST))
+
+def _read_manifest(path):
+  try:
+    with open(os.path.join(path, _MANIFEST)) as f: manifest = json.load(f)
+  except FileNotFoundError:
+    raise IOError("{} is not a chunkiter directory store".format(path)) from None
+  if manifest.get("format")!=_FORMAT: raise IOError("{} is not a chunkiter directory store".format(path))
+  if manifest["version"]!=1: raise IOError("unsupported chunkiter directory store version {}".format(manifest["version"]))
+  return manifest
+
+def _write_chunk(filename, rows, data, cparams):
+  # write to a temporary name first, so that a chunk file is either complete or missing
+  buffers = [rows] + (_compress_arrays(data, cparams) if cparams is not None else [np.ascontiguousarray(d) for d in data])
+  with open(filename+".tmp", "wb") as f: _writev(f, buffers)
+  os.replace(filename+".tmp", filename)
+
+def yielding_chunks_to_directory(iterator, path, verbose=False, preprocessor=None, skip=1, compression="lz4", complevel=5, shuffle=True, threads=0, append=False, checkpoint=None):
+  """Write chunks to a directory with one file per chunk, yielding data for further processing.
+
+  The directory gets a ``manifest.json`` declaring the dtype and trailing
+  shape of each ndarray, and one file ``00000000.chunk``,
+  ``00000001.chunk``, ... per chunk, holding shape[0] of each ndarray
+  (64-bit integers), then with *compression* the compressed size of each
+  ndarray followed by its data as a sequence of Blosc2 chunks, otherwise
+  the raw data of each ndarray (C order).  Chunk files are written under a
+  temporary name and renamed when complete.  After the last chunk, the
+  manifest lists shape[0] of all ndarrays of all chunks.
+
+  Since the chunk files are independent, they can be written and read
+  concurrently, and a store that is still being written (or whose writer
+  died) can be read up to its first missing chunk.
+
+  Args:
+      iterator: Iterator yielding ``np.ndarray`` chunks (or tuples thereof).
+      path (str): Output directory, created if needed.
+      verbose (bool): Print progress.
+      preprocessor (callable, optional): Transform applied before writing
+          (yielded data is still original).
+      skip (int): Only write every ``skip``-th chunk (1 = every chunk).
+      compression (str, None): Blosc2 codec, e.g. ``"lz4"``, ``"zstd"`` or
+          ``"blosclz"``; ``None`` stores the raw data.
+      complevel (int): Compression level.
+      shuffle (bool or str): Byte shuffle before compression (``True``),
+          bit shuffle (``"bit"``) or none (``False``).
+      threads (int): If > 0, compress and write the chunk files on a pool of
+          *threads* threads while the next chunks are pulled.  Written
+          chunks must not be modified in place after they have been yielded.
+      append (bool): Continue an existing store after its last chunk instead
+          of raising ``IOError``.  The dtypes and trailing shapes must match,
+          and the compression of the store is kept.
+      checkpoint (callable, None): Called after each written chunk; if it
+          returns a callable, that is called once the chunk files so far
+          are written, like in :func:`yielding_chunks_to_h5`.
+
+  Raises:
+      IOError: If *path* already holds a chunk store and *append* is not set.
+      ValueError: If a chunk does not match the dtypes and trailing shapes of
+          the first chunk.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Original chunks, unchanged.
+
+  Example:
+      >>> source = chunkiter.IterableH5Chunks("input.h5", "data")
+      >>> chunkiter.chunks_to_directory(source, "output.chunks", threads=4)
+      >>> array = chunkiter.IterableDirectoryChunks("output.chunks", threads=4)
+  """
+  os.makedirs(path, exist_ok=True)
+  manifest = None
+  chunk_rows = []
+
+  if os.path.exists(os.path.join(path, _MANIFEST)):
+    if not append: raise IOError("{} already contains a chunk store".format(path))
+    store = IterableDirectoryChunks(path)
+    chunk_rows = store._rows.tolist()
+    manifest = _read_manifest(path)
+    manifest.pop("chunks", None) # unfinished again
+    _write_manifest(path, manifest)
+    header = list(zip(store.dtypes, store.shapes))
+    compression = manifest["compression"]
+    cparams = None if compression is None else [_stream_cparams(dtype, compression, complevel, shuffle) for dtype in store.dtypes]
+  pending = collections.deque() # chunk files being written, in order
+  writer = concurrent.futures.ThreadPoolExecutor(threads) if threads>0 else None
+
+  try:
+    for data_i,data in enumerate(iterator):
+      data_original = data
+      if preprocessor is not None: data = preprocessor(data)
+
+      istuple = type(data)==tuple
+      if not istuple: data = (data,)
+
+      if data_i%skip==0:
+        if verbose: print("* ...writing chunk {}".format(data_i), end="\r")
+
+        if manifest is None:
+          manifest = dict(
+            format = _FORMAT,
+            version = 1,
+            tuple = istuple,
+            arrays = [dict(dtype=d.dtype.str, shape=list(d.shape[1:])) for d in data],
+            compression = compression,
+            attrs = {},
+          )
+          _write_manifest(path, manifest)
+          header = [(d.dtype, d.shape[1:]) for d in data]
+          cparams = None if compression is None else [_stream_cparams(d.dtype, compression, complevel, shuffle) for d in data]
+        if [(d.dtype, d.shape[1:]) for d in data]!=header:
+          raise ValueError("chunk {} does not match the dtypes and trailing shapes of the first chunk".format(data_i))
+
+        rows = np.array([d.shape[0] for d in data], np.int64)
+        filename = _chunk_filename(path, len(chunk_rows))
+        chunk_rows.append(rows.tolist())
+
+        if writer is None:
+          _write_chunk(filename, rows, data, cparams)
+        else:
+          pending.append(writer.submit(_write_chunk, filename, rows, data, cparams))
+          while len(pending)>2*threads: pending.popleft().result()
+
+        stored = checkpoint() if checkpoint is not None else None
+        if stored is not None:
+          while len(pending): pending.popleft().result()
+          stored()
+
+      yield data_original
+
+    while len(pending): pending.popleft().result()
+    if verbose: print()
+
+  finally:
+    if writer is not None: writer.shutdown(cancel_futures=True)
+
+  if manifest is None: manifest = dict(format=_FORMAT, version=1, tuple=False, arrays=[], compression=compression, attrs={})
+  manifest["chunks"] = chunk_rows
+  _write_manifest(path, manifest)
+
+def chunks_to_directory(*args, **kwargs):
+  """Consume an iterator and write all chunks to a directory chunk store (no yielding).
+
+  Convenience wrapper around :func:`yielding_chunks_to_directory`.
+  Same parameters.
+  """
+  for i in yielding_chunks_to_directory(*args, **kwargs): pass
+
+class IterableDirectoryChunks(_IndexedChunks):
+  """Iterable reading a directory chunk store written by :func:`yielding_chunks_to_directory`.
+
+  A store that is still being written is read up to its first missing
+  chunk, as it was when the iterable was created; ``complete`` tells
+  whether the writer has finished.
+
+  Each instance has an ``identifier`` attribute for use with :func:`cache`.
+
+  Args:
+      path (str): Directory of the store.
+      reverse (bool): If ``True``, iterate in reverse order.
+      start (int): First sample (along axis 0) to read.
+      stop (int, None): End of the samples to read (exclusive), ``None``
+          reads until the end.  The first and last chunk may be shorter.
+      threads (int): If > 0, read and decompress chunk files on a pool of
+          *threads* threads, yielding them in order.
+
+  Like :class:`IterableH5Chunks`, the iterable supports ``len()``,
+  ``chunks[i]``, :meth:`range` and ``reversed()``.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Data chunks.
+
+  Example:
+      >>> array = chunkiter.IterableDirectoryChunks("output.chunks")
+      >>> print(array.complete, len(array))
+      >>> tail = chunkiter.concatenate(array.range(-1000))
+  """
+  def __init__(self, path, reverse=False, start=0, stop=None, threads=0):
+    self.path = path
+    if start==0 and stop is None:
+      self.identifier = multihash(path, str(reverse))
+    else:
+      self.identifier = multihash(path, str(reverse), str(start), str(stop))
+    self.reverse = reverse
+    self.start = start
+    self.stop = stop
+    self.threads = threads
+
+    manifest = _read_manifest(path)
+    self.attrs = manifest["attrs"]
+    self.complete = "chunks" in manifest
+    self.dtypes = [np.dtype(a["dtype"]) for a in manifest["arrays"]]
+    self.shapes = [tuple(a["shape"]) for a in manifest["arrays"]]
+    self._compressed = manifest["compression"] is not None
+    self._tuple = manifest["tuple"]
+
+    if self.complete:
+      rows = manifest["chunks"]
+    else:
+      # scan the chunk files written so far
+      rows = []
+      while True:
+        try:
+          with open(_chunk_filename(path, len(rows)), "rb") as f:
+            r = np.empty(len(self.dtypes), np.int64)
+            _readinto(f, r)
+        except FileNotFoundError:
+          break
+        rows.append(r.tolist())
+
+    self._set_rows(np.array(rows, np.int64).reshape(len(rows), len(self.dtypes)))
+
+  def _reader(self):
+    def read(frame):
+      with open(_chunk_filename(self.path, frame), "rb") as f:
+        rows = np.empty(len(self.dtypes), np.int64)
+        _readinto(f, rows)
+        if self._compressed:
+          sizes = np.empty(len(self.dtypes), np.int64)
+          _readinto(f, sizes)
+
+        arrays = []
+        for k, (n, dtype, shape) in enumerate(zip(rows.tolist(), self.dtypes, self.shapes)):
+          array = np.empty((n,)+shape, dtype)
+          if self._compressed:
+            compressed = bytearray(int(sizes[k]))
+            _readinto(f, compressed)
+            _decompress_into(compressed, array)
+          else:
+            _readinto(f, array.reshape(-1).view(np.uint8))
+          arrays.append(array)
+      return arrays
+
+    return read
+
+  def _map(self, read, frames):
+    if self.threads>0: return _ordered_map(read, frames, self.threads)
+    return map(read, frames)
+
+  def _copy(self, **kwargs):
+    options = dict(reverse=self.reverse, start=self.start, stop=self.stop, threads=self.threads)
+    options.update(kwargs)
+    return IterableDirectoryChunks(self.path, **options)
+
+class DirectoryCacheBackend(CacheBackend):
+  """:class:`CacheBackend` storing each result in a directory chunk store, see :func:`yielding_chunks_to_directory`.
+
+  Registered as ``"directory"`` in ``cache_backends``.
+
+  Args:
+      threads (int): Passed on to :class:`IterableDirectoryChunks` for
+          reading.
+  """
+  suffix = ".chunks"
+
+  def __init__(self, threads=0):
+    self.threads = threads
+
+  def finished(self, path):
+    try: return bool(_read_manifest(path)["attrs"].get("finished", False))
+    except IOError: return False
+
+  def write(self, iterator, path, verbose=False, append=False, **kwargs):
+    chunks_to_directory(iterator, path, verbose=verbose, append=append, **kwargs)
+
+  def rows(self, path):
+    return IterableDirectoryChunks(path)._rows.sum(axis=0).tolist()
+
+  def truncate(self, path, rows):
+    store = IterableDirectoryChunks(path)
+    ends = np.cumsum(store._rows, axis=0)
+    n = int((ends<=rows).all(axis=1).sum()) if len(ends) else 0
+    if list(ends[n-1] if n else np.zeros(len(rows), np.int64))!=list(rows):
+      raise ValueError("{} rows do not end at a chunk boundary of {}".format(rows, path))
+    i = n
+    while os.path.exists(_chunk_filename(path, i)):
+      os.remove(_chunk_filename(path, i))
+      i += 1
+
+  def finish(self, path, attrs):
+    manifest = _read_manifest(path)
+    manifest["attrs"].update(attrs, finished=True)
+    _write_manifest(path, manifest)
+
+  def attrs(self, path):
+    try: return _read_manifest(path)["attrs"]
+    except IOError: return {}
+
+  def open(self, path):
+    return IterableDirectoryChunks(path, threads=self.threads)
+
+  def remove(self, path):
+    if os.path.exists(path): shutil.rmtree(path)
+
+cache_backends["directory"] = DirectoryCacheBackend()
+
+# --- tests ---
+
+def _chunks(n=7):
+  import numpy as np
+  rng = np.random.default_rng(0)
+  return [(rng.standard_normal((k, 3)), np.arange(k, dtype=np.int16)) for k in [5, 0, 8, 8, 8, 1, 3][:n]]
+
+def test_roundtrip():
+  """Single arrays and tuples, with and without compression and threads."""
+  import tempfile
+  import numpy as np
+  chunks = _chunks()
+  with tempfile.TemporaryDirectory() as d:
+    for i, (compression, threads) in enumerate([("lz4", 0), ("zstd", 2), (None, 0), (None, 3)]):
+      path = os.path.join(d, str(i))
+      out = list(yielding_chunks_to_directory(iter(chunks), path, compression=compression, threads=threads))
+      assert all(a is b for a, b in zip(out, chunks))
+
+      for t in [0, 2]:
+        got = list(IterableDirectoryChunks(path, threads=t))
+        assert len(got)==len(chunks)
+        for a, b in zip(got, chunks):
+          assert a[0].dtype==b[0].dtype and (a[0]==b[0]).all() and (a[1]==b[1]).all()
+
+      chunks_to_directory((c[0] for c in chunks), path+"single", compression=compression, threads=threads)
+      got = list(IterableDirectoryChunks(path+"single"))
+      assert all(type(a)==np.ndarray and (a==b[0]).all() for a, b in zip(got, chunks))
+
+def test_reverse_range():
+  """reversed(), len(), indexing and sample ranges."""
+  import tempfile
+  import numpy as np
+  chunks = _chunks()
+  full = np.concatenate([c[0] for c in chunks])
+  with tempfile.TemporaryDirectory() as d:
+    chunks_to_directory(iter(chunks), d)
+    array = IterableDirectoryChunks(d)
+    assert len(array)==len(chunks) and array.complete
+
+    rv = reversed(array)
+    assert (np.concatenate([c[0] for c in rv])==full[::-1]).all()
+    assert rv.identifier!=array.identifier
+    assert (array[-1][0]==chunks[-1][0]).all() and (rv[0][0]==chunks[-1][0][::-1]).all()
+
+    for start, stop in [(3, 20), (-4, None), (5, 13), (6, 6)]:
+      r = array.range(start, stop)
+      got = np.concatenate([c[0] for c in r]) if len(r) else full[:0]
+      assert (got==full[start:stop]).all() and got.shape==full[start:stop].shape
+    assert (np.concatenate([c[1] for c in rv.range(2, 10)])==np.concatenate([c[1] for c in chunks])[::-1][2:10]).all()
+
+def test_partial():
+  """A store that is still being written can be read up to the chunks written so far."""
+  import tempfile
+  import numpy as np
+  chunks = _chunks()
+  with tempfile.TemporaryDirectory() as d:
+    writer = yielding_chunks_to_directory(iter(chunks), d)
+    for i in range(3): next(writer)
+
+    array = IterableDirectoryChunks(d)
+    assert not array.complete and len(array)==3
+    assert all((a[0]==b[0]).all() for a, b in zip(array, chunks[:3]))
+
+    for i in writer: pass
+    assert IterableDirectoryChunks(d).complete and len(IterableDirectoryChunks(d))==len(chunks)
+
+def test_errors():
+  """Writing into an existing store and mismatching chunks raise."""
+  import tempfile
+  import numpy as np
+  with tempfile.TemporaryDirectory() as d:
+    chunks_to_directory([np.zeros(3)], d)
+    try: chunks_to_directory([np.zeros(3)], d)
+    except IOError: pass
+    else: assert False
+
+    try: chunks_to_directory([np.zeros(3), np.zeros((3, 2))], os.path.join(d, "x"))
+    except ValueError: pass
+    else: assert False
+
+    try: IterableDirectoryChunks(os.path.join(d, "y"))
+    except IOError: pass
+    else: assert False
+
+def test_cache_backend():
+  """cache() with backend="directory" computes once and returns a directory store."""
+  import tempfile
+  import numpy as np
+  from ..functions import cache
+  calls = []
+  def source():
+    calls.append(1)
+    for c in _chunks(): yield c[0]
+
+  with tempfile.TemporaryDirectory() as d:
+    r = cache(source(), "dirtest", cachedir=d, verbose=False, backend="directory", compression="zstd")
+    assert type(r)==IterableDirectoryChunks and r.attrs["finished"]
+    r2 = cache(source(), "dirtest", cachedir=d, verbose=False, backend="directory")
+    assert len(calls)==1 and r2.identifier==r.identifier
+    assert all((a==b).all() for a, b in zip(r2, r))
+    assert os.path.isdir(os.path.join(d, "dirtest.0.0.chunks"))
+
+def test_append():
+  """Appending continues an existing store after its last chunk."""
+  import tempfile
+  import numpy as np
+  chunks = _chunks()
+  with tempfile.TemporaryDirectory() as d:
+    chunks_to_directory(iter(chunks[:3]), d, compression="zstd")
+    chunks_to_directory(iter(chunks[3:]), d, append=True, compression=None)
+    array = IterableDirectoryChunks(d)
+    assert array.complete and len(array)==len(chunks)
+    assert all((a[0]==b[0]).all() for a, b in zip(array, chunks))
+
+def test_resume():
+  """An interrupted cache() computation continues after its last checkpoint."""
+  import tempfile
+  import numpy as np
+  from ..functions import cache, apply
+  calls = []
+  def running_sum(chunk, carry):
+    calls.append(1)
+    carry = carry + chunk.sum(axis=0)
+    return chunk + carry, carry
+  running_sum.has_carry = True
+  running_sum.initial_carry = 0.
+  def source(fail_at=None):
+    for i, c in enumerate(_chunks()):
+      if i==fail_at: raise KeyboardInterrupt()
+      yield c[0]
+
+  expected = np.concatenate(list(apply(running_sum, source())))
+  calls.clear()
+  with tempfile.TemporaryDirectory() as d:
+    try: cache(apply(running_sum, source(5)), "resume", cachedir=d, verbose=False, backend="directory", checkpoint_interval=0)
+    except KeyboardInterrupt: pass
+    assert len(calls)==5 and not DirectoryCacheBackend().finished(os.path.join(d, "resume.0.0.chunks"))
+
+    r = cache(apply(running_sum, source()), "resume", cachedir=d, verbose=False, backend="directory", checkpoint_interval=0)
+    assert len(calls)==len(_chunks()) # chunks before the checkpoint are not computed again
+    assert (np.concatenate(list(r))==expected).all()
+    assert sorted(os.listdir(d))==["resume.0.0.chunks", "resume.0.0.chunks.lock"]
+
+if __name__ == "__main__":
+  tests = [test_roundtrip, test_reverse_range, test_partial, test_errors, test_cache_backend, test_append, test_resume]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
@@ -0,0 +1,544 @@
+"""
+fingerprints of computations (code, captured values, arrays, upstream identifiers) and of chunk stream contents for cache identifiers
+"""
+
+import sys
+import types
+import hashlib
+import concurrent.futures
+
+import numpy as np
+
+try: import xxhash # several times faster than SHA-256 for large arrays
+except ImportError: xxhash = None
+
+try: import blake3
+except ImportError: blake3 = None
+
+__all__ = ['fingerprint', 'ContentHash', 'ContentHashIterator']
+
+_BLOCK = 16*1024**2 # bytes per update when hashing non-contiguous arrays
+
+def _array_digest(a):
+  # digest of the data of an array, streamed through the hash without copying contiguous data
+  h = xxhash.xxh3_128() if xxhash is not None else hashlib.sha256()
+  if a.flags.c_contiguous:
+    h.update(a.reshape(-1).view(np.uint8))
+  else:
+    rows = max(1, _BLOCK//max(1, a[:1].nbytes))
+    for i in range(0, a.shape[0], rows): h.update(np.ascontiguousarray(a[i:i+rows]).reshape(-1).view(np.uint8))
+  return (b'xxh3' if xxhash is not None else b'sha256') + h.digest()
+
+def _cell_contents(cell, function):
+  try: value = cell.cell_contents
+  except ValueError: return None # empty cell
+  return None if value is function else value # recursive functions
+
+class _Fingerprint(object):
+  # feeds a type-tagged serialization of objects into a SHA-256 hash, following code, closures,
+  # referenced globals, generator frames and the reduce protocol
+  def __init__(self):
+    self.hash = hashlib.sha256()
+    self.active = set() # ids of the objects being fingerprinted, to break cycles
+
+  def tag(self, *parts):
+    for p in parts:
+      p = p if type(p)==bytes else str(p).encode("utf-8")
+      self.hash.update(len(p).to_bytes(8, "little"))
+      self.hash.update(p)
+
+  def update(self, o):
+    t = type(o)
+
+    if o is None or t in (bool, int, float, complex, str, bytes):
+      return self.tag(t.__name__, repr(o))
+    if isinstance(o, np.ma.MaskedArray):
+      return self.tag("masked", o.dtype.str, o.shape, _array_digest(np.asarray(o)), _array_digest(np.ma.getmaskarray(o)))
+    if isinstance(o, np.ndarray): # including subclasses like np.memmap
+      return self.tag("ndarray", o.dtype.str, o.shape, _array_digest(np.asarray(o)))
+    if isinstance(o, np.generic):
+      return self.tag("scalar", o.dtype.str, o.tobytes())
+    if isinstance(o, (types.ModuleType, type, types.BuiltinFunctionType, np.ufunc)):
+      module = getattr(o, "__module__", None) or getattr(o, "__name__", "")
+      version = getattr(sys.modules.get(module.split(".")[0]), "__version__", "")
+      return self.tag(t.__name__, module, getattr(o, "__qualname__", getattr(o, "__name__", "")), version)
+
+    identifier = getattr(o, "identifier", None)
+    if type(identifier)==str: return self.tag("identifier", identifier)
+
+    if id(o) in self.active: return self.tag("cycle")
+    self.active.add(id(o))
+    try: self._update(o, t)
+    finally: self.active.discard(id(o))
+
+  def _update(self, o, t):
+    if t in (list, tuple, frozenset, set):
+      items = list(o)
+      if t in (frozenset, set): items = sorted(items, key=lambda i: fingerprint(i))
+      self.tag(t.__name__, len(items))
+      for i in items: self.update(i)
+    elif t is dict:
+      self.tag("dict", len(o))
+      for k, v in o.items():
+        self.update(k)
+        self.update(v)
+    elif t is types.CodeType:
+      self.code(o)
+    elif t is types.FunctionType:
+      self.tag("function", o.__module__, o.__qualname__)
+      self.code(o.__code__)
+      self.update(o.__defaults__)
+      self.update(o.__kwdefaults__)
+      self.update([_cell_contents(c, o) for c in (o.__closure__ or ())])
+      self.update(o.__dict__) # e.g. has_carry and initial_carry of bodyfuns
+      self.globals(o.__code__, o.__globals__)
+    elif t is types.GeneratorType:
+      self.tag("generator", o.gi_code.co_qualname if hasattr(o.gi_code, "co_qualname") else o.gi_code.co_name)
+      self.code(o.gi_code)
+      if o.gi_frame is not None:
+        self.update(o.gi_frame.f_locals) # arguments, captured values and the input of generator expressions
+        self.globals(o.gi_code, o.gi_frame.f_globals)
+    else:
+      try: reduced = o.__reduce_ex__(4)
+      except Exception: raise TypeError("cannot fingerprint {} objects".format(t.__qualname__)) from None
+      if type(reduced)==str: return self.tag("global", t.__module__, reduced)
+      self.tag("object", t.__module__, t.__qualname__)
+      self.update(list(reduced[1:]))
+
+  def code(self, code):
+    self.tag("code", code.co_code, code.co_names, code.co_varnames, code.co_freevars)
+    for c in code.co_consts:
+      if type(c)==types.CodeType: self.code(c)
+      else: self.update(c)
+
+  def globals(self, code, namespace):
+    # values of the global names referenced by the code, including nested functions
+    names = set()
+    def collect(code):
+      names.update(code.co_names)
+      for c in code.co_consts:
+        if type(c)==types.CodeType: collect(c)
+    collect(code)
+
+    for name in sorted(names):
+      if name in namespace:
+        self.tag("global", name)
+        self.update(namespace[name])
+
+def fingerprint(*objects):
+  """Return a hash identifying a computation by its code and inputs.
+
+  Used by :func:`cache` with ``auto=True``.  Objects are hashed by value,
+  following:
+
+  - objects with a string ``identifier`` attribute (e.g.
+    :class:`IterableH5Chunks` or the result of another :func:`cache`) by
+    that identifier,
+  - ``np.ndarray`` by dtype, shape and a hash of the data (xxHash if the
+    ``xxhash`` package is installed, otherwise SHA-256, which most CPUs
+    accelerate in hardware); subclasses like ``np.memmap`` like the plain
+    array of their data, masked arrays with their mask,
+  - functions by bytecode, constants, defaults, closure values, attributes
+    and the values of the global names they refer to,
+  - generators (and generator expressions) by their code and the local
+    variables of their frame, i.e. arguments, captured values and the input
+    iterator,
+  - modules, classes and builtins by name and package version,
+  - containers by their items, and other objects through the pickle
+    protocol (``__reduce_ex__``), e.g. the iterators returned by
+    :func:`apply`.
+
+  Arrays are hashed with a streaming hash without copying; contiguous
+  arrays are hashed in a single pass over their memory.
+
+  Args:
+      *objects: Objects to fingerprint.
+
+  Raises:
+      TypeError: If an object can be neither introspected nor pickled.
+
+  Returns:
+      str: Hex digest.
+
+  Example:
+      >>> window = np.hanning(1024)
+      >>> spectra = (np.fft.rfft(chunk*window) for chunk in source)
+      >>> chunkiter.fingerprint(spectra)  # changes with the code, window and source.identifier
+      '...'
+  """
+  f = _Fingerprint()
+  for o in objects: f.update(o)
+  return f.hash.hexdigest()
+
+def _block_hash():
+  # name and constructor of the hash for the blocks of a content hash; SHA-256 rather than
+  # BLAKE2 as fallback, as most CPUs have instructions for it and it is faster there
+  if xxhash is not None: return "xxh3_128", xxhash.xxh3_128
+  if blake3 is not None: return "blake3", blake3.blake3
+  return "sha256", hashlib.sha256
+
+class _Stream(object):
+  # content hash state of one entry of the chunks: the digests of the complete blocks are
+  # fed in order into an outer hash, the bytes of the incomplete last block are kept
+  def __init__(self, a):
+    self.dtype = a.dtype
+    self.shape = a.shape[1:]
+    self.rows = 0
+    self.outer = hashlib.sha256()
+    self.pending = bytearray()
+
+  def blocks(self, a, block_size):
+    # split the bytes of a into the views to be hashed as complete blocks, without copying
+    # except for blocks straddling chunk boundaries
+    if a.dtype!=self.dtype or a.shape[1:]!=self.shape:
+      raise ValueError("chunks do not match the dtype and trailing shape of the first chunk")
+    if a.dtype.hasobject: raise ValueError("cannot hash object arrays")
+    self.rows += a.shape[0]
+    data = memoryview(np.ascontiguousarray(a).reshape(-1).view(np.uint8))
+
+    views = []
+    if len(self.pending):
+      n = min(len(data), block_size-len(self.pending))
+      self.pending += data[:n]
+      data = data[n:]
+      if len(self.pending)==block_size:
+        views.append(self.pending)
+        self.pending = bytearray()
+    complete = len(data)//block_size*block_size
+    views.extend(data[i:i+block_size] for i in range(0, complete, block_size))
+    self.pending += data[complete:]
+    return views
+
+class ContentHash(object):
+  """Streaming hash of the data of a chunk stream, independent of its chunking.
+
+  The bytes of the data (of each entry, for tuple chunks) are split into
+  blocks of *block_size* bytes regardless of chunk boundaries.  The blocks
+  are hashed with xxHash (XXH3, if the ``xxhash`` package is installed),
+  BLAKE3 (if the ``blake3`` package is installed) or SHA-256, optionally in
+  parallel, and the digests are combined in order with SHA-256, together
+  with dtype and shape.  Hence the same data gives the same hash however it
+  is chunked, for the same block size and block hash.
+
+  Chunks are hashed through the buffer protocol, without copying, if they
+  are C-contiguous; only the bytes of blocks straddling chunk boundaries
+  are copied.  :meth:`update` returns once the chunk is hashed, so it may
+  be modified afterwards.
+
+  Args:
+      block_size (int): Bytes per block.
+      threads (int): If > 0, hash the blocks on a pool of *threads* threads.
+          The block hashes release the GIL.
+
+  Raises:
+      ValueError: In :meth:`update`, if the dtype, trailing shape or tuple
+          length of a chunk differs from the first chunk, or for object
+          arrays.
+
+  Example:
+      >>> h = chunkiter.ContentHash(threads=4)
+      >>> for chunk in chunkiter.IterableH5Chunks("test.h5", "data"):
+      ...     h.update(chunk)
+      >>> h.hexdigest()
+      '...'
+  """
+  def __init__(self, block_size=1024**2, threads=0):
+    self.block_size = block_size
+    self.threads = threads
+    self.name, self.new = _block_hash()
+    self.pool = concurrent.futures.ThreadPoolExecutor(threads) if threads>0 else None
+    self.tuple = None
+    self.streams = None
+
+  def _digest(self, data):
+    h = self.new()
+    h.update(data)
+    return h.digest()
+
+  def update(self, chunk):
+    """Hash the next chunk of the stream."""
+    arrays = chunk if type(chunk)==tuple else (chunk,)
+    arrays = [np.asarray(a) for a in arrays]
+    if self.streams is None:
+      self.tuple = type(chunk)==tuple
+      self.streams = [_Stream(a) for a in arrays]
+    elif self.tuple!=(type(chunk)==tuple) or len(arrays)!=len(self.streams):
+      raise ValueError("chunks do not match the tuple length of the first chunk")
+
+    streams, views = [], []
+    for stream, a in zip(self.streams, arrays):
+      blocks = stream.blocks(a, self.block_size)
+      streams.extend([stream]*len(blocks))
+      views.extend(blocks)
+    digests = self.pool.map(self._digest, views) if self.pool is not None and len(views)>1 else map(self._digest, views)
+    for stream, digest in zip(streams, digests): stream.outer.update(digest)
+
+  def hexdigest(self):
+    """Return the hash of the chunks so far as hex string."""
+    h = hashlib.sha256()
+    for part in (self.name, self.block_size, self.tuple, len(self.streams or ())):
+      h.update(str(part).encode("utf-8")+b";")
+    for stream in self.streams or ():
+      outer = stream.outer.copy()
+      if len(stream.pending): outer.update(self._digest(stream.pending))
+      h.update("{};{};{};".format(stream.dtype.str, stream.shape, stream.rows).encode("utf-8"))
+      h.update(outer.digest())
+    return h.hexdigest()
+
+  def close(self):
+    """Shut down the thread pool."""
+    if self.pool is not None: self.pool.shutdown()
+
+class ContentHashIterator(object):
+  """Pass-through stage that identifies a chunk stream by its data.
+
+  Yields the chunks of *iterator* unchanged while hashing them with
+  :class:`ContentHash`.  The ``identifier`` attribute is the content hash,
+  so that results computed from the data can be cached with
+  :func:`cache` independent of where the data came from, and recomputed
+  when it changes.
+
+  The content hash is known once the stage is exhausted.  If
+  ``identifier`` is accessed before, and *iterator* is iterable several
+  times (like :class:`IterableH5Chunks`), it is computed by an extra pass
+  over *iterator*; in this case the chunks are not hashed again while
+  iterating.
+
+  Args:
+      iterator: Chunk iterator or iterable.
+      block_size (int): Bytes per block, see :class:`ContentHash`.
+      threads (int): If > 0, hash on a pool of *threads* threads.
+
+  Raises:
+      RuntimeError: When accessing ``identifier`` of a one-shot iterator
+          that is not exhausted yet.
+
+  Example:
+      >>> source = chunkiter.ContentHashIterator(chunkiter.IterableH5Chunks("test.h5", "data"), threads=4)
+      >>> spectra = chunkiter.cache((np.fft.fft(c, axis=1) for c in source), "fft", source.identifier)
+  """
+  def __init__(self, iterator, block_size=1024**2, threads=0):
+    self.iterable = iterator
+    self.block_size = block_size
+    self.threads = threads
+    self.iterator = None
+    self.hash = None
+    self._identifier = None
+
+  @property
+  def identifier(self):
+    if self._identifier is None:
+      if self.iterator is not None or iter(self.iterable) is self.iterable:
+        raise RuntimeError("the content hash of a one-shot iterator is known only after iterating through it")
+      h = ContentHash(self.block_size, self.threads)
+      try:
+        for chunk in self.iterable: h.update(chunk)
+        self._identifier = h.hexdigest()
+      finally: h.close()
+    return self._identifier
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self.iterator is None:
+      self.iterator = iter(self.iterable)
+      if self._identifier is None: self.hash = ContentHash(self.block_size, self.threads)
+
+    try: chunk = next(self.iterator)
+    except StopIteration:
+      if self.hash is not None:
+        self._identifier = self.hash.hexdigest()
+        self.hash.close()
+        self.hash = None
+      raise
+
+    if self.hash is not None: self.hash.update(chunk)
+    return chunk
+
+# --- tests ---
+
+def test_generator_expression():
+  """Generator expressions are fingerprinted by code, captured values and input identifier."""
+  import numpy as np
+  from ..functions import IdentifierIterator
+
+  def spectra(source, window):
+    return (np.fft.rfft(chunk*window) for chunk in source)
+
+  window = np.hanning(16)
+  a = IdentifierIterator(iter([]), "a")
+  base = fingerprint(spectra(a, window))
+  assert base==fingerprint(spectra(IdentifierIterator(iter([]), "a"), window.copy()))
+  assert base!=fingerprint(spectra(IdentifierIterator(iter([]), "b"), window))
+  assert base!=fingerprint(spectra(a, np.hamming(16)))
+  assert base!=fingerprint((np.fft.fft(chunk*window) for chunk in a))
+
+def test_functions_and_globals():
+  """Functions change their fingerprint with code, closure values and referenced globals."""
+  import numpy as np
+  global _scale
+  def make(factor):
+    def bodyfun(chunk):
+      return chunk*factor + _scale
+    return bodyfun
+
+  _scale = 1
+  base = fingerprint(make(2))
+  assert base==fingerprint(make(2)) and base!=fingerprint(make(3))
+  _scale = 2
+  assert base!=fingerprint(make(2))
+
+def test_arrays():
+  """Arrays are fingerprinted by content, also when not contiguous."""
+  import numpy as np
+  a = np.arange(3*1024**2, dtype=np.float32).reshape(-1, 3)
+  assert fingerprint(a)==fingerprint(a.copy())
+  assert fingerprint(a[:, 1])==fingerprint(a[:, 1].copy())
+  assert fingerprint(a)!=fingerprint(a.astype(np.float64))
+  assert fingerprint(a)!=fingerprint(a.reshape(3, -1))
+  b = a.copy()
+  b[-1, -1] += 1
+  assert fingerprint(a)!=fingerprint(b)
+
+def test_array_subclasses():
+  """Memory-mapped arrays are fingerprinted like plain arrays, masked arrays also by their mask."""
+  import os
+  import tempfile
+  import numpy as np
+  a = np.arange(1000*50.).reshape(1000, 50)
+  with tempfile.TemporaryDirectory() as d:
+    m = np.memmap(os.path.join(d, "a.bin"), a.dtype, "w+", shape=a.shape)
+    m[:] = a
+    assert fingerprint(m)==fingerprint(a) and fingerprint(m[10:20])==fingerprint(a[10:20])
+    del m
+  masked = np.ma.masked_array(a, a%3==0)
+  assert fingerprint(masked)==fingerprint(np.ma.masked_array(a.copy(), a%3==0))
+  assert fingerprint(masked)!=fingerprint(a)!=fingerprint(np.ma.masked_array(a, a%3==1))
+
+def test_apply():
+  """Iterators returned by apply() are fingerprinted by bodyfun and input."""
+  import numpy as np
+  from ..functions import apply, IdentifierIterator
+  source = lambda name: IdentifierIterator(iter([]), name)
+  assert fingerprint(apply(np.abs, source("a")))==fingerprint(apply(np.abs, source("a")))
+  assert fingerprint(apply(np.abs, source("a")))!=fingerprint(apply(np.abs, source("b")))
+  assert fingerprint(apply(np.abs, source("a")))!=fingerprint(apply(np.sqrt, source("a")))
+
+def test_cache_auto():
+  """cache(auto=True) recomputes exactly when the fingerprint changes."""
+  import os
+  import tempfile
+  import numpy as np
+  from ..functions import cache
+  def compute(offset):
+    for i in range(3): yield np.full(4, i+offset)
+
+  with tempfile.TemporaryDirectory() as d:
+    r1 = cache(compute(1), auto=True, cachedir=d, verbose=False)
+    r2 = cache(compute(1), auto=True, cachedir=d, verbose=False)
+    assert r1.identifier==r2.identifier and len([f for f in os.listdir(d) if f.endswith(".h5")])==1
+    r3 = cache(compute(2), auto=True, cachedir=d, verbose=False)
+    assert r3.identifier!=r1.identifier and len([f for f in os.listdir(d) if f.endswith(".h5")])==2
+    assert [c[0] for c in r3]==[2, 3, 4]
+
+def test_cache_incremental():
+  """cache(incremental=True) recomputes only the chunks whose input changed or is new."""
+  import tempfile
+  import numpy as np
+  from ..functions import apply, cache
+  calls = []
+  def bodyfun(chunk):
+    calls.append(chunk[0])
+    return chunk*2
+
+  with tempfile.TemporaryDirectory() as d:
+    inputs = [np.full(4, i) for i in range(5)]
+    r1 = cache(apply(bodyfun, iter(inputs)), "x", cachedir=d, verbose=False, incremental=True)
+    assert len(calls)==5 and [c[0] for c in r1]==[0, 2, 4, 6, 8]
+    del calls[:]
+    inputs[2] = np.full(4, 10)
+    inputs.append(np.full(6, 5))
+    r2 = cache(apply(bodyfun, iter(inputs)), "x", cachedir=d, verbose=False, incremental=True)
+    assert calls==[10, 5]
+    assert np.array_equal(np.concatenate(list(r2)), np.concatenate(inputs)*2)
+
+    def cumsum(chunk, carry=0):
+      return chunk+carry, carry+chunk.sum()
+    cumsum.has_carry = True
+    try: cache(apply(cumsum, iter(inputs)), "y", cachedir=d, incremental=True)
+    except ValueError: pass
+    else: assert False
+
+def test_cache_incremental_memmap():
+  """Chunks of memory-mapped sources hit the incremental cache, also of the same data read as plain arrays."""
+  import os
+  import tempfile
+  import numpy as np
+  from ..functions import apply, cache, chunks_to_binaryfile, IterableMemmapChunks
+  calls = []
+  def bodyfun(chunk):
+    calls.append(chunk[0, 0])
+    return chunk*2
+
+  with tempfile.TemporaryDirectory() as d:
+    inputs = [np.full((100, 3), float(i)) for i in range(5)]
+    with open(os.path.join(d, "x.bin"), "wb") as f: chunks_to_binaryfile(iter(inputs), f, verbose=False, index=True)
+    cache(apply(bodyfun, IterableMemmapChunks(os.path.join(d, "x.bin"))), "x", cachedir=d, verbose=False, incremental=True)
+    assert len(calls)==5
+    del calls[:]
+    r = cache(apply(bodyfun, IterableMemmapChunks(os.path.join(d, "x.bin"))), "x", cachedir=d, verbose=False, incremental=True)
+    assert calls==[]
+    r = cache(apply(bodyfun, iter(inputs)), "x", cachedir=d, verbose=False, incremental=True)
+    assert calls==[] and np.array_equal(np.concatenate(list(r)), np.concatenate(inputs)*2)
+
+def test_content_hash_chunking():
+  """The content hash does not depend on chunking or threads, but on dtype, shape and data."""
+  import numpy as np
+  data = np.random.default_rng(0).standard_normal((1000, 3))
+  def digest(chunks, **kwargs):
+    h = ContentHash(block_size=1000, **kwargs)
+    for c in chunks: h.update(c)
+    h.close()
+    return h.hexdigest()
+
+  base = digest([data])
+  assert base==digest(np.array_split(data, 7))
+  assert base==digest([data[:1], data[1:1], data[1:]], threads=3)
+  assert base==digest([np.asfortranarray(data[:500]), data[500:]])
+  assert base!=digest([data.astype(np.float32)])
+  assert base!=digest([data.reshape(-1, 1)])
+  changed = data.copy()
+  changed[-1, -1] += 1
+  assert base!=digest([changed])
+  assert digest([(data, data[:, 0])])==digest([(data[:10], data[:10, 0]), (data[10:], data[10:, 0])])
+
+  try: digest([data, data[:, :2]])
+  except ValueError: pass
+  else: assert False
+
+def test_content_hash_iterator():
+  """ContentHashIterator passes chunks through and identifies them by content."""
+  import numpy as np
+  chunks = [np.arange(10)+i for i in range(3)]
+
+  one_shot = ContentHashIterator(iter(chunks))
+  try: one_shot.identifier
+  except RuntimeError: pass
+  else: assert False
+  assert [c[0] for c in one_shot]==[0, 1, 2]
+
+  iterable = ContentHashIterator(chunks)
+  assert iterable.identifier==one_shot.identifier
+  assert fingerprint(iterable)==fingerprint(ContentHashIterator([c.copy() for c in chunks]))
+  assert [c[0] for c in iterable]==[0, 1, 2]
+  assert ContentHashIterator([np.concatenate(chunks)], threads=2).identifier==one_shot.identifier
+
+if __name__ == "__main__":
+  tests = [test_generator_expression, test_functions_and_globals, test_arrays, test_array_subclasses, test_apply, test_cache_auto, test_cache_incremental, test_cache_incremental_memmap, test_content_hash_chunking, test_content_hash_iterator]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
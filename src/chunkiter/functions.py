@@ -1,7 +1,23 @@
-import os, itertools, traceback, hashlib, time, collections, uuid, tempfile
+import os, itertools, traceback, hashlib, time, collections, uuid, tempfile, threading, queue, concurrent.futures, pickle, json, contextlib
 
 import numpy as np
 import tables
+import blosc2
+
+try: import fcntl
+except ImportError: fcntl = None # no locking between processes on Windows
+
+# PyTables is not thread-safe, and prefetching readers and write-behind writers access HDF5
+# files from background threads, so all HDF5 access of chunkiter goes through this lock
+_h5_lock = threading.RLock()
+
+@contextlib.contextmanager
+def _open_h5(filename, mode):
+  # open an HDF5 file, taking _h5_lock only for opening and closing it
+  with _h5_lock: datafile = tables.open_file(filename, mode)
+  try: yield datafile
+  finally:
+    with _h5_lock: datafile.close()
 
 def sliceiter(n, stop):
   """Yield ``slice`` objects dividing ``range(stop)`` into chunks of size *n*.
@@ -37,6 +53,111 @@ def multihash(*args, binary=False):
   if binary: return h.digest()
   else: return h.hexdigest()
 
+def _background_iter(iterable, n):
+  # iterate over *iterable* in a background thread, keeping at most n items queued
+  items = queue.Queue(maxsize=n)
+  stop = threading.Event()
+
+  def worker():
+    try:
+      for item in iterable:
+        items.put((True, item))
+        if stop.is_set(): break
+    except BaseException as e:
+      items.put((False, e))
+    else:
+      items.put((False, None))
+    finally:
+      if hasattr(iterable, "close"): iterable.close()
+
+  thread = threading.Thread(target=worker, daemon=True)
+  thread.start()
+
+  try:
+    while True:
+      ok, item = items.get()
+      if not ok:
+        if item is not None: raise item
+        return
+      yield item
+  finally:
+    # unblock the worker if the consumer stops early
+    stop.set()
+    while thread.is_alive():
+      try: items.get(timeout=0.01)
+      except queue.Empty: pass
+
+def _ordered_map(fun, iterable, threads, inflight=None):
+  # like map(fun, iterable), but evaluated on a thread pool with at most inflight pending items
+  if inflight is None: inflight = 2*threads
+  pending = collections.deque()
+
+  with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+    try:
+      for item in iterable:
+        pending.append(pool.submit(fun, item))
+        if len(pending)>=inflight: yield pending.popleft().result()
+      while len(pending): yield pending.popleft().result()
+    finally:
+      for future in pending: future.cancel()
+
+class _BufferPool(object):
+  # rotating pool of n preallocated buffers: a handed-out buffer is reused once n more buffers
+  # have been taken, or earlier if it is released explicitly
+  def __init__(self, n):
+    self.n = n
+    self.free = []
+    self.used = collections.deque() # handed-out buffers, oldest first
+    self.lock = threading.Lock()
+
+  def take(self, shape, dtype):
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape))*dtype.itemsize
+
+    with self.lock:
+      if len(self.free): buf = self.free.pop()
+      elif len(self.used)>=self.n: buf = self.used.popleft()
+      else: buf = None
+
+      if buf is None or buf.size<nbytes: buf = np.empty(nbytes, np.uint8)
+      self.used.append(buf)
+
+    return buf[:nbytes].view(dtype).reshape(shape)
+
+  def release(self, array):
+    with self.lock:
+      while array is not None:
+        for i,buf in enumerate(self.used):
+          if buf is array:
+            del self.used[i]
+            self.free.append(buf)
+            return True
+        array = getattr(array, "base", None)
+
+    return False
+
+class _ChunkBounds(object):
+  # lazy sequence of (start, stop) pairs of the chunks covering range(start, stop),
+  # with chunk borders at multiples of chunksize
+  def __init__(self, start, stop, chunksize, reverse=False):
+    self.start = start
+    self.stop = max(start, stop)
+    self.chunksize = chunksize
+    self.reverse = reverse
+
+  def __len__(self):
+    if self.stop==self.start: return 0
+    return (self.stop-1)//self.chunksize - self.start//self.chunksize + 1
+
+  def __getitem__(self, i):
+    n = len(self)
+    if i<0: i += n
+    if not 0<=i<n: raise IndexError("chunk index out of range")
+    if self.reverse: i = n-1-i
+
+    chunkstart = (self.start//self.chunksize + i)*self.chunksize
+    return max(chunkstart, self.start), min(chunkstart+self.chunksize, self.stop)
+
 class IterableH5Chunks(object):
   """Iterable that reads an HDF5 dataset chunk-by-chunk without loading all data into memory.
 
@@ -53,6 +174,31 @@ class IterableH5Chunks(object):
       chunksize (int, None): Override chunk size.  ``None`` uses the file's
           native chunk size.
       reverse (bool): If ``True``, iterate in reverse order.
+      prefetch (int): If > 0, read and decompress up to *prefetch* chunks
+          ahead in a background thread, so that I/O overlaps with the
+          computations done on the yielded chunks.  As PyTables is not
+          thread-safe, all HDF5 access of chunkiter (e.g. by a write-behind
+          writer at the same time) takes turns through a process-wide lock.
+      buffers (int): If > 0, read into a rotating pool of preallocated
+          buffers instead of allocating a new array per chunk.  A yielded
+          chunk stays valid until *buffers* more chunks have been pulled,
+          or until it is handed back with :meth:`release`; copy it if you
+          need it for longer.
+      threads (int): If > 0, read the compressed HDF5 chunks directly and
+          decompress them on a pool of *threads* threads, yielding them in
+          order.  Only used for Blosc-compressed datasets (``blosc`` or, if
+          written by :func:`yielding_chunks_to_h5` with *threads*,
+          ``blosc2``) whose chunks span the full trailing dimensions and
+          match *chunksize*; other datasets are read as usual.
+      start (int): First sample (along axis 0) of the datasets to read.
+      stop (int, None): End of the samples to read (exclusive), ``None``
+          reads until the end.  Chunk borders stay at multiples of the chunk
+          size, so the first and last chunk may be shorter.
+
+  The iterable supports random access without reading the data before the
+  region of interest: ``len()`` gives the number of chunks, ``chunks[i]``
+  reads the *i*-th chunk, and :meth:`range` returns a new iterable for a
+  range of samples.
 
   Yields:
       np.ndarray or tuple of np.ndarray: Data chunks.
@@ -62,84 +208,246 @@ class IterableH5Chunks(object):
       >>> for chunk in array:
       ...     print(chunk.shape)
       >>> print(array.identifier)
+      >>> # read the next two chunks while the current one is processed:
+      >>> array = chunkiter.IterableH5Chunks("test.h5", "data", prefetch=2)
+      >>> # reuse the memory of two buffers for all chunks:
+      >>> array = chunkiter.IterableH5Chunks("test.h5", "data", buffers=2)
+      >>> total = sum(chunk.sum() for chunk in array)
+      >>> # decompress on 8 cores:
+      >>> array = chunkiter.IterableH5Chunks("test.h5", "data", threads=8)
+      >>> # read only the last 1000 samples:
+      >>> tail = chunkiter.concatenate(array.range(-1000))
   """
-  def __init__(self, filename, name=None, chunksize=None, reverse=False):
+  def __init__(self, filename, name=None, chunksize=None, reverse=False, prefetch=0, buffers=0, threads=0, start=0, stop=None):
     self.filename = filename
-    self.identifier = multihash(filename, str(type(name)), str(name), str(chunksize), str(reverse))
+    if start==0 and stop is None:
+      self.identifier = multihash(filename, str(type(name)), str(name), str(chunksize), str(reverse))
+    else:
+      self.identifier = multihash(filename, str(type(name)), str(name), str(chunksize), str(reverse), str(start), str(stop))
     self.chunksize = chunksize
     self.reverse = reverse
+    self.prefetch = prefetch
+    self.buffers = buffers
+    self.threads = threads
+    self.start = start
+    self.stop = stop
+    self._pools = []
+
+    with _h5_lock, tables.open_file(self.filename, "r") as datafile:
+      if name is None:
+        if "data" in datafile.root: name = "data"
+        else:
+          name = []
+          i = 0
+          while True:
+            name_ = "data{}".format(i)
+            if name_ in datafile.root: name.append(name_)
+            else: break
+            i += 1
+      self.name = name
+
+      if type(self.name) in [list, tuple]:
+        self.shape = []
+        self.size = []
+        self.chunksize = []
+        if chunksize is not None: raise NotImplementedError("chunksize!=None not supported when yielding tuples")
+        for name_ in self.name:
+          array = datafile.root[name_]
+          self.shape.append( array.shape )
+          self.size.append( int(np.prod(array.shape)) )
+          self.chunksize.append( array.chunkshape[0] )
+      else:
+        array = datafile.root[self.name]
+        self.shape = array.shape
+        self.size = int(np.prod(self.shape))
+        self.chunksize = chunksize if chunksize is not None else array.chunkshape[0]
 
-    datafile = tables.open_file(self.filename, "r")
-
-    if name is None:
-      if "data" in datafile.root: name = "data"
+  def __iter__(self):
+    if self.prefetch>0: return _background_iter(self._iter_chunks(), self.prefetch)
+    else: return self._iter_chunks()
+
+  def _reader(self, array, chunksize, pools):
+    # returns read(start, stop), which does all HDF5 access and returns a function that
+    # finishes the chunk, so that decompression can run on a thread pool
+    pool = None
+    if self.buffers>0:
+      # the background thread may be up to prefetch+1 chunks ahead of the consumer, and
+      # the decompression threads up to 2*threads chunks ahead of the background thread
+      pool = _BufferPool(self.buffers + (self.prefetch+1 if self.prefetch>0 else 0) + 2*self.threads)
+      pools.append(pool)
+      self._pools.append(pool)
+
+    def read(start, stop):
+      stop = min(stop, array.shape[0])
+      with _h5_lock:
+        if pool is None:
+          out = array[start:stop,...]
+        else:
+          out = pool.take((stop-start,)+array.shape[1:], array.dtype)
+          array.read(start, stop, out=out)
+      return lambda: out
+
+    chunkshape = tuple(int(i) for i in array.chunkshape)
+    complib = array.filters.complib.split(":")[0] if array.filters.complevel>0 else None
+    direct = (
+      self.threads>0
+      and complib in ["blosc", "blosc2"]
+      and not array.filters.fletcher32
+      and chunkshape[0]==chunksize
+      and chunkshape[1:]==tuple(array.shape[1:])
+    )
+    if not direct: return read
+
+    def read_direct(start, stop):
+      stop = min(stop, array.shape[0])
+      coords = (start - start%chunkshape[0],) + (0,)*(len(chunkshape)-1)
+      with _h5_lock:
+        info = array.chunk_info(coords)
+        if info.offset is None or info.filter_mask: return read(start, stop) # chunk not written or stored uncompressed
+        raw = array.read_chunk(coords)
+
+      if complib=="blosc2":
+        # frame written by the PyTables blosc2 filter; the b2nd layout may be blocked, so leave that to PyTables
+        schunk = blosc2.schunk_from_cframe(raw)
+        if "b2nd" in schunk.meta: return read(start, stop)
+        blosc_chunks = [(i*schunk.chunksize, schunk.get_chunk(i)) for i in range(schunk.nchunks)]
       else:
-        name = []
-        i = 0
-        while True:
-          name_ = "data{}".format(i)
-          if name_ in datafile.root: name.append(name_)
-          else: break
-          i += 1
-    self.name = name
-
-    if type(self.name) in [list, tuple]:
-      self.shape = []
-      self.size = []
-      self.chunksize = []
-      if chunksize is not None: raise NotImplementedError("chunksize!=None not supported when yielding tuples")
-      for name_ in self.name:
-        array = datafile.root[name_]
-        self.shape.append( array.shape )
-        self.size.append( int(np.prod(array.shape)) )
-        self.chunksize.append( array.chunkshape[0] )
-    else:
-      array = datafile.root[self.name]
-      self.shape = array.shape
-      self.size = int(np.prod(self.shape))
-      self.chunksize = chunksize if chunksize is not None else array.chunkshape[0]
+        blosc_chunks = [(0, raw)]
+
+      def decompress():
+        if pool is None: out = np.empty(chunkshape, array.dtype)
+        else: out = pool.take(chunkshape, array.dtype)
+        out_bytes = out.reshape(-1).view(np.uint8)
+        for offset, blosc_chunk in blosc_chunks:
+          blosc2.decompress2(blosc_chunk, dst=out_bytes[offset:], nthreads=1)
+        return out[start-coords[0]:stop-coords[0],...]
+
+      return decompress
+
+    return read_direct
+
+  def _sample_range(self):
+    # (start, stop) of the samples covered by all datasets
+    lengths = [shape[0] for shape in self.shape] if type(self.name) in [list, tuple] else [self.shape[0]]
+    stop = min(lengths) if self.stop is None else min(lengths+[self.stop])
+    return min(self.start, stop), stop
+
+  def _bounds(self):
+    # per dataset: chunk bounds in iteration order
+    chunksizes = self.chunksize if type(self.name) in [list, tuple] else [self.chunksize]
+    start, stop = self._sample_range()
+    return [_ChunkBounds(start, stop, chunksize, self.reverse) for chunksize in chunksizes]
+
+  def _iter_chunks(self, indices=None):
+    with _h5_lock: datafile = tables.open_file(self.filename, "r")
+    pools = []
+
+    try:
+      names = self.name if type(self.name) in [list, tuple] else [self.name]
+      chunksizes = self.chunksize if type(self.name) in [list, tuple] else [self.chunksize]
+      with _h5_lock: readers = [self._reader(datafile.root[name], chunksize, pools) for name, chunksize in zip(names, chunksizes)]
+      bounds = self._bounds()
+      if indices is None: indices = range(min(len(b) for b in bounds))
+
+      tasks = (tuple(read(*b[i]) for read, b in zip(readers, bounds)) for i in indices)
+      run = lambda task: tuple(t() for t in task)
+      chunks = _ordered_map(run, tasks, self.threads) if self.threads>0 else map(run, tasks)
+
+      for chunk in chunks:
+        if self.reverse: chunk = tuple(c[::-1,...] for c in chunk)
+        yield chunk if type(self.name) in [list, tuple] else chunk[0]
+
+    finally:
+      with _h5_lock: datafile.close()
+      for pool in pools: self._pools.remove(pool)
+
+  def release(self, chunk):
+    """Hand a chunk back for reuse before the rotation reaches it (only with ``buffers`` > 0).
+
+    Args:
+        chunk (np.ndarray or tuple of np.ndarray): A chunk yielded by this
+            iterable, which must not be used afterwards.
+    """
+    chunks = chunk if type(chunk)==tuple else (chunk,)
+    for c in chunks:
+      for pool in self._pools:
+        if pool.release(c): break
+
+  def _copy(self, **kwargs):
+    options = dict(
+      chunksize = None if type(self.name) in [list, tuple] else self.chunksize,
+      reverse = self.reverse,
+      prefetch = self.prefetch,
+      buffers = self.buffers,
+      threads = self.threads,
+      start = self.start,
+      stop = self.stop,
+    )
+    options.update(kwargs)
+    return IterableH5Chunks(self.filename, self.name, **options)
 
-    datafile.close()
+  def __reversed__(self):
+    return self._copy(reverse=not self.reverse)
 
-  def __iter__(self):
-    datafile = tables.open_file(self.filename, "r")
+  def __len__(self):
+    return min(len(b) for b in self._bounds())
 
-    if type(self.name) in [list, tuple]: # yielding tuples of arrays
-      arrays = [datafile.root[name] for name in self.name]
+  def __getitem__(self, i):
+    n = len(self)
+    if i<0: i += n
+    if not 0<=i<n: raise IndexError("chunk index out of range")
 
-      if self.reverse:
-        startindices_iterators = [reversed(range(0, shape[0], chunksize)) for shape, chunksize in zip(self.shape, self.chunksize)]
-        for startindices in zip(*startindices_iterators):
-          yield tuple(array[startindex:startindex+chunksize,...][::-1,...] for array, startindex, chunksize in zip(arrays, startindices, self.chunksize))
-      else:
-        startindices_iterators = [range(0, shape[0], chunksize) for shape, chunksize in zip(self.shape, self.chunksize)]
-        for startindices in zip(*startindices_iterators):
-          yield tuple(array[startindex:startindex+chunksize,...] for array, startindex, chunksize in zip(arrays, startindices, self.chunksize))
-      
-    else: # yielding single arrays
-      array = datafile.root[self.name]
-
-      if self.reverse:
-        for startindex in reversed(range(0, self.shape[0], self.chunksize)):
-          yield array[startindex:startindex+self.chunksize,...][::-1,...]
-      else:
-        for startindex in range(0, self.shape[0], self.chunksize):
-          yield array[startindex:startindex+self.chunksize,...]
+    # read a single chunk directly, without prefetching or buffer reuse
+    chunks = self._copy(prefetch=0, buffers=0, threads=0)._iter_chunks([i])
+    try: return next(chunks)
+    finally: chunks.close()
 
-    datafile.close()
+  def range(self, start=0, stop=None):
+    """Return an iterable over a range of samples, seeking directly to the first needed chunk.
+
+    *start* and *stop* count samples along axis 0 in iteration order (i.e.
+    from the end of the datasets for reversed iterables) and may be negative
+    like slice indices.
+
+    Args:
+        start (int): First sample.
+        stop (int, None): End sample (exclusive); ``None`` for all remaining.
+
+    Returns:
+        IterableH5Chunks: A new iterable with the same options.
+
+    Example:
+        >>> array = chunkiter.IterableH5Chunks("test.h5", "data")
+        >>> last_minute = array.range(-60*samplerate)
+    """
+    samples_start, samples_stop = self._sample_range()
+    start, stop, _ = slice(start, stop).indices(samples_stop-samples_start)
+    stop = max(start, stop)
+
+    if self.reverse: return self._copy(start=samples_stop-stop, stop=samples_stop-start)
+    else: return self._copy(start=samples_start+start, stop=samples_start+stop)
 
-  def __reversed__(self):
-    return IterableH5Chunks(self.filename, self.name, self.chunksize, not self.reverse)
 
 class IterableBinaryFileChunks(object):
   """Iterator reading from binary format (streaming-capable, also over sockets using ``socket.makefile``).
 
-  Reads the format written by :func:`yielding_chunks_to_binaryfile`.
+  Reads both format versions written by :func:`yielding_chunks_to_binaryfile`.
   Each instance has an ``identifier`` attribute.
 
   Args:
       file: A file-like object in binary read mode.
       identifier (str, optional): Identifier hash.  Auto-generated if not given.
+      buffers (int): If > 0, read version 2 streams into a rotating pool of
+          reusable buffers instead of allocating new arrays per chunk.  A
+          yielded chunk stays valid until *buffers* more chunks have been
+          pulled, or until it is handed back with :meth:`release`.
+      threads (int): If > 0, decompress compressed streams on a pool of
+          *threads* threads while the next chunks are read, yielding them in
+          order.
+      require_end (bool): If ``True``, raise :class:`EOFError` when the
+          file ends before the end marker of a version 2 stream, e.g. when
+          a connection is closed before the writer has finished.  Otherwise
+          the end of the file between two chunks also ends the stream.
 
   Yields:
       np.ndarray or tuple of np.ndarray: Deserialized chunk(s).
@@ -152,14 +460,23 @@ class IterableBinaryFileChunks(object):
       ...     print(chunk.shape)
   """
 
-  def __init__(self, file, identifier=None):
+  def __init__(self, file, identifier=None, buffers=0, threads=0, require_end=False):
     self.file = file
     self.identifier = identifier if identifier is not None else str(uuid.uuid4())
+    self.buffers = buffers
+    self.threads = threads
+    self.require_end = require_end
+    self._pool = None
 
   def __iter__(self):
-    while True:
-      assert self.file.read(5)==b'TUPLE'
+    magic = self.file.read(5)
+    if magic==b'TUPLE': yield from self._iter_v1()
+    elif magic==b'CHUNK': yield from self._iter_v2()
+    elif magic!=b'': raise IOError("not a chunkiter binary stream")
+    elif self.require_end: raise EOFError("unexpected end of chunkiter binary stream")
 
+  def _iter_v1(self):
+    while True:
       tuple_len = np.empty(1, np.int64)
       self.file.readinto(tuple_len.view("b").data)
 
@@ -171,6 +488,246 @@ class IterableBinaryFileChunks(object):
 
       yield arrays[0] if len(arrays)==1 else arrays
 
+      magic = self.file.read(5)
+      if magic==b'': return
+      assert magic==b'TUPLE'
+
+  def _iter_v2(self):
+    flags, dtypes, shapes, pos = _read_stream_header(self.file)
+    if flags&_STREAM_COMPRESSED:
+      yield from self._iter_compressed(dtypes, shapes)
+      return
+    if self.buffers>0: self._pool = _BufferPool(self.buffers*len(dtypes)) # a buffer per array of a chunk
+
+    rows = np.empty(len(dtypes), np.int64)
+    padding = bytearray(_STREAM_ALIGNMENT)
+    while _readinto(self.file, rows.view(np.uint8), eof_ok=not self.require_end) and rows[0]>=0:
+      pos += rows.nbytes
+      arrays = []
+      for n, dtype, shape in zip(rows, dtypes, shapes):
+        pad = _padding(pos, flags)
+        _readinto(self.file, memoryview(padding)[:pad])
+        shape = (int(n),)+shape
+        array = np.empty(shape, dtype) if self._pool is None else self._pool.take(shape, dtype)
+        _readinto(self.file, array.reshape(-1).view(np.uint8))
+        pos += pad + array.nbytes
+        arrays.append(array)
+
+      yield arrays[0] if len(arrays)==1 else tuple(arrays)
+
+  def _read_compressed(self, n):
+    # compressed frames as row counts and compressed data of each array
+    rows = np.empty(n, np.int64)
+    sizes = np.empty(n, np.int64)
+    while _readinto(self.file, rows.view(np.uint8), eof_ok=not self.require_end) and rows[0]>=0:
+      _readinto(self.file, sizes)
+      compressed = [bytearray(size) for size in sizes.tolist()]
+      for c in compressed: _readinto(self.file, c)
+      yield rows.tolist(), compressed
+
+  def _iter_compressed(self, dtypes, shapes):
+    if self.buffers>0: self._pool = _BufferPool((self.buffers+2*self.threads)*len(dtypes))
+
+    def decompress(frame):
+      arrays = []
+      for n, compressed, dtype, shape in zip(*frame, dtypes, shapes):
+        shape = (n,)+shape
+        array = np.empty(shape, dtype) if self._pool is None else self._pool.take(shape, dtype)
+        _decompress_into(compressed, array)
+        arrays.append(array)
+      return arrays[0] if len(arrays)==1 else tuple(arrays)
+
+    frames = self._read_compressed(len(dtypes))
+    if self.threads>0: yield from _ordered_map(decompress, frames, self.threads)
+    else: yield from map(decompress, frames)
+
+  def release(self, chunk):
+    """Hand a chunk back for reuse before the rotation reaches it (only with ``buffers`` > 0).
+
+    Args:
+        chunk (np.ndarray or tuple of np.ndarray): A chunk yielded by this
+            iterable, which must not be used afterwards.
+    """
+    if self._pool is None: return
+    for c in (chunk if type(chunk)==tuple else (chunk,)):
+      self._pool.release(c)
+
+class _IndexedChunks(object):
+  # sample ranges, random access and reverse iteration over stored chunks whose row counts
+  # are known in advance; subclasses call _set_rows, set self.reverse, self.start, self.stop
+  # and self._tuple, and implement _reader() and _copy()
+
+  def _set_rows(self, rows):
+    self._rows = rows # chunks x arrays
+    self._ends = np.cumsum(rows[:,0])
+
+  def _sample_range(self):
+    # (start, stop) of the samples covered by the stored chunks
+    length = int(self._ends[-1]) if len(self._ends) else 0
+    stop = length if self.stop is None else min(length, self.stop)
+    return min(self.start, stop), stop
+
+  def _frames(self):
+    # frame indices covering the sample range, in storage order
+    start, stop = self._sample_range()
+    if self.start==0 and self.stop is None: return np.arange(len(self._rows))
+    if start==stop: return np.arange(0)
+    if (self._rows!=self._rows[:,:1]).any():
+      raise ValueError("start and stop require chunks with equal lengths for all ndarrays")
+    return np.arange(np.searchsorted(self._ends, start, "right"), np.searchsorted(self._ends, stop, "left")+1)
+
+  def _chunk(self, frame, arrays):
+    # trim the arrays of a frame to the sample range and orient them for iteration
+    if not (self.start==0 and self.stop is None):
+      start, stop = self._sample_range()
+      framestart = int(self._ends[frame]-self._rows[frame,0])
+      lo = max(start-framestart, 0)
+      arrays = [array[lo:stop-framestart] for array in arrays]
+    if self.reverse: arrays = [array[::-1,...] for array in arrays]
+    return tuple(arrays) if self._tuple else arrays[0]
+
+  def _map(self, read, frames):
+    return map(read, frames)
+
+  def __iter__(self):
+    frames = self._frames()
+    if self.reverse: frames = frames[::-1]
+    read = self._reader()
+    for frame, arrays in zip(frames, self._map(read, frames)):
+      yield self._chunk(frame, arrays)
+
+  def __reversed__(self):
+    return self._copy(reverse=not self.reverse)
+
+  def __len__(self):
+    return len(self._frames())
+
+  def __getitem__(self, i):
+    frames = self._frames()
+    n = len(frames)
+    if i<0: i += n
+    if not 0<=i<n: raise IndexError("chunk index out of range")
+    frame = frames[n-1-i if self.reverse else i]
+    return self._chunk(frame, self._reader()(frame))
+
+  def range(self, start=0, stop=None):
+    """Return an iterable over a range of samples, seeking directly to the first needed chunk.
+
+    *start* and *stop* count samples along axis 0 in iteration order and may
+    be negative like slice indices, as for :meth:`IterableH5Chunks.range`.
+
+    Args:
+        start (int): First sample.
+        stop (int, None): End sample (exclusive); ``None`` for all remaining.
+
+    Returns:
+        A new iterable of the same type with the same options.
+    """
+    samples_start, samples_stop = self._sample_range()
+    start, stop, _ = slice(start, stop).indices(samples_stop-samples_start)
+    stop = max(start, stop)
+
+    if self.reverse: return self._copy(start=samples_stop-stop, stop=samples_stop-start)
+    else: return self._copy(start=samples_start+start, stop=samples_start+stop)
+
+class IterableMemmapChunks(_IndexedChunks):
+  """Iterable that memory-maps a binary chunk file written with an index footer.
+
+  Reads files written by :func:`yielding_chunks_to_binaryfile` with
+  ``index=True`` and yields read-only views into the memory-mapped file, so
+  no data is copied or read before it is accessed.  The views stay valid as
+  long as they are referenced.
+
+  Each instance has an ``identifier`` attribute for use with :func:`cache`.
+
+  Args:
+      filename (str): Path to the binary file.
+      reverse (bool): If ``True``, iterate in reverse order.
+      start (int): First sample (along axis 0) to read.
+      stop (int, None): End of the samples to read (exclusive), ``None``
+          reads until the end.  The first and last chunk may be shorter.
+
+  Like :class:`IterableH5Chunks`, the iterable supports ``len()``,
+  ``chunks[i]``, :meth:`range` and ``reversed()``.
+
+  Raises:
+      ValueError: If the file is empty, as written for an empty iterator,
+          which has no dtypes to declare.
+      IOError: If the file has no index footer.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Data chunks.
+
+  Example:
+      >>> with open("test.bin", "wb") as f:
+      ...     chunkiter.chunks_to_binaryfile(chunks, f, index=True)
+      >>> array = chunkiter.IterableMemmapChunks("test.bin")
+      >>> tail = chunkiter.concatenate(array.range(-1000))
+  """
+  def __init__(self, filename, reverse=False, start=0, stop=None):
+    self.filename = filename
+    if start==0 and stop is None:
+      self.identifier = multihash(filename, str(reverse))
+    else:
+      self.identifier = multihash(filename, str(reverse), str(start), str(stop))
+    self.reverse = reverse
+    self.start = start
+    self.stop = stop
+
+    with open(filename, "rb") as f:
+      size = f.seek(0, os.SEEK_END)
+      if size==0: raise ValueError("{} is empty: no chunks were written to it".format(filename))
+      if size<21: raise IOError("no chunkiter index footer (write with index=True)")
+      f.seek(-21, os.SEEK_END)
+      trailer = np.empty(2, np.int64)
+      _readinto(f, trailer)
+      if f.read(5)!=b'CKIDX': raise IOError("no chunkiter index footer (write with index=True)")
+      footer_offset, stream_size = trailer.tolist()
+      self._base = f.tell() - stream_size # the stream may follow other data in the file
+
+      f.seek(self._base)
+      if f.read(5)!=b'CHUNK': raise IOError("not a chunkiter binary stream")
+      flags, self.dtypes, self.shapes, _ = _read_stream_header(f)
+
+      f.seek(self._base+footer_offset)
+      if f.read(5)!=b'INDEX': raise IOError("corrupt chunkiter index footer")
+      count = np.empty(1, np.int64)
+      _readinto(f, count)
+      offsets = np.empty(count.item(), np.int64)
+      _readinto(f, offsets)
+      rows = np.empty((count.item(), len(self.dtypes)), np.int64)
+      _readinto(f, rows)
+      self._set_rows(rows)
+
+    self._tuple = len(self.dtypes)>1
+
+    # stream offset of the data of each array in each frame
+    self._offsets = np.empty_like(self._rows)
+    pos = offsets + self._rows.shape[1]*8
+    for k, (dtype, shape) in enumerate(zip(self.dtypes, self.shapes)):
+      if flags&_STREAM_ALIGNED: pos = pos + (-pos)%_STREAM_ALIGNMENT
+      self._offsets[:,k] = pos
+      pos = pos + self._rows[:,k]*dtype.itemsize*int(np.prod(shape))
+
+  def _reader(self):
+    if not len(self._rows): return None
+    mm = np.memmap(self.filename, np.uint8, "r", offset=self._base)
+
+    def read(frame):
+      arrays = []
+      for k, (dtype, shape) in enumerate(zip(self.dtypes, self.shapes)):
+        n = int(self._rows[frame,k])
+        offset = int(self._offsets[frame,k])
+        arrays.append(mm[offset:offset+n*dtype.itemsize*int(np.prod(shape))].view(dtype).reshape((n,)+shape))
+      return arrays
+
+    return read
+
+  def _copy(self, **kwargs):
+    options = dict(reverse=self.reverse, start=self.start, stop=self.stop)
+    options.update(kwargs)
+    return IterableMemmapChunks(self.filename, **options)
+
 class IdentifierIterator(object):
   """Iterator wrapper that attaches an ``identifier`` hash attribute.
 
@@ -197,7 +754,111 @@ class IdentifierIterator(object):
   def __next__(self):
     return next(self.iterator)
 
-def yielding_chunks_to_h5(iterator, filename, name=None, expectedchunks=128, verbose=False, preprocessor=None, skip=1):
+def _blosc2_cparams(filters, dtype):
+  # blosc2 compression parameters matching the PyTables filters of a dataset
+  codec = filters.complib.split(":")[1] if ":" in filters.complib else "blosclz"
+  if filters.bitshuffle: shuffle = blosc2.Filter.BITSHUFFLE
+  elif filters.shuffle: shuffle = blosc2.Filter.SHUFFLE
+  else: shuffle = blosc2.Filter.NOFILTER
+  return dict(typesize=dtype.itemsize, clevel=filters.complevel, codec=blosc2.Codec[codec.upper()], filters=[shuffle], nthreads=1)
+
+def _compress_cframe(v, cparams):
+  # compress a full HDF5 chunk to the frame format of the PyTables blosc2 filter
+  v = np.ascontiguousarray(v)
+  schunk = blosc2.SChunk(chunksize=v.nbytes, cparams=cparams)
+  schunk.append_chunk(blosc2.compress2(v, **cparams))
+  return v.shape[0], schunk.to_cframe()
+
+class _H5Writer(object):
+  # appends to the datasets of one HDF5 file, optionally from a dedicated writer thread and
+  # with compression on a thread pool
+  def __init__(self, filename, writebehind=0, threads=0, copy=True):
+    with _h5_lock: self.datafile = tables.open_file(filename, "a")
+    self.copy = copy
+    self.error = None
+    self.queue = None
+    self.pending = collections.deque() # chunks waiting for compression, in order
+    self.threads = threads
+    self.compressor = concurrent.futures.ThreadPoolExecutor(threads) if threads>0 else None
+    self.unaligned = set() # datasets that got a partial chunk, which must be appended normally from then on
+
+    if writebehind>0:
+      self.queue = queue.Queue(maxsize=writebehind)
+      self.thread = threading.Thread(target=self._worker, daemon=True)
+      self.thread.start()
+
+  def _worker(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None: break
+        if self.error is not None: continue # keep draining so that the producer never blocks
+        try: self._write(*item)
+        except BaseException as e: self.error = e
+      finally:
+        self.queue.task_done()
+
+  def _check(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def _write(self, dataset, v):
+    if isinstance(v, concurrent.futures.Future):
+      rows, cframe = v.result()
+      with _h5_lock:
+        start = dataset.nrows
+        dataset.truncate(start+rows)
+        dataset.write_chunk((start,)+(0,)*(dataset.ndim-1), cframe)
+    else:
+      with _h5_lock: dataset.append(v)
+
+  def _direct(self, dataset, v):
+    # can v be compressed in parallel and written as a whole HDF5 chunk?
+    return (
+      dataset not in self.unaligned
+      and dataset.filters.complevel>0 and dataset.filters.complib.split(":")[0]=="blosc2"
+      and not dataset.filters.fletcher32
+      and v.shape==dataset.chunkshape and v.dtype==dataset.dtype and v.dtype.itemsize<256
+    )
+
+  def append(self, dataset, v):
+    if self.copy and (self.queue is not None or self.compressor is not None):
+      v = v.copy() # written after the chunk has been yielded, which may be modified by then
+
+    if self.compressor is not None:
+      if self._direct(dataset, v):
+        v = self.compressor.submit(_compress_cframe, v, _blosc2_cparams(dataset.filters, v.dtype))
+      else:
+        self.unaligned.add(dataset)
+
+    if self.queue is None:
+      self.pending.append((dataset, v))
+      while len(self.pending)>2*self.threads: self._write(*self.pending.popleft())
+    else:
+      self._check()
+      self.queue.put((dataset, v))
+
+  def flush(self):
+    # store all appended chunks and flush the file to the OS
+    while len(self.pending): self._write(*self.pending.popleft())
+    if self.queue is not None:
+      self.queue.join()
+      self._check()
+    with _h5_lock: self.datafile.flush()
+
+  def close(self):
+    try:
+      while len(self.pending): self._write(*self.pending.popleft())
+      if self.queue is not None:
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+    finally:
+      if self.compressor is not None: self.compressor.shutdown(cancel_futures=True)
+      with _h5_lock: self.datafile.close()
+
+def yielding_chunks_to_h5(iterator, filename, name=None, expectedchunks=128, verbose=False, preprocessor=None, skip=1, writebehind=0, complib=None, complevel=5, shuffle=True, threads=0, append=False, copy=True, checkpoint=None):
   """Stream chunks from an iterator to HDF5, yielding data unchanged for further processing.
 
   This is the streaming variant — each chunk is written and yielded immediately.
@@ -216,6 +877,33 @@ def yielding_chunks_to_h5(iterator, filename, name=None, expectedchunks=128, ver
       preprocessor (callable, optional): Transformation applied before writing
           (yielded data is still the original).
       skip (int): Only write/save every ``skip``-th chunk (1 = every chunk).
+      writebehind (int): If > 0, compression and writing is done by a
+          dedicated writer thread per output file, which is fed through a
+          queue holding up to *writebehind* chunks.  Write errors are raised
+          on the next chunk or at the end of the iteration.  The writer
+          thread takes turns with other HDF5 access through a process-wide
+          lock, as PyTables is not thread-safe.
+      complib (str, None): PyTables compression library, e.g. ``"blosc:lz4"``
+          or ``"blosc2:zstd"``.  Defaults to ``"blosc:lz4"``, or to
+          ``"blosc2:lz4"`` if *threads* > 0.
+      complevel (int): Compression level (0 disables compression).
+      shuffle (bool or str): Byte shuffle before compression (``True``),
+          bit shuffle (``"bit"``) or none (``False``).
+      threads (int): If > 0, compress on a pool of *threads* threads and
+          write the compressed chunks directly into the file.  Requires a
+          ``blosc2:`` *complib*; the files stay readable by stock PyTables.
+          Chunks that do not fill a whole HDF5 chunk are appended as usual.
+      append (bool): Append to existing datasets instead of raising
+          ``IOError``.  Their dtypes and trailing shapes must match.
+      copy (bool): With *writebehind* or *threads*, chunks are written after
+          they have been yielded, so they are copied first, and the yielded
+          chunks may be modified in place.  ``False`` avoids the copy; then
+          the yielded chunks must not be modified.
+      checkpoint (callable, None): Called as ``checkpoint()`` after each
+          written chunk.  If it returns a callable, all chunks so far are
+          first stored and flushed (waiting for the writer threads), and
+          then that callable is called.  :func:`cache` stores its resumable
+          checkpoints this way.
 
   Yields:
       np.ndarray or tuple of np.ndarray: Original (unprocessed) chunks.
@@ -227,7 +915,8 @@ def yielding_chunks_to_h5(iterator, filename, name=None, expectedchunks=128, ver
       >>> saved = chunkiter.yielding_chunks_to_h5(processed, "output.h5")
       >>> chunkiter.chunks_to_binaryfile(saved, open("output.bin", "wb"))
   """
-  filters = tables.Filters(complevel=5, complib='blosc:lz4')
+  if complib is None: complib = "blosc2:lz4" if threads>0 else "blosc:lz4"
+  filters = tables.Filters(complevel=complevel, complib=complib, shuffle=shuffle is True, bitshuffle=shuffle=="bit")
 
   filenames = filename if type(filename)==tuple else (filename,)
   names = name if type(name)==tuple else (name,)
@@ -241,51 +930,69 @@ def yielding_chunks_to_h5(iterator, filename, name=None, expectedchunks=128, ver
   #   v1,v2 | fn      | n     | error
 
   unnamed_counter = collections.Counter()
-  datafiles = []
+  writers = {} # one writer per output file
   datasets = []
   nottuple = False
 
-  for chunk_i,data in enumerate(iterator):
-    data_original = data
-    if preprocessor is not None: data = preprocessor(data)
-
-    if not type(data)==tuple:
-      data = (data,)
-      nottuple = True
-
-    if len(filenames)==1 and len(data)>1: filenames = filenames*len(data)
-    if len(names)==1 and len(data)>1: names = names*len(data)
-
-    if chunk_i%skip==0:
-      if verbose: print("* ...writing chunk {}".format(chunk_i), end="\r")
-
-      # initialize datasets
-      if not len(datasets):
-        occupied = []
-        for fn,n,v in zip(filenames, names, data):
-          if n is None:
-            n = "data" if nottuple else "data{}".format(unnamed_counter[fn])
-            unnamed_counter[fn] += 1
-
-          if (fn,n) in occupied: raise ValueError("conflict: tried to write twice to dataset {} in filename {}".format(n,fn))
-          occupied.append((fn,n))
-
-          datafile = tables.open_file(fn, "a")
-          datafiles.append(datafile)
-          if n in datafile.root: raise IOError("{} in {} already contains data".format(n, fn))
-          atom = tables.Atom.from_dtype(v.dtype)
-          shape = (0,)+v.shape[1:]
-          datafile.create_earray(datafile.root, n, atom=atom, shape=shape, chunkshape=v.shape, expectedrows=expectedchunks*v.shape[0], filters=filters)
-          datasets.append(datafile.root[n])
-
-      for d,v in zip(datasets, data):
-        d.append(v)
-
-    yield data_original
-
-  if verbose: print()
-
-  for datafile in datafiles: datafile.close()
+  try:
+    for chunk_i,data in enumerate(iterator):
+      data_original = data
+      if preprocessor is not None: data = preprocessor(data)
+
+      if not type(data)==tuple:
+        data = (data,)
+        nottuple = True
+
+      if len(filenames)==1 and len(data)>1: filenames = filenames*len(data)
+      if len(names)==1 and len(data)>1: names = names*len(data)
+
+      if chunk_i%skip==0:
+        if verbose: print("* ...writing chunk {}".format(chunk_i), end="\r")
+
+        # initialize datasets
+        if not len(datasets):
+          occupied = []
+          for fn,n,v in zip(filenames, names, data):
+            if n is None:
+              n = "data" if nottuple else "data{}".format(unnamed_counter[fn])
+              unnamed_counter[fn] += 1
+
+            if (fn,n) in occupied: raise ValueError("conflict: tried to write twice to dataset {} in filename {}".format(n,fn))
+            occupied.append((fn,n))
+
+            if fn not in writers: writers[fn] = _H5Writer(fn, writebehind, threads, copy)
+            with _h5_lock:
+              datafile = writers[fn].datafile
+              if n in datafile.root:
+                if not append: raise IOError("{} in {} already contains data".format(n, fn))
+                dataset = datafile.root[n]
+                if dataset.dtype!=v.dtype or dataset.shape[1:]!=v.shape[1:]:
+                  raise ValueError("chunks do not match the dtype and trailing shape of {} in {}".format(n, fn))
+                if dataset.nrows%dataset.chunkshape[0]: writers[fn].unaligned.add(dataset)
+              else:
+                atom = tables.Atom.from_dtype(v.dtype)
+                shape = (0,)+v.shape[1:]
+                datafile.create_earray(datafile.root, n, atom=atom, shape=shape, chunkshape=v.shape, expectedrows=expectedchunks*v.shape[0], filters=filters)
+              datasets.append((writers[fn], datafile.root[n]))
+
+        for (writer,d),v in zip(datasets, data):
+          writer.append(d, v)
+
+        stored = checkpoint() if checkpoint is not None else None
+        if stored is not None:
+          for writer in writers.values(): writer.flush()
+          stored()
+
+      yield data_original
+
+    if verbose: print()
+
+  finally:
+    errors = []
+    for writer in writers.values():
+      try: writer.close()
+      except BaseException as e: errors.append(e)
+    if errors: raise errors[0]
 
 def chunks_to_h5(*args, **kwargs):
   """Consume an iterator and write all chunks to HDF5 (no yielding).
@@ -313,10 +1020,9 @@ def array_to_h5(filename, name, data):
       >>> np.allclose(chunkiter.array_from_h5("output.h5", "result"), [1, 2, 3])
       True
   """
-  datafile = tables.open_file(filename, "a")
-  if name not in datafile.root: datafile.create_array(datafile.root, name, atom=tables.Atom.from_dtype(data.dtype), shape=data.shape)
-  datafile.root[name][...] = data
-  datafile.close()
+  with _h5_lock, tables.open_file(filename, "a") as datafile:
+    if name not in datafile.root: datafile.create_array(datafile.root, name, atom=tables.Atom.from_dtype(data.dtype), shape=data.shape)
+    datafile.root[name][...] = data
 
 def array_from_h5(filename, name):
   """Read a single numpy array from an HDF5 file.
@@ -331,10 +1037,8 @@ def array_from_h5(filename, name):
   Example:
       >>> data = chunkiter.array_from_h5("input.h5", "metadata")
   """
-  datafile = tables.open_file(filename, "r")
-  data = datafile.root[name][...]
-  datafile.close()
-  return data
+  with _h5_lock, tables.open_file(filename, "r") as datafile:
+    return datafile.root[name][...]
 
 def serialize_ndarray(array, file):
   file.write(b'ARRAY')
@@ -376,13 +1080,147 @@ def deserialize_ndarray(file, memory_limit=512*1024**2):
 
   return array
 
-def yielding_chunks_to_binaryfile(iterator, file, verbose=True, preprocessor=None, skip=1):
+def _readinto(file, buffer, eof_ok=False):
+  # fill buffer completely (sockets may return partial reads); returns False on EOF before the first byte if eof_ok
+  view = memoryview(buffer).cast("B")
+  pos = 0
+  while pos<len(view):
+    n = file.readinto(view[pos:])
+    if not n:
+      if pos==0 and eof_ok: return False
+      raise EOFError("unexpected end of chunkiter binary stream")
+    pos += n
+  return True
+
+def _writev(file, buffers):
+  # write buffers with as few system calls as possible, without joining them first
+  buffers = [memoryview(b.reshape(-1).view(np.uint8) if isinstance(b, np.ndarray) else b) for b in buffers]
+  buffers = [b for b in buffers if len(b)]
+  size = sum(len(b) for b in buffers)
+
+  try:
+    fd = file.fileno()
+    vectored = hasattr(os, "writev") and os.get_blocking(fd)
+  except (AttributeError, OSError):
+    vectored = False
+
+  if not vectored:
+    for b in buffers: file.write(b)
+    return size
+
+  file.flush()
+  while len(buffers):
+    n = os.writev(fd, buffers[:1024])
+    while len(buffers) and n>=len(buffers[0]):
+      n -= len(buffers.pop(0))
+    if n: buffers[0] = buffers[0][n:]
+
+  return size
+
+_STREAM_INDEX = 1 # index footer after the end of the stream
+_STREAM_ALIGNED = 2 # array data padded to start at multiples of _STREAM_ALIGNMENT bytes
+_STREAM_ALIGNMENT = 64
+_STREAM_COMPRESSED = 4 # array data compressed with blosc2, preceded by its compressed size
+
+def _stream_cparams(dtype, compression, complevel, shuffle):
+  # blosc2 compression parameters for the arrays of a binary stream
+  typesize = dtype.itemsize if dtype.itemsize<256 else 1
+  if shuffle=="bit": shuffle = blosc2.Filter.BITSHUFFLE
+  elif shuffle: shuffle = blosc2.Filter.SHUFFLE
+  else: shuffle = blosc2.Filter.NOFILTER
+  return dict(typesize=typesize, clevel=complevel, codec=blosc2.Codec[compression.upper()], filters=[shuffle], nthreads=1)
+
+def _compress_arrays(arrays, cparams):
+  # compress each array to a sequence of blosc2 chunks (a single one unless it is larger
+  # than blosc2 allows); returns the compressed sizes and the buffers to write
+  sizes = []
+  buffers = []
+  for d, params in zip(arrays, cparams):
+    v = np.ascontiguousarray(d).reshape(-1).view(np.uint8)
+    step = blosc2.MAX_BUFFERSIZE//params["typesize"]*params["typesize"]
+    compressed = [blosc2.compress2(v[i:i+step], **params) for i in range(0, max(len(v), 1), step)]
+    sizes.append(sum(len(c) for c in compressed))
+    buffers += compressed
+  return [np.array(sizes, np.int64)] + buffers
+
+def _decompress_into(compressed, out):
+  # decompress a sequence of blosc2 chunks written by _compress_arrays into out
+  compressed = memoryview(compressed)
+  out = out.reshape(-1).view(np.uint8)
+  pos = 0
+  offset = 0
+  while pos<len(compressed):
+    nbytes, cbytes, _ = blosc2.get_cbuffer_sizes(compressed[pos:])
+    if nbytes: blosc2.decompress2(compressed[pos:pos+cbytes], dst=out[offset:], nthreads=1)
+    pos += cbytes
+    offset += nbytes
+
+def _stream_header(arrays, flags=0):
+  # version 2 stream header: dtype and trailing shape of each array, declared once per stream
+  header = [b'CHUNK', np.array([2, flags, len(arrays)], np.int64)]
+  for a in arrays:
+    typestr = a.dtype.str.encode("ascii")
+    header += [np.array([len(typestr)], np.int64), typestr, np.array([a.ndim-1]+list(a.shape[1:]), np.int64)]
+  return header
+
+def _read_stream_header(file):
+  # reads the version 2 stream header after the magic; returns flags, dtypes, trailing shapes
+  # and the header size including the magic
+  header = np.empty(3, np.int64)
+  _readinto(file, header)
+  version, flags, n = header.tolist()
+  if version!=2: raise IOError("unsupported chunkiter binary stream version {}".format(version))
+  size = 5 + header.nbytes
+
+  dtypes = []
+  shapes = []
+  for i in range(n):
+    typestr_len = np.empty(1, np.int64)
+    _readinto(file, typestr_len)
+    typestr = bytearray(typestr_len.item())
+    _readinto(file, typestr)
+    ndim = np.empty(1, np.int64)
+    _readinto(file, ndim)
+    shape = np.empty(ndim.item(), np.int64)
+    _readinto(file, shape)
+    dtypes.append(np.dtype(typestr.decode("ascii")))
+    shapes.append(tuple(shape.tolist()))
+    size += typestr_len.nbytes + len(typestr) + ndim.nbytes + shape.nbytes
+
+  return flags, dtypes, shapes, size
+
+def _padding(pos, flags):
+  return (-pos)%_STREAM_ALIGNMENT if flags&_STREAM_ALIGNED else 0
+
+def yielding_chunks_to_binaryfile(iterator, file, verbose=True, preprocessor=None, skip=1, version=None, index=False, compression=None, complevel=5, shuffle=True, threads=0):
   """Write chunks to a binary file format, yielding data for further streaming.
 
   Streaming-capable — can write to sockets via ``socket.makefile``.
   See :class:`IterableBinaryFileChunks` for reading back.
 
-  The binary format (repeating) consists of:
+  The binary format version 2 declares the dtypes and trailing shapes once
+  per stream, so that chunks only need a length.  All integers are 64-bit:
+
+  - string ``CHUNK``, version (2), flags, number of ndarrays per chunk
+  - For each ndarray: typestr length, typestring, ndim-1, shape[1:]
+  - For each chunk (repeating): shape[0] of each ndarray, followed by the
+    raw data of each ndarray (C order)
+  - shape[0] of -1 for each ndarray to mark the end of the stream
+
+  With flag 2 (set together with flag 1 by ``index=True``), zero bytes are
+  inserted before each ndarray's data so that it starts at a multiple of
+  64 bytes from the beginning of the stream.  With flag 1, an index footer
+  follows the end of the stream: string ``INDEX``, the number of chunks,
+  the stream offset of each chunk, shape[0] of each ndarray of each chunk,
+  the stream offset of the footer, the total stream size, and the string
+  ``CKIDX``.  See :class:`IterableMemmapChunks`.
+
+  With flag 4 (set by *compression*), the shape[0] values of a chunk are
+  followed by the compressed size of each ndarray, and the data of each
+  ndarray is stored as a sequence of Blosc2 chunks, which record the codec
+  and filters themselves.
+
+  Format version 1 repeats everything for each chunk:
 
   - string ``TUPLE``
   - 64-bit integer: number of ndarrays in this tuple
@@ -396,6 +1234,26 @@ def yielding_chunks_to_binaryfile(iterator, file, verbose=True, preprocessor=Non
       preprocessor (callable, optional): Transform applied before writing
           (yielded data is still original).
       skip (int): Only write every ``skip``-th chunk (1 = every chunk).
+      version (int, None): Format version.  Version 2 requires all chunks to
+          have the same dtypes and trailing shapes; older versions of
+          chunkiter only read version 1.  ``None`` writes version 1, unless
+          *index* or *compression* need version 2.
+      index (bool): Append an index footer of chunk offsets and shapes and
+          align the data for memory mapping (version 2 only).  Like the
+          stream header, it is only written once there is a chunk.
+      compression (str, None): Compress each chunk with this Blosc2 codec,
+          e.g. ``"lz4"``, ``"zstd"`` or ``"blosclz"`` (version 2 only, not
+          together with *index*).
+      complevel (int): Compression level.
+      shuffle (bool or str): Byte shuffle before compression (``True``),
+          bit shuffle (``"bit"``) or none (``False``).
+      threads (int): If > 0, compress on a pool of *threads* threads while
+          the next chunks are pulled.  Written chunks must not be modified in
+          place after they have been yielded.
+
+  Raises:
+      ValueError: If a chunk does not match the dtypes and trailing shapes of
+          the first chunk (version 2).
 
   Yields:
       np.ndarray or tuple of np.ndarray: Original chunks, unchanged.
@@ -415,33 +1273,94 @@ def yielding_chunks_to_binaryfile(iterator, file, verbose=True, preprocessor=Non
   t_start = time.time()
   t_chunk_start = time.time()
 
-  for data_i,data in enumerate(iterator):
-    data_original = data
-    if preprocessor is not None: data = preprocessor(data)
+  if version is None: version = 2 if index or compression is not None else 1
+  if (index or compression is not None) and version==1: raise ValueError("index and compression require version 2")
+  if index and compression is not None: raise ValueError("compressed streams cannot be indexed")
+  flags = _STREAM_INDEX|_STREAM_ALIGNED if index else 0
+  if compression is not None: flags |= _STREAM_COMPRESSED
+
+  header = None
+  pos = 0 # bytes since the start of the stream
+  frame_offsets = []
+  frame_rows = []
+  pending = collections.deque() # compressed frames waiting to be written, in order
+  compressor = concurrent.futures.ThreadPoolExecutor(threads) if compression is not None and threads>0 else None
+
+  def write_frame(rows, compressed):
+    if isinstance(compressed, concurrent.futures.Future): compressed = compressed.result()
+    return _writev(file, [rows]+compressed)
+
+  try:
+    for data_i,data in enumerate(iterator):
+      data_original = data
+      if preprocessor is not None: data = preprocessor(data)
+
+      if not type(data)==tuple:
+        data = (data,)
+
+      if data_i%skip==0:
+        if verbose: print("* ...writing chunk {}, current {:.2f} MB/s, avg {:.2f} MB/s".format(data_i, speed_current/1024**2, speed_avg/1024**2), end="\r")
+
+        if version==1:
+          file.write(b'TUPLE')
+          file.write(np.array([len(data)], np.int64).view("b").data)
+
+          for d in data:
+            serialize_ndarray(d, file)
+
+        else:
+          if header is None:
+            header = [(d.dtype, d.shape[1:]) for d in data]
+            pos += _writev(file, _stream_header(data, flags))
+          if [(d.dtype, d.shape[1:]) for d in data]!=header:
+            raise ValueError("chunk {} does not match the dtypes and trailing shapes of the first chunk".format(data_i))
+
+          rows = np.array([d.shape[0] for d in data], np.int64)
+          if index:
+            frame_offsets.append(pos)
+            frame_rows.append(rows)
+
+          if compression is not None:
+            cparams = [_stream_cparams(d.dtype, compression, complevel, shuffle) for d in data]
+            if compressor is None: pending.append((rows, _compress_arrays(data, cparams)))
+            else: pending.append((rows, compressor.submit(_compress_arrays, data, cparams)))
+            while len(pending)>2*threads: pos += write_frame(*pending.popleft())
 
-    if not type(data)==tuple:
-      data = (data,)
+          else:
+            buffers = [rows]
+            frame_pos = pos + rows.nbytes
+            for d in data:
+              pad = _padding(frame_pos, flags)
+              buffers += [bytes(pad), np.ascontiguousarray(d)]
+              frame_pos += pad + d.nbytes
+            pos += _writev(file, buffers)
 
-    if data_i%skip==0:
-      if verbose: print("* ...writing chunk {}, current {:.2f} MB/s, avg {:.2f} MB/s".format(data_i, speed_current/1024**2, speed_avg/1024**2), end="\r")
+        chunk_bytes = sum(d.nbytes for d in data)
+        total_bytes += chunk_bytes
 
-      file.write(b'TUPLE')
-      file.write(np.array([len(data)], np.int64).view("b").data)
+        now = time.time()
+        speed_current = chunk_bytes/(now-t_chunk_start)
+        speed_avg = total_bytes/(now-t_start)
+        t_chunk_start = now
 
-      chunk_bytes = 0
-      for d in data:
-        serialize_ndarray(d, file)
-        total_bytes += d.nbytes
-        chunk_bytes += d.nbytes
+        file.flush()
 
-      now = time.time()
-      speed_current = chunk_bytes/(now-t_chunk_start)
-      speed_avg = total_bytes/(now-t_start)
-      t_chunk_start = now
+      yield data_original
 
-      file.flush()
+    while len(pending): pos += write_frame(*pending.popleft())
 
-    yield data_original
+  finally:
+    if compressor is not None: compressor.shutdown(cancel_futures=True)
+
+  if header is not None:
+    pos += _writev(file, [np.full(len(header), -1, np.int64)])
+
+    if index:
+      footer = [b'INDEX', np.array([len(frame_offsets)], np.int64), np.array(frame_offsets, np.int64), np.array(frame_rows, np.int64).reshape(-1)]
+      footer_size = sum(len(b) if type(b)==bytes else b.nbytes for b in footer) + 2*8 + 5
+      _writev(file, footer + [np.array([pos, pos+footer_size], np.int64), b'CKIDX'])
+
+    file.flush()
 
 def chunks_to_binaryfile(*args, **kwargs):
   """Consume an iterator and write all chunks to binary format (no yielding).
@@ -456,8 +1375,221 @@ def chunks_to_binaryfile(*args, **kwargs):
   """
   for i in yielding_chunks_to_binaryfile(*args, **kwargs): pass
 
+class CacheBackend(object):
+  """Storage format for the results computed by :func:`cache`.
+
+  Subclass this to plug in another format, and pass an instance as
+  *backend* to :func:`cache` or register it by name in ``cache_backends``.
+
+  Attributes:
+      suffix (str): Appended to the name of each cache entry.
+  """
+  suffix = ""
+
+  def finished(self, path):
+    """Return whether *path* holds a complete result."""
+    raise NotImplementedError()
+
+  def write(self, iterator, path, verbose=False, append=False, **kwargs):
+    """Consume *iterator* and store its chunks at *path*, after the data already there if *append* is set.
+
+    With *checkpoint_interval*, :func:`cache` passes a *checkpoint* callable,
+    see :func:`yielding_chunks_to_h5`.
+    """
+    raise NotImplementedError()
+
+  def rows(self, path):
+    """Return the number of rows stored for each ndarray of the chunks (for resuming)."""
+    raise NotImplementedError()
+
+  def truncate(self, path, rows):
+    """Drop the data after the first *rows* rows of each ndarray (for resuming)."""
+    raise NotImplementedError()
+
+  def finish(self, path, attrs):
+    """Store the dict *attrs* of scalars and strings with the result at *path* and mark it complete."""
+    raise NotImplementedError()
+
+  def attrs(self, path):
+    """Return the dict stored by :meth:`finish` plus ``finished``, or an empty dict if there is none."""
+    raise NotImplementedError()
+
+  def open(self, path):
+    """Return an iterable with an ``identifier`` attribute reading the result at *path*."""
+    raise NotImplementedError()
+
+  def remove(self, path):
+    """Remove a complete or partial result at *path*."""
+    raise NotImplementedError()
+
+class H5CacheBackend(CacheBackend):
+  """Default :class:`CacheBackend`, storing each result in an HDF5 file read by :class:`IterableH5Chunks`."""
+  suffix = ".h5"
+
+  def finished(self, path):
+    try: return bool(array_from_h5(path, "_finished"))
+    except: return False
+
+  def write(self, iterator, path, verbose=False, append=False, **kwargs):
+    chunks_to_h5(iterator, path, verbose=verbose, append=append, **kwargs)
+
+  def _datasets(self, datafile):
+    # datasets named by yielding_chunks_to_h5, in the order of the ndarrays of a chunk
+    if "data" in datafile.root: return [datafile.root.data]
+    return [datafile.root["data{}".format(i)] for i in itertools.takewhile(lambda i: "data{}".format(i) in datafile.root, itertools.count())]
+
+  def rows(self, path):
+    with _h5_lock, tables.open_file(path, "r") as datafile:
+      return [dataset.nrows for dataset in self._datasets(datafile)]
+
+  def truncate(self, path, rows):
+    with _h5_lock, tables.open_file(path, "a") as datafile:
+      for dataset, n in zip(self._datasets(datafile), rows): dataset.truncate(n)
+
+  def finish(self, path, attrs):
+    for name, value in attrs.items():
+      array_to_h5(path, "_"+name, np.array([value.encode("utf-8") if type(value)==str else value]))
+    array_to_h5(path, "_finished", np.array([True]))
+
+  def attrs(self, path):
+    attrs = {}
+    try:
+      with _h5_lock, tables.open_file(path, "r") as datafile:
+        for node in datafile.root:
+          if not node.name.startswith("_"): continue
+          value = node[0]
+          attrs[node.name[1:]] = value.decode("utf-8") if type(value)==np.bytes_ else value.item()
+    except: pass
+    return attrs
+
+  def open(self, path):
+    return IterableH5Chunks(path)
+
+  def remove(self, path):
+    if os.path.exists(path): os.remove(path)
+
+cache_backends = {"h5": H5CacheBackend()}
+
+class _FileLock(object):
+  # exclusive lock on a lock file, between processes as well as threads (flock locks belong
+  # to the open file); released by the OS if the holder dies, and a no-op without fcntl
+  def __init__(self, path):
+    self.path = path
+    self.file = None
+
+  def acquire(self, blocking=True):
+    while True:
+      self.file = open(self.path, "a")
+      if fcntl is None: return True
+      try:
+        fcntl.flock(self.file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX|fcntl.LOCK_NB)
+      except BlockingIOError:
+        self.file.close()
+        self.file = None
+        return False
+      # the lock file may have been removed meanwhile by its previous holder (CacheManager.prune)
+      try:
+        if os.path.samestat(os.fstat(self.file.fileno()), os.stat(self.path)): return True
+      except FileNotFoundError: pass
+      self.release()
+
+  def release(self):
+    if self.file is None: return
+    if fcntl is not None: fcntl.flock(self.file, fcntl.LOCK_UN)
+    self.file.close()
+    self.file = None
+
+def _resume_cache(iterator, backend, path, checkpoint_path):
+  # continue an interrupted computation of cache() after its last checkpoint; returns the
+  # iterator over the remaining chunks and the checkpoint, or None to start over
+  try:
+    with open(checkpoint_path, "rb") as f: checkpoint = pickle.load(f)
+    rows = backend.rows(path)
+    if len(rows)!=len(checkpoint["rows"]) or any(r<c for r, c in zip(rows, checkpoint["rows"])): return None
+    backend.truncate(path, checkpoint["rows"])
+  except Exception:
+    return None
+
+  if checkpoint["state"] is not None and hasattr(iterator, "resume"):
+    iterator = iterator.resume(checkpoint["state"])
+  else:
+    # fast-forward over the chunks that are already stored
+    iterator = iter(iterator)
+    for chunk in itertools.islice(iterator, checkpoint["chunks"]): pass
+
+  return iterator, checkpoint
+
+class _Checkpointer(object):
+  # passes the chunks on to the writer of cache() and, called by the writer after each chunk
+  # (the checkpoint argument of yielding_chunks_to_h5), takes a checkpoint every interval
+  # seconds, which the writer stores once it has flushed the chunks so far
+  def __init__(self, iterator, checkpoint_path, interval, checkpoint, t_start):
+    self.iterator = iterator
+    self.checkpoint_path = checkpoint_path
+    self.interval = interval
+    self.checkpoint = checkpoint
+    self.t_start = t_start
+    self.t_checkpoint = time.time()
+
+  def __iter__(self):
+    for chunk in self.iterator:
+      arrays = chunk if type(chunk)==tuple else (chunk,)
+      if self.checkpoint["rows"] is None: self.checkpoint["rows"] = [0]*len(arrays)
+      self.checkpoint["rows"] = [r+a.shape[0] for r, a in zip(self.checkpoint["rows"], arrays)]
+      self.checkpoint["chunks"] += 1
+      yield chunk
+
+  def __call__(self):
+    if time.time()-self.t_checkpoint<self.interval: return None
+    self.checkpoint["state"] = self.iterator.checkpoint() if hasattr(self.iterator, "checkpoint") else None
+    self.checkpoint["computation_time"] = time.time()-self.t_start
+    data = pickle.dumps(self.checkpoint) # the state now, after the chunks written so far
+    def store():
+      with open(self.checkpoint_path+".tmp", "wb") as f: f.write(data)
+      os.replace(self.checkpoint_path+".tmp", self.checkpoint_path)
+      self.t_checkpoint = time.time()
+    return store
+
+def _concatenate_chunks(chunks):
+  if type(chunks[0])==tuple: return tuple(np.concatenate(c) for c in zip(*chunks))
+  return np.concatenate(chunks)
+
+def _incremental(applied, backend, path, index):
+  # pass on the output of an apply() iterator with a stateless bodyfun, reusing the output
+  # chunks of the finished result at path whose input chunk and bodyfun are unchanged; the
+  # key and rows of each output chunk are appended to index
+  from .fingerprint import fingerprint
+
+  previous = {} # key -> sample range in the previous result
+  try:
+    if os.path.exists(path) and backend.finished(path):
+      stored = json.loads(backend.attrs(path).get("chunk_index", "null"))
+      if stored is not None:
+        old = backend.open(path)
+        ends = np.cumsum(stored["rows"])
+        for key, rows, end in zip(stored["keys"], stored["rows"], ends.tolist()):
+          if rows>0: previous[key] = (end-rows, end)
+  except Exception:
+    previous = {}
+
+  operation = fingerprint(applied.bodyfun)
+  counter = getattr(applied.bodyfun, "has_counter", False)
+  for chunk_i, chunk in enumerate(applied._input()):
+    key = fingerprint(operation, chunk, chunk_i if counter else None)
+    if key in previous:
+      out = _concatenate_chunks(list(old.range(*previous[key])))
+      index["reused"] += 1
+    else:
+      applied.applier.chunk_i = chunk_i
+      out, carry = applied.applier.push(chunk)
+    index["keys"].append(key)
+    index["rows"].append((out[0] if type(out)==tuple else out).shape[0])
+    yield (out, None) if applied.yield_carry else out
+
 default_cachedir = "cache"
-def cache(iterator, *identifiers, active=True, cachedir=None, verbose=True):
+default_cache_manager = None
+default_memory_cache = None
+def cache(iterator, *identifiers, active=True, cachedir=None, verbose=True, backend="h5", cache_manager=None, checkpoint_interval=None, memory_cache=None, auto=False, incremental=False, **kwargs):
   """Cache an iterator's output to disk for repeated consumption.
 
   Generator expressions can't be rewound — you can't consume the same one
@@ -475,12 +1607,63 @@ def cache(iterator, *identifiers, active=True, cachedir=None, verbose=True):
           If empty, a random UUID is used with a temporary directory.
       active (bool): If ``False``, computation is skipped (pass-through with
           an :class:`IdentifierIterator` wrapper).
-      cachedir (str, optional): Cache directory.  Defaults to ``"cache"``.
+      cachedir (str, optional): Cache directory.  Defaults to the directory
+          of *cache_manager*, or to ``"cache"``.
       verbose (bool): Print progress and cache status.
+      backend (str or CacheBackend): Storage format, a :class:`CacheBackend`
+          instance or the name of one in ``cache_backends``: ``"h5"`` (the
+          default) or ``"directory"`` (see :class:`IterableDirectoryChunks`).
+      **kwargs: Passed on to the writer of the backend (:func:`chunks_to_h5`
+          for ``"h5"``) when computing, e.g. ``writebehind=2`` to overlap
+          the computation with compression and writing, or ``complib``,
+          ``complevel``, ``shuffle`` and ``threads`` to configure the
+          compression.
+      cache_manager (CacheManager, None): Prune the cache directory with
+          this :class:`CacheManager` after each call, keeping the returned
+          entry.  Defaults to ``default_cache_manager``.
+      checkpoint_interval (float, None): Make the computation resumable by
+          storing a checkpoint next to the cache entry every
+          *checkpoint_interval* seconds, recording the number of chunks
+          stored and the state of *iterator*.  A checkpoint is stored once
+          the writer has flushed the chunks before it, including those
+          queued with *writebehind* or *threads*, so the computation can
+          also be resumed after a crash.  If a computation is
+          interrupted, the next call with the same identifiers keeps the
+          chunks stored up to the last checkpoint and continues from there.
+          Iterators returned by :func:`apply` (also with :func:`chain`) are
+          resumed with their carry and input position, see there; other
+          iterators are fast-forwarded by pulling and discarding the chunks
+          already stored.  Not together with *skip* or *preprocessor*.
+      memory_cache (MemoryCache, None): Keep small results in memory after
+          they have been computed or read once, see :class:`MemoryCache`.
+          The returned iterable is then an :class:`IterableMemoryChunks`
+          wrapping the on-disk one.  Defaults to ``default_memory_cache``.
+      auto (bool): Add :func:`fingerprint` of *iterator* to the
+          identifiers, so that the result is recomputed whenever the code,
+          the captured values or arrays, or the input identifiers of the
+          computation change.  *identifiers* are then optional, and the
+          first one (by default ``"auto"``) only names the cache entry.
+      incremental (bool): Memoize the result per chunk, for an *iterator*
+          returned by :func:`apply` with a bodyfun without carry.  Each
+          output chunk is stored with a hash of its input chunk and of the
+          bodyfun, and when called again, even if the entry is complete, the
+          input is read and hashed again, and only output chunks whose input
+          chunk or bodyfun has changed are recomputed; the others are read
+          from the previous result.  This suits inputs that grow or are
+          partially rewritten while their identifiers stay the same.  Not
+          together with *checkpoint_interval* or *auto* (which would change
+          the identifiers with the input).
+
+  Concurrent calls with the same identifiers, also from other processes,
+  compute the result only once: the first one holds a lock file next to
+  the entry while it computes, and the others wait for it and then read the
+  result.  The result is written to a partial entry, which is renamed when
+  it is complete, so an entry is never seen half-written.
 
   Returns:
       :class:`IterableH5Chunks` or :class:`IdentifierIterator`: An iterable
-      reading from the cached HDF5 file, or a pass-through wrapper.
+      reading from the cache (of the backend's type), or a pass-through
+      wrapper.
 
   Example:
       >>> import numpy as np, chunkiter
@@ -494,6 +1677,15 @@ def cache(iterator, *identifiers, active=True, cachedir=None, verbose=True):
       >>> half = (c / 2 for c in fftdata)
       >>> double = (c * 2 for c in fftdata)
   """
+  if incremental:
+    if not isinstance(iterator, _ApplyIterator) or getattr(iterator.bodyfun, "has_carry", False):
+      raise ValueError("incremental requires an iterator returned by apply() with a bodyfun without carry")
+    if checkpoint_interval is not None or auto: raise ValueError("incremental does not support checkpoint_interval and auto")
+
+  if auto:
+    from .fingerprint import fingerprint
+    identifiers = (identifiers or ("auto",)) + (fingerprint(iterator),)
+
   tempdir = None
   if len(identifiers):
     identifier, *input_identifiers = identifiers
@@ -511,7 +1703,12 @@ def cache(iterator, *identifiers, active=True, cachedir=None, verbose=True):
   else:
     input_identifier = "0"
 
-  filename = identifier+"."+version+"."+input_identifier+".h5"
+  if type(backend)==str: backend = cache_backends[backend]
+  if cache_manager is None: cache_manager = default_cache_manager
+  if cache_manager is not None and cachedir is None: cachedir = cache_manager.cachedir
+  if memory_cache is None: memory_cache = default_memory_cache
+
+  filename = identifier+"."+version+"."+input_identifier+backend.suffix
   cachedir = cachedir if cachedir is not None else default_cachedir
   path = os.path.join(cachedir, filename)
 
@@ -520,45 +1717,87 @@ def cache(iterator, *identifiers, active=True, cachedir=None, verbose=True):
     iterator = iter(iterator) # just in case iterator is a list
     return IdentifierIterator(iterator, path)
 
-  # TO DO: clean up files with same identifier but different version
-
-  # in case we have complete cached data, return it
-  have_data = False
-  if os.path.exists(path):
-    try: have_data = array_from_h5(path, "_finished")
-    except: pass
-
-  if have_data:
+  def use():
     if verbose: print("using {}.".format(path))
-    return IterableH5Chunks(path)
-
-  # otherwise, first compute it
-  if os.path.exists(path): os.remove(path)
-
-  if verbose:
-    tb = "".join(traceback.format_stack()[:-1]).split("\n")
-    tb = "\n".join(["*"+line[1:80] for line in tb])
+    os.utime(path) # last use, for pruning
+    if cache_manager is not None and tempdir is None: cache_manager.prune(keep=[path])
+    r = backend.open(path)
+    return memory_cache.wrap(path, r) if memory_cache is not None else r
 
-    print()
-    print("*"*80)
-    print("* chunkiter.cache called from\n*")
-    print(tb)
-    print("* saving to {}.".format(path))
+  # in case we have complete cached data, return it
+  if not incremental and os.path.exists(path) and backend.finished(path): return use()
 
+  # otherwise, compute it unless another process or thread is doing so already
   os.makedirs(cachedir, exist_ok=True)
-  t_start = time.time()
-
-  chunks_to_h5(iterator, path, verbose=verbose)
-
-  t_total = time.time() - t_start
-  array_to_h5(path, "_computation_time", np.array([t_total]))
-  array_to_h5(path, "_finished", np.array([True]))
-  if verbose:
-    print("* done.")
-    print("*"*80)
-    print()
-
-  r = IterableH5Chunks(path)
+  lock = _FileLock(path+".lock")
+  if not lock.acquire(blocking=False):
+    if verbose: print("waiting for {} being computed elsewhere.".format(path))
+    lock.acquire()
+
+  try:
+    if not incremental and os.path.exists(path) and backend.finished(path): return use()
+
+    # compute into a partial entry that is published when complete, continuing an
+    # interrupted computation if possible
+    partial = path+".partial"
+    checkpoint_path = partial+".checkpoint"
+    resumed = None
+    if checkpoint_interval is not None:
+      if "skip" in kwargs or "preprocessor" in kwargs: raise ValueError("checkpoint_interval does not support skip and preprocessor")
+      if os.path.exists(partial): resumed = _resume_cache(iterator, backend, partial, checkpoint_path)
+
+    if resumed is None:
+      backend.remove(partial)
+      if os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+      checkpoint = dict(chunks=0, rows=None, state=None, computation_time=0.)
+    else:
+      iterator, checkpoint = resumed
+
+    if verbose:
+      tb = "".join(traceback.format_stack()[:-1]).split("\n")
+      tb = "\n".join(["*"+line[1:80] for line in tb])
+
+      print()
+      print("*"*80)
+      print("* chunkiter.cache called from\n*")
+      print(tb)
+      print("* saving to {}.".format(path))
+      if resumed is not None: print("* resuming after chunk {}.".format(checkpoint["chunks"]))
+
+    t_start = time.time() - checkpoint["computation_time"]
+
+    if checkpoint_interval is not None:
+      iterator = _Checkpointer(iterator, checkpoint_path, checkpoint_interval, checkpoint, t_start)
+      kwargs["checkpoint"] = iterator
+    if incremental:
+      index = dict(keys=[], rows=[], reused=0)
+      iterator = _incremental(iterator, backend, path, index)
+    if memory_cache is not None and resumed is None:
+      iterator = memory_cache.collect(path, iterator)
+    backend.write(iterator, partial, verbose=verbose, append=resumed is not None, **kwargs)
+
+    t_total = time.time() - t_start
+    attrs = dict(computation_time=t_total, identifier=identifier, version=version, input_identifier=input_identifier)
+    if incremental:
+      if verbose: print("* reused {} of {} chunks.".format(index.pop("reused"), len(index["keys"])))
+      else: index.pop("reused")
+      attrs["chunk_index"] = json.dumps(index)
+    backend.finish(partial, attrs)
+    backend.remove(path) # unfinished data of an older version of chunkiter
+    os.replace(partial, path)
+    if os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+    if verbose:
+      print("* done.")
+      print("*"*80)
+      print()
+
+  finally:
+    lock.release()
+
+  if cache_manager is not None and tempdir is None: cache_manager.prune(keep=[path])
+
+  r = backend.open(path)
+  if memory_cache is not None: r = memory_cache.wrap(path, r)
   if tempdir is not None: r.__tempdir = tempdir # so that tempdir will not be deleted as long as r exists
 
   return r
@@ -596,48 +1835,54 @@ def pre_rechunk(data, chunk_size, overlap_size=0):
       (10, 3)
   """
 
-  if not chunk_size-overlap_size>0: raise ValueError("need chunk_size>overlap_size")
-
-  input_chunks = [next(data)]
-  input_start_i = 0
-  input_stop_i = input_chunks[0].shape[0]
-  output_start_i = 0
-
-  while True:
-    # clean up unneeded input chunks at head
-    while len(input_chunks) and output_start_i>input_start_i+input_chunks[0].shape[0]:
-      input_start_i += input_chunks[0].shape[0]
-      input_chunks.pop(0)
-
-    # extend tail of input chunks as needed
-    while output_start_i+chunk_size>input_stop_i:
-      try:
-        next_chunk = next(data)
-      except StopIteration:
-        break
-      input_chunks.append(next_chunk)
-      input_stop_i += input_chunks[-1].shape[0]
-
-    # prepare list of views that can be concatenated
+  rechunker = _Rechunker(chunk_size, overlap_size)
+  for chunk in data:
+    yield from rechunker.push(chunk)
+  yield from rechunker.flush()
+
+class _Rechunker(object):
+  # push-style core of pre_rechunk, shared with the asyncio variant: push() returns the
+  # views of the output chunks completed by an input chunk, flush() those of the remainder
+  def __init__(self, chunk_size, overlap_size=0):
+    if not chunk_size-overlap_size>0: raise ValueError("need chunk_size>overlap_size")
+    self.chunk_size = chunk_size
+    self.overlap_size = overlap_size
+    self.input_chunks = collections.deque()
+    self.input_start_i = 0
+    self.input_stop_i = 0
+    self.output_start_i = 0
+
+  def _views(self, stop):
+    # views of the input chunks from output_start_i to stop
     ret = []
-    skip = output_start_i-input_start_i
-    N = 0
-    for chunk in input_chunks:
-      # skip beginning to start at output_start_i
-      chunk_relevantpart = chunk[skip:,...]
-      skip -= chunk.shape[0]-chunk_relevantpart.shape[0]
+    skip = self.output_start_i-self.input_start_i
+    N = stop-self.output_start_i
+    for chunk in self.input_chunks:
+      chunk_relevantpart = chunk[skip:skip+N,...]
+      skip = max(skip-chunk.shape[0], 0)
+      N -= chunk_relevantpart.shape[0]
+      if chunk_relevantpart.shape[0]>0: ret.append(chunk_relevantpart)
+    return tuple(ret)
 
-      # skip end to get exactly chunk size
-      chunk_relevantpart = chunk_relevantpart[:chunk_size-N,...]
-      N += chunk_relevantpart.shape[0]
+  def push(self, chunk):
+    self.input_chunks.append(chunk)
+    self.input_stop_i += chunk.shape[0]
 
-      if chunk_relevantpart.shape[0]>0: ret.append(chunk_relevantpart)
+    ret = []
+    while self.output_start_i+self.chunk_size<=self.input_stop_i:
+      ret.append(self._views(self.output_start_i+self.chunk_size))
+      self.output_start_i += self.chunk_size-self.overlap_size
 
-    if N>0: yield tuple(ret)
+      # clean up unneeded input chunks at head
+      while len(self.input_chunks) and self.output_start_i>=self.input_start_i+self.input_chunks[0].shape[0]:
+        self.input_start_i += self.input_chunks[0].shape[0]
+        self.input_chunks.popleft()
 
-    if N<chunk_size: break
+    return ret
 
-    output_start_i += chunk_size-overlap_size
+  def flush(self):
+    if self.output_start_i>=self.input_stop_i: return []
+    return [self._views(self.input_stop_i)]
 
 def combine_chunks(data, factor):
   return (np.concatenate(i,axis=0) for i in itertools.batched(data, factor))
@@ -680,16 +1925,21 @@ def rechunk(data, chunk_size, overlap_size=0, padding=False, concatenate=np.conc
   data = pre_rechunk(data, chunk_size, overlap_size)
 
   for arrays_for_concatenation in data:
-    if padding:
-      actual_size = sum(a.shape[0] for a in arrays_for_concatenation)
-      dtype = arrays_for_concatenation[-1].dtype
-      shape = (chunk_size-actual_size,) + arrays_for_concatenation[-1].shape[1:]
-      arrays_for_concatenation = arrays_for_concatenation + (np.zeros(shape, dtype=dtype),)
+    yield from _concatenate_rechunked(arrays_for_concatenation, chunk_size, padding, concatenate, yield_remainder)
 
-      if actual_size==chunk_size or yield_remainder: yield actual_size, concatenate(arrays_for_concatenation)
-    else:
-      arr = concatenate(arrays_for_concatenation)
-      if arr.shape[0]==chunk_size or yield_remainder: yield arr
+def _concatenate_rechunked(arrays_for_concatenation, chunk_size, padding, concatenate, yield_remainder):
+  # output chunk of rechunk from the views of pre_rechunk (none for a suppressed remainder)
+  if padding:
+    actual_size = sum(a.shape[0] for a in arrays_for_concatenation)
+    dtype = arrays_for_concatenation[-1].dtype
+    shape = (chunk_size-actual_size,) + arrays_for_concatenation[-1].shape[1:]
+    arrays_for_concatenation = arrays_for_concatenation + (np.zeros(shape, dtype=dtype),)
+
+    if actual_size==chunk_size or yield_remainder: return [(actual_size, concatenate(arrays_for_concatenation))]
+  else:
+    arr = concatenate(arrays_for_concatenation)
+    if arr.shape[0]==chunk_size or yield_remainder: return [arr]
+  return []
 
 ###
 
@@ -746,6 +1996,17 @@ def apply(bodyfun, iterator, yield_carry=False):
   The *carry* for the first iteration is ``bodyfun.initial_carry`` (if set)
   or ``None``.
 
+  The returned iterator can be resumed after an interruption (see the
+  *checkpoint_interval* of :func:`cache`): its ``checkpoint()`` method
+  returns the carry, the chunk counter and the input position after the
+  chunks yielded so far, and ``resume(state)`` returns a new iterator
+  continuing from such a checkpoint.  An input with a ``range`` method, like
+  :class:`IterableH5Chunks`, is resumed by seeking to the next sample, an
+  input that is itself resumable by its own ``resume``; other inputs are
+  fast-forwarded by pulling the chunks consumed so far without passing them
+  to *bodyfun*.  Checkpoints must be picklable to be stored by
+  :func:`cache`, and so must the carry.
+
   Args:
       bodyfun (callable): Callback (auto-normalized by :func:`normalize_bodyfun`).
       iterator: Iterator yielding chunks.
@@ -767,17 +2028,77 @@ def apply(bodyfun, iterator, yield_carry=False):
       >>> list(chunkiter.apply(running_sum, chunks))
       [array([1, 3, 6]), array([10, 15, 21])]
   """
-  bodyfun = normalize_bodyfun(bodyfun)
+  return _ApplyIterator(bodyfun, iterator, yield_carry)
+
+class _ApplyIterator(object):
+  # iterator returned by apply, which tracks its input position for checkpoint() and resume()
+  def __init__(self, bodyfun, iterator, yield_carry, applier=None, position=(0, 0)):
+    self.bodyfun = bodyfun
+    self.source = iterator
+    self.iterator = None # created on the first chunk, so that e.g. prefetching only starts then
+    self.yield_carry = yield_carry
+    self.applier = applier if applier is not None else _Applier(bodyfun)
+    self.chunks, self.samples = position # input consumed so far
+
+  def _input(self):
+    if self.iterator is None: self.iterator = iter(self.source)
+    return self.iterator
 
-  carry = None
-  for chunk_i, chunk in enumerate(iterator):
-    if chunk_i==0:
-      if hasattr(bodyfun, "initial_carry"): chunk, carry = bodyfun(chunk_i, chunk, bodyfun.initial_carry)
-      else: chunk, carry = bodyfun(chunk_i, chunk)
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    chunk = next(self._input())
+    self.chunks += 1
+    self.samples += (chunk[0] if type(chunk)==tuple else chunk).shape[0]
+    chunk, carry = self.applier.push(chunk)
+    return (chunk, carry) if self.yield_carry else chunk
+
+  def checkpoint(self):
+    return dict(
+      chunk_i = self.applier.chunk_i,
+      carry = self.applier.carry,
+      chunks = self.chunks,
+      samples = self.samples,
+      source = self.iterator.checkpoint() if hasattr(self.iterator, "checkpoint") else None,
+    )
+
+  def resume(self, state):
+    if hasattr(self.source, "range"):
+      iterator = self.source.range(state["samples"])
+    elif state["source"] is not None and hasattr(self._input(), "resume"):
+      iterator = self._input().resume(state["source"])
+    else:
+      iterator = iter(self.source)
+      for chunk in itertools.islice(iterator, state["chunks"]): pass
+
+    applier = _Applier(self.bodyfun)
+    applier.chunk_i = state["chunk_i"]
+    applier.carry = state["carry"]
+    return _ApplyIterator(self.bodyfun, iterator, self.yield_carry, applier, (state["chunks"], state["samples"]))
+
+  def close(self):
+    # like the close() of a generator, stops the input, e.g. its prefetching thread
+    iterator = self.iterator if self.iterator is not None else self.source
+    if hasattr(iterator, "close"): iterator.close()
+
+class _Applier(object):
+  # push-style core of apply, shared with the asyncio variant: push() returns the
+  # processed chunk and the new carry
+  def __init__(self, bodyfun):
+    self.bodyfun = normalize_bodyfun(bodyfun)
+    self.chunk_i = 0
+    self.carry = None
+
+  def push(self, chunk):
+    if self.chunk_i==0:
+      if hasattr(self.bodyfun, "initial_carry"): chunk, self.carry = self.bodyfun(self.chunk_i, chunk, self.bodyfun.initial_carry)
+      else: chunk, self.carry = self.bodyfun(self.chunk_i, chunk)
     else:
-      chunk, carry = bodyfun(chunk_i, chunk, carry)
+      chunk, self.carry = self.bodyfun(self.chunk_i, chunk, self.carry)
 
-    yield (chunk, carry) if yield_carry else chunk
+    self.chunk_i += 1
+    return chunk, self.carry
 
 def chain(*bodyfuns):
   """Compose multiple body functions for sequential application with :func:`apply`.
@@ -0,0 +1,472 @@
+"""
+parallel apply of bodyfuns on a process pool, handing chunks through shared memory, or on a thread pool
+"""
+
+import os
+import weakref
+import collections
+import contextlib
+import concurrent.futures
+
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+try: import threadpoolctl # for limiting the threads of BLAS/OpenMP libraries
+except ImportError: threadpoolctl = None
+
+from ..functions import normalize_bodyfun, _ordered_map
+from ..shm import _align, _Mapping
+
+__all__ = ['parallel_apply', 'threaded_apply', 'threaded_per_entry']
+
+def _layout(arrays):
+  # offsets of arrays within a segment, and the segment size needed
+  offsets = []
+  pos = 0
+  for a in arrays:
+    offsets.append(pos)
+    pos = _align(pos+a.nbytes)
+  return offsets, max(pos, 1)
+
+def _write(mapped, arrays):
+  # copy arrays into a mapped segment, returning their (offset, dtype, shape)
+  offsets, size = _layout(arrays)
+  for a, offset in zip(arrays, offsets):
+    np.copyto(mapped[offset:offset+a.nbytes].view(a.dtype).reshape(a.shape), a)
+  return [(offset, a.dtype.str, a.shape) for a, offset in zip(arrays, offsets)]
+
+def _read(mapped, layout):
+  # views of the arrays written by _write
+  return [mapped[offset:offset+np.dtype(dtype).itemsize*int(np.prod(shape))].view(dtype).reshape(shape) for offset, dtype, shape in layout]
+
+def _shm_arrays(value):
+  # entries of a chunk if it can be handed through shared memory, else None
+  arrays = value if type(value)==tuple else (value,)
+  if not all(isinstance(a, np.ndarray) and not a.dtype.hasobject for a in arrays): return None
+  return [np.asarray(a) for a in arrays] # e.g. np.memmap chunks of IterableMemmapChunks
+
+# --- worker side ---
+
+_worker = {} # bodyfun and the segments attached by this worker process, per slot
+
+def _init_worker(bodyfun):
+  _worker["bodyfun"] = normalize_bodyfun(bodyfun)
+  _worker["segments"] = {}
+
+def _segment(slot, name):
+  # attached segment of a slot, re-attached when the parent has replaced it; the parent's
+  # resource tracker is shared, so the segment is not unregistered here
+  segments = _worker["segments"]
+  if (slot, name) not in segments:
+    for key in [key for key in segments if key[0]==slot]: del segments[key] # unmapped with the last view
+    shm = shared_memory.SharedMemory(name)
+    segments[(slot, name)] = (shm, np.asarray(_Mapping(shm)))
+  return segments[(slot, name)][1]
+
+def _run(slot, chunk_i, input_name, layout, is_tuple, output_name, output_size):
+  arrays = _read(_segment(slot, input_name), layout)
+  chunk, carry = _worker["bodyfun"](chunk_i, tuple(arrays) if is_tuple else arrays[0])
+
+  arrays = _shm_arrays(chunk)
+  if arrays is None: return False, chunk, 0
+  size = _layout(arrays)[1]
+  if size>output_size: return False, chunk, size # the parent enlarges the output segment
+  return True, _write(_segment(slot, output_name), arrays), type(chunk)==tuple
+
+# --- parent side ---
+
+class _Slot(object):
+  # input and output segment for one chunk in flight
+  def __init__(self, i):
+    self.i = i
+    self.input = None
+    self.output = None
+
+  def _resize(self, segment, size):
+    if segment is not None and segment[0].size>=size: return segment
+    _release(segment)
+    shm = shared_memory.SharedMemory(create=True, size=int(size*1.25)) # headroom for varying chunk sizes
+    return shm, np.asarray(_Mapping(shm))
+
+  def submit(self, pool, chunk_i, chunk, output_size):
+    arrays = _shm_arrays(chunk)
+    if arrays is None: raise TypeError("parallel_apply needs chunks of np.ndarray (or tuples thereof)")
+    self.input = self._resize(self.input, _layout(arrays)[1])
+    self.output = self._resize(self.output, output_size)
+    layout = _write(self.input[1], arrays)
+    return pool.submit(_run, self.i, chunk_i, self.input[0].name, layout, type(chunk)==tuple, self.output[0].name, self.output[0].size)
+
+  def result(self, future, copy):
+    # returns the result and the output segment size it needs
+    in_shm, value, extra = future.result()
+    if not in_shm: return value, extra
+    arrays = _read(self.output[1], value)
+    if copy: arrays = [a.copy() for a in arrays]
+    return (tuple(arrays) if extra else arrays[0]), 0
+
+  def release(self):
+    for segment in (self.input, self.output): _release(segment)
+
+def _release(segment):
+  # unlink a segment; it stays mapped as long as arrays viewing it exist
+  if segment is not None: segment[0].unlink()
+
+def parallel_apply(bodyfun, iterator, workers=None, max_inflight=None, copy=True, mp_context=None):
+  """Apply a stateless bodyfun to chunks on a process pool, yielding the results in order.
+
+  Like :func:`apply` for a bodyfun without carry, but evaluates up to
+  *max_inflight* chunks concurrently on *workers* processes, so that
+  per-chunk transforms like FFTs and filters use several cores.  Chunks
+  are not pickled: each chunk in flight has a slot of two shared-memory
+  segments, the input chunk is copied into the first one, the worker
+  process reads it from there and writes the result into the second one.
+  Slots grow with the chunks; a result that does not fit (or is not an
+  ``np.ndarray``) is pickled once, and the slot is enlarged.  At most
+  *max_inflight* chunks are read ahead, which bounds the memory used.
+
+  The bodyfun is sent to the worker processes once.  With the ``fork``
+  start method (default on Linux up to Python 3.13) it can be any
+  callable; with ``spawn`` or ``forkserver`` it must be picklable, e.g. a
+  module-level function.
+
+  Args:
+      bodyfun (callable): Body function without carry, see :func:`apply`.
+          ``has_counter`` is supported.
+      iterator: Iterator yielding ``np.ndarray`` chunks (or tuples thereof).
+      workers (int, None): Number of worker processes.  ``None`` uses
+          ``os.cpu_count()``.
+      max_inflight (int, None): Maximum number of chunks being processed or
+          waiting to be yielded.  ``None`` uses ``2*workers``.
+      copy (bool): Yield copies of the results.  If ``False``, yield views
+          of the shared memory, which stay valid until the next chunk is
+          pulled; copy them if you need them for longer.
+      mp_context: ``multiprocessing`` context, e.g.
+          ``multiprocessing.get_context("spawn")``.  ``None`` uses the
+          default start method.
+
+  Raises:
+      ValueError: If *bodyfun* has a carry (``has_carry``), as the chunks
+          would depend on each other; use :func:`apply` for these.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Processed chunks, in input order.
+
+  Example:
+      >>> source = chunkiter.IterableH5Chunks("test.h5", "data")
+      >>> spectra = chunkiter.parallel_apply(np.fft.fft, source, workers=8)
+      >>> chunkiter.chunks_to_h5(spectra, "output.h5")
+  """
+  if getattr(bodyfun, "has_carry", False):
+    raise ValueError("parallel_apply needs a bodyfun without carry, use apply() for bodyfuns with has_carry")
+  if workers is None: workers = os.cpu_count()
+  if max_inflight is None: max_inflight = 2*workers
+  return _parallel_apply(bodyfun, iterator, workers, max_inflight, copy, mp_context)
+
+def _parallel_apply(bodyfun, iterator, workers, max_inflight, copy, mp_context):
+  resource_tracker.ensure_running() # shared with the workers, which attach to the segments
+  slots = [_Slot(i) for i in range(max_inflight)]
+  free = collections.deque(slots)
+  pending = collections.deque() # (future, slot), oldest first
+  output_size = 0 # largest result so far
+
+  pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=mp_context, initializer=_init_worker, initargs=(bodyfun,))
+  try:
+    chunks = enumerate(iterator)
+    exhausted = False
+    while True:
+      while len(free) and not exhausted:
+        try: chunk_i, chunk = next(chunks)
+        except StopIteration:
+          exhausted = True
+          break
+        if output_size==0: output_size = _layout(_shm_arrays(chunk) or ())[1]
+        slot = free.popleft()
+        pending.append((slot.submit(pool, chunk_i, chunk, output_size), slot))
+
+      if not len(pending): break
+      future, slot = pending.popleft()
+      chunk, needed = slot.result(future, copy)
+      output_size = max(output_size, needed)
+      yield chunk
+      free.append(slot) # only now, as the yielded chunk may view its output segment
+
+  finally:
+    for future, slot in pending: future.cancel()
+    pool.shutdown(wait=True)
+    for slot in slots: slot.release()
+
+def _limits(blas_threads):
+  # limit the thread pools of BLAS/OpenMP libraries; the limit is process-wide
+  if blas_threads is None: return contextlib.nullcontext()
+  if threadpoolctl is None: raise ImportError("blas_threads requires the threadpoolctl package")
+  return threadpoolctl.threadpool_limits(limits=blas_threads)
+
+def threaded_apply(bodyfun, iterator, threads=None, max_inflight=None, blas_threads=None):
+  """Apply a stateless bodyfun to chunks on a thread pool, yielding the results in order.
+
+  Like :func:`parallel_apply`, but with threads, for bodyfuns that spend
+  their time in code releasing the GIL, like ``np.fft``, most of
+  ``scipy.signal`` and ufuncs on large arrays.  Chunks are passed without
+  any copy, and the results are new arrays.  At most *max_inflight* chunks
+  are read ahead.
+
+  When the bodyfun uses BLAS or OpenMP, which have thread pools of their
+  own, *blas_threads* limits them (with ``threadpoolctl``), so that
+  *threads* times their threads do not oversubscribe the cores.  The limit
+  is process-wide while the iterator runs.
+
+  Args:
+      bodyfun (callable): Body function without carry, see :func:`apply`.
+          ``has_counter`` is supported.
+      iterator: Iterator yielding chunks.
+      threads (int, None): Number of threads.  ``None`` uses
+          ``os.cpu_count()``.
+      max_inflight (int, None): Maximum number of chunks being processed or
+          waiting to be yielded.  ``None`` uses ``2*threads``.
+      blas_threads (int, None): Threads per BLAS/OpenMP library, e.g. 1.
+          ``None`` leaves them unchanged.
+
+  Raises:
+      ValueError: If *bodyfun* has a carry (``has_carry``); see
+          :func:`threaded_per_entry` for processing the entries of tuple
+          chunks with carries concurrently.
+      ImportError: If *blas_threads* is given but ``threadpoolctl`` is not
+          installed.
+
+  Yields:
+      Processed chunks, in input order.
+
+  Example:
+      >>> source = chunkiter.IterableH5Chunks("test.h5", "data")
+      >>> spectra = chunkiter.threaded_apply(np.fft.fft, source, threads=8, blas_threads=1)
+  """
+  if getattr(bodyfun, "has_carry", False):
+    raise ValueError("threaded_apply needs a bodyfun without carry, use apply() for bodyfuns with has_carry")
+  if threads is None: threads = os.cpu_count()
+  if max_inflight is None: max_inflight = 2*threads
+  return _threaded_apply(bodyfun, iterator, threads, max_inflight, blas_threads)
+
+def _threaded_apply(bodyfun, iterator, threads, max_inflight, blas_threads):
+  bodyfun = normalize_bodyfun(bodyfun)
+  with _limits(blas_threads):
+    for chunk, carry in _ordered_map(lambda item: bodyfun(*item), enumerate(iterator), threads, max_inflight):
+      yield chunk
+
+def threaded_per_entry(*bodyfuns, threads=None):
+  """Like :func:`per_entry`, but processing the entries of each tuple chunk concurrently.
+
+  The *i*-th entry of each chunk is passed to the *i*-th bodyfun, and the
+  entries of a chunk are processed on a thread pool at the same time.
+  Carries are kept per entry, so bodyfuns with carry are supported.  If
+  none of the bodyfuns has a carry, neither has the returned bodyfun, so
+  that it can also be used with :func:`threaded_apply` to process several
+  chunks concurrently.
+
+  The threads are started on the first chunk and kept for the following
+  ones; they end when the returned bodyfun is garbage-collected.
+
+  Args:
+      *bodyfuns: One body function per tuple entry.
+      threads (int, None): Number of threads.  ``None`` uses one per entry.
+
+  Returns:
+      callable: A combined body function processing tuples.
+
+  Example:
+      >>> body = chunkiter.threaded_per_entry(np.fft.fft, np.fft.fft)
+      >>> spectra = chunkiter.apply(body, chunkiter.IterableH5Chunks("test.h5", ["x", "y"]))
+  """
+  stateful = any(getattr(bodyfun, "has_carry", False) for bodyfun in bodyfuns)
+  bodyfuns = [normalize_bodyfun(bodyfun) for bodyfun in bodyfuns]
+  initial_carry = [getattr(bodyfun, "initial_carry", None) for bodyfun in bodyfuns]
+  pool = concurrent.futures.ThreadPoolExecutor(threads if threads is not None else len(bodyfuns))
+
+  def run(chunk_i, chunk, carry):
+    futures = [pool.submit(bodyfun, chunk_i, chunk_, carry_) for bodyfun,chunk_,carry_ in zip(bodyfuns,chunk,carry)]
+    results = [future.result() for future in futures]
+    return tuple(r[0] for r in results), tuple(r[1] for r in results)
+
+  if stateful:
+    def bodyfun(chunk_i, chunk, carry=initial_carry):
+      return run(chunk_i, chunk, carry)
+    bodyfun.has_carry = True
+    bodyfun.initial_carry = initial_carry
+  else:
+    def bodyfun(chunk_i, chunk):
+      return run(chunk_i, chunk, initial_carry)[0]
+  bodyfun.has_counter = True
+
+  weakref.finalize(bodyfun, pool.shutdown, wait=False) # the pool is only referenced by bodyfun
+  return bodyfun
+
+# --- tests ---
+
+def _double(chunk):
+  return chunk*2
+
+def _rfft_with_index(chunk_i, chunk):
+  return np.fft.rfft(chunk, axis=-1), np.full(1, chunk_i)
+_rfft_with_index.has_counter = True
+
+def _summary(chunk):
+  data, labels = chunk
+  return data.sum(), labels[:1].tolist()
+
+def _fail(chunk):
+  if chunk[0]==3: raise ArithmeticError("chunk 3")
+  return chunk
+
+def _segments():
+  return set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+def test_order_and_results():
+  """Results equal serial apply, in input order, for varying chunk sizes."""
+  from chunkiter.functions import apply
+  rng = np.random.default_rng(0)
+  chunks = [rng.standard_normal((int(n), 64)) for n in rng.integers(0, 300, 40)]
+  before = _segments()
+  expected = list(apply(_double, iter(chunks)))
+  result = list(parallel_apply(_double, iter(chunks), workers=3, max_inflight=4))
+  assert len(result)==len(expected) and all(np.array_equal(r, e) for r, e in zip(result, expected))
+  assert _segments()==before
+
+def test_growing_and_tuple_results():
+  """Larger results and tuples go through shared memory, after the slots have grown."""
+  chunks = [np.random.default_rng(i).standard_normal((10*(i+1), 32)) for i in range(12)]
+  result = [(s.copy(), i.copy()) for s, i in parallel_apply(_rfft_with_index, iter(chunks), workers=2, max_inflight=3, copy=False)]
+  assert all(np.allclose(s, np.fft.rfft(c, axis=-1)) and i[0]==k for k, ((s, i), c) in enumerate(zip(result, chunks)))
+
+def test_tuple_chunks_and_other_results():
+  """Tuple chunks are handed through shared memory; other results are pickled."""
+  chunks = [(np.full(5, float(i)), np.arange(i, i+3)) for i in range(6)]
+  assert list(parallel_apply(_summary, iter(chunks), workers=2)) == [(5.*i, [i]) for i in range(6)]
+
+def test_array_subclasses():
+  """Chunks of ndarray subclasses, like the np.memmap views of IterableMemmapChunks, are accepted."""
+  import tempfile
+  from chunkiter.functions import chunks_to_binaryfile, IterableMemmapChunks
+  x = np.arange(60.).reshape(20, 3)
+  with tempfile.TemporaryDirectory() as d:
+    with open(os.path.join(d, "x.bin"), "wb") as f: chunks_to_binaryfile(iter(np.split(x, 4)), f, index=True, verbose=False)
+    result = list(parallel_apply(np.negative, IterableMemmapChunks(os.path.join(d, "x.bin")), workers=2))
+  assert np.array_equal(np.concatenate(result), -x)
+  masked = [np.ma.masked_array(c) for c in np.split(x, 4)]
+  assert np.array_equal(np.concatenate(list(parallel_apply(_double, iter(masked), workers=2))), 2*x)
+
+def test_errors():
+  """Bodyfuns with carry are refused, bodyfun errors propagate and the segments are removed."""
+  def cumsum(chunk, carry=0):
+    return chunk+carry, carry+chunk.sum()
+  cumsum.has_carry = True
+  try: parallel_apply(cumsum, iter([]))
+  except ValueError: pass
+  else: assert False
+
+  before = _segments()
+  result = []
+  try:
+    for chunk in parallel_apply(_fail, (np.full(4, i) for i in range(10)), workers=2): result.append(int(chunk[0]))
+  except ArithmeticError: pass
+  else: assert False
+  assert result==[0, 1, 2] and _segments()==before
+
+  stopped = parallel_apply(_double, (np.full(4, i) for i in range(100)), workers=2)
+  assert int(next(stopped)[0])==0
+  stopped.close()
+  assert _segments()==before
+
+def test_threaded_apply():
+  """threaded_apply yields the results of apply in order, and refuses carries."""
+  from chunkiter.functions import apply
+  rng = np.random.default_rng(1)
+  chunks = [rng.standard_normal((int(n), 16)) for n in rng.integers(1, 200, 30)]
+  expected = list(apply(_rfft_with_index, iter(chunks)))
+  result = list(threaded_apply(_rfft_with_index, iter(chunks), threads=3, max_inflight=5))
+  assert all(np.allclose(r[0], e[0]) and r[1][0]==e[1][0] for r, e in zip(result, expected)) and len(result)==len(expected)
+
+  def cumsum(chunk, carry=0):
+    return chunk+carry, carry+chunk.sum()
+  cumsum.has_carry = True
+  try: threaded_apply(cumsum, iter([]))
+  except ValueError: pass
+  else: assert False
+
+  if threadpoolctl is not None:
+    assert len(list(threaded_apply(np.linalg.inv, (np.eye(50)*i for i in range(1, 5)), threads=2, blas_threads=1)))==4
+  else:
+    try: threaded_apply(np.abs, iter([]), blas_threads=1).__next__()
+    except ImportError: pass
+    else: assert False
+
+def test_threaded_per_entry():
+  """threaded_per_entry matches per_entry, with carries, and without for threaded_apply."""
+  from chunkiter.functions import apply, per_entry
+  def cumsum(chunk, carry=0):
+    out = np.cumsum(chunk)+carry
+    return out, out[-1]
+  cumsum.has_carry = True
+  cumsum.initial_carry = 0
+  chunks = [(np.arange(5.)+i, np.ones(3)*i) for i in range(6)]
+
+  expected = list(apply(per_entry(cumsum, _double), iter(chunks)))
+  result = list(apply(threaded_per_entry(cumsum, _double), iter(chunks)))
+  assert all(np.array_equal(r[0], e[0]) and np.array_equal(r[1], e[1]) for r, e in zip(result, expected))
+
+  stateless = threaded_per_entry(_double, np.negative)
+  result = list(threaded_apply(stateless, iter(chunks), threads=2))
+  assert all(np.array_equal(r[0], c[0]*2) and np.array_equal(r[1], -c[1]) for r, c in zip(result, chunks))
+
+def test_threaded_per_entry_threads_end():
+  """The threads of a threaded_per_entry bodyfun end with it."""
+  import gc
+  import time
+  import threading
+  from chunkiter.functions import apply
+  threads = set(threading.enumerate())
+  for i in range(5):
+    result = list(apply(threaded_per_entry(_double, np.negative), iter([(np.ones(3), np.ones(2))]*3)))
+  gc.collect()
+  for i in range(100):
+    if not set(threading.enumerate())-threads: break
+    time.sleep(0.01)
+  assert not set(threading.enumerate())-threads
+
+# --- timing comparison ---------------------------------------
+
+def test_timing():
+  """Compare wall-clock time of apply, threaded_apply and parallel_apply for an FFT per chunk.
+
+  128 MB of complex128 in chunks of 128 KB to 32 MB, with as many threads or
+  workers as cores.
+  """
+  import time
+  from chunkiter.functions import apply
+
+  cores = os.cpu_count()
+  data = np.random.default_rng(0).standard_normal((4096, 2048)).astype(np.complex128)
+  print()
+  print(f"--- Timing comparison (FFT of {data.nbytes/1024**2:.0f} MB, {cores} cores) ---")
+  print(f"  {'chunk':>8} {'apply':>8} {'threads':>8} {'processes':>10}")
+  for rows in (4, 64, 1024):
+    chunks = [data[i:i+rows] for i in range(0, data.shape[0], rows)]
+    times = []
+    for run in (lambda: apply(np.fft.fft, iter(chunks)),
+                lambda: threaded_apply(np.fft.fft, iter(chunks), threads=cores),
+                lambda: parallel_apply(np.fft.fft, iter(chunks), workers=cores, copy=False)):
+      t0 = time.perf_counter()
+      for c in run(): pass
+      times.append(time.perf_counter()-t0)
+    print(f"  {chunks[0].nbytes//1024:>6}KB {times[0]:>7.3f}s {times[1]:>7.3f}s {times[2]:>9.3f}s")
+  print("  ✓ timing comparison ok")
+
+
+if __name__ == "__main__":
+  tests = [test_order_and_results, test_growing_and_tuple_results, test_tuple_chunks_and_other_results, test_array_subclasses,
+           test_errors,
+           test_threaded_apply, test_threaded_per_entry, test_threaded_per_entry_threads_end, test_timing]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
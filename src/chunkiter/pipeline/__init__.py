@@ -0,0 +1,326 @@
+"""
+stage-parallel pipelines: each stage in its own thread or process, connected by bounded queues
+"""
+
+import time
+import queue
+import threading
+import collections
+import multiprocessing
+
+from ..functions import _background_iter
+
+__all__ = ['pipeline', 'StageStats']
+
+StageStats = collections.namedtuple("StageStats", ["name", "chunks", "busy", "starved", "blocked"])
+StageStats.__doc__ = """Time spent by a pipeline stage, in seconds.
+
+Attributes:
+    name (str): Name of the stage.
+    chunks (int): Number of chunks it produced.
+    busy (float): Time spent computing (or reading, for the source).
+    starved (float): Time spent waiting for input from the previous stage.
+    blocked (float): Time spent waiting for the next stage (or the consumer
+        of the pipeline) to take its output.
+"""
+
+def _name(stage):
+  return getattr(stage, "__qualname__", None) or getattr(stage, "__name__", None) or type(stage).__name__
+
+class _StageTimer(object):
+  # measures the time a stage spends in producing chunks, and the part of it spent waiting for input
+  def __init__(self, name):
+    self.name = name
+    self.chunks = 0
+    self.running = 0.
+    self.waiting = 0.
+    self.wall = 0.
+    self.t_start = None
+    self.finished = False
+
+  def input(self, iterator):
+    iterator = iter(iterator)
+    while True:
+      t0 = time.perf_counter()
+      try: item = next(iterator)
+      except StopIteration: return
+      finally: self.waiting += time.perf_counter()-t0
+      yield item
+
+  def output(self, iterable):
+    self.t_start = time.perf_counter()
+    iterator = iter(iterable)
+    try:
+      while True:
+        t0 = time.perf_counter()
+        try: item = next(iterator)
+        except StopIteration: return
+        finally: self.running += time.perf_counter()-t0
+        self.chunks += 1
+        yield item
+    finally:
+      self.wall = time.perf_counter()-self.t_start
+      self.finished = True
+      if hasattr(iterator, "close"): iterator.close()
+
+  def totals(self):
+    wall = self.wall if self.finished or self.t_start is None else time.perf_counter()-self.t_start
+    return (self.name, self.chunks, self.running, self.waiting, wall)
+
+def _stats(totals):
+  name, chunks, running, waiting, wall = totals
+  return StageStats(name, chunks, running-waiting, waiting, max(0., wall-running))
+
+# --- processes ---
+
+def _put(q, item, stop):
+  # put into a multiprocessing queue, giving up when stop is set
+  while not stop.is_set():
+    try: return q.put(item, timeout=0.1)
+    except queue.Full: pass
+
+def _receive(q, upstream, stop=None):
+  # chunks from a queue of a stage process, until the end marker, which carries the totals of
+  # the previous stages, or until stop is set
+  while True:
+    if stop is None: ok, item, totals = q.get()
+    else:
+      try: ok, item, totals = q.get(timeout=0.1)
+      except queue.Empty:
+        if stop.is_set(): return
+        continue
+    if not ok:
+      upstream.extend(totals)
+      if item is not None: raise item
+      return
+    yield item
+
+def _stage_process(stage, name, input_queue, output_queue, stop):
+  # runs until the end of its input, or until the consumer of the pipeline sets stop
+  timer = _StageTimer(name)
+  upstream = []
+  try:
+    for item in timer.output(stage(timer.input(_receive(input_queue, upstream, stop)))):
+      _put(output_queue, (True, item, None), stop)
+      if stop.is_set(): break
+  except BaseException as e:
+    _put(output_queue, (False, e, upstream+[timer.totals()]), stop)
+  else:
+    _put(output_queue, (False, None, upstream+[timer.totals()]), stop)
+  if stop.is_set(): output_queue.cancel_join_thread() # nobody reads the chunks still buffered
+
+def _feed(source, timer, output_queue, stop):
+  try:
+    for item in timer.output(source):
+      _put(output_queue, (True, item, None), stop)
+      if stop.is_set(): break
+  except BaseException as e:
+    _put(output_queue, (False, e, [timer.totals()]), stop)
+  else:
+    _put(output_queue, (False, None, [timer.totals()]), stop)
+
+class _Pipeline(object):
+  # iterator over the output of a pipeline, with the statistics of its stages
+  def __init__(self, stages, queue_size, processes, verbose):
+    self.names = [_name(stage) for stage in stages]
+    self.verbose = verbose
+    self.processes = []
+    self.timers = [_StageTimer(name) for name in self.names]
+    self.totals = None # of all stages, once the process stages are done
+
+    if not processes:
+      iterator = self.timers[0].output(stages[0])
+      for timer, stage in zip(self.timers[1:], stages[1:]):
+        iterator = timer.output(stage(timer.input(_background_iter(iterator, queue_size))))
+      self.iterator = _background_iter(iterator, queue_size) # the last stage in its own thread, too
+    else:
+      self.upstream = []
+      self.iterator = self._run_processes(stages, queue_size)
+
+  def _run_processes(self, stages, queue_size):
+    # started on the first chunk, like the threads of _background_iter
+    self.stop = multiprocessing.Event()
+    queues = [multiprocessing.Queue(queue_size) for stage in stages]
+    feeder = threading.Thread(target=_feed, args=(stages[0], self.timers[0], queues[0], self.stop), daemon=True)
+    feeder.start()
+    for name, stage, input_queue, output_queue in zip(self.names[1:], stages[1:], queues[:-1], queues[1:]):
+      process = multiprocessing.Process(target=_stage_process, args=(stage, name, input_queue, output_queue, self.stop), daemon=True)
+      process.start()
+      self.processes.append(process)
+    yield from self._receive(queues[-1])
+
+  def _receive(self, q):
+    try:
+      yield from _receive(q, self.upstream)
+    finally:
+      if len(self.upstream)==len(self.names): self.totals = self.upstream
+      self.stop.set() # the stages end after their current chunk
+      for process in self.processes:
+        process.join(timeout=10)
+        if process.is_alive(): process.terminate() # stuck in a stage
+        process.join()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    try: return next(self.iterator)
+    except StopIteration:
+      if self.verbose: print(self.report())
+      raise
+
+  def close(self):
+    self.iterator.close()
+
+  @property
+  def stats(self):
+    if self.totals is not None: return [_stats(totals) for totals in self.totals]
+    if not len(self.processes): return [_stats(timer.totals()) for timer in self.timers]
+    return [_stats(self.timers[0].totals())]+[StageStats(name, 0, 0., 0., 0.) for name in self.names[1:]]
+
+  def report(self):
+    lines = ["* {:<30} {:>8} {:>10} {:>10} {:>10}".format("stage", "chunks", "busy", "starved", "blocked")]
+    stats = self.stats
+    bottleneck = max(range(len(stats)), key=lambda i: stats[i].busy)
+    for i, s in enumerate(stats):
+      lines.append("* {:<30} {:>8} {:>9.3f}s {:>9.3f}s {:>9.3f}s{}".format(s.name[:30], s.chunks, s.busy, s.starved, s.blocked, "  <- bottleneck" if i==bottleneck else ""))
+    return "\n".join(lines)
+
+def pipeline(*stages, queue_size=2, processes=False, verbose=False):
+  """Run the stages of a chunk pipeline concurrently, each in its own thread.
+
+  In a chain of generators, the stages run interleaved in one thread, so
+  the time per chunk is the sum over all stages.  Here each stage runs in
+  a thread of its own, connected to the next stage by a queue holding up
+  to *queue_size* chunks, so that the stages overlap and the throughput is
+  set by the slowest stage.  This pays off when the stages release the GIL
+  (I/O, compression, NumPy/SciPy on large arrays); otherwise, set
+  *processes*.
+
+  Each stage still processes its chunks one after the other, in order, so
+  stateful stages like :func:`sosfilt`, :func:`unwrap` or :func:`cumsum`
+  work unchanged.
+
+  The returned iterator has a ``stats`` attribute, a list of
+  :class:`StageStats` with the time each stage spent computing (busy),
+  waiting for its input (starved) and waiting for the next stage to take
+  its output (blocked); the stage with most busy time is the bottleneck.
+  ``report()`` formats them as a table.
+
+  Args:
+      *stages: The first stage is the source, an iterable of chunks (e.g.
+          :class:`IterableH5Chunks`).  Each further stage is a function
+          taking an iterator of chunks and returning a (lazy) iterator of
+          chunks, like a generator function.
+      queue_size (int): Maximum number of chunks waiting between two stages.
+      processes (bool): Run each stage after the source in its own process
+          instead, with chunks pickled through ``multiprocessing`` queues,
+          for stages holding the GIL.  The source stays in a thread of the
+          calling process.  With the ``spawn`` or ``forkserver`` start
+          method, the stages must be picklable; ``stats`` is complete once
+          the pipeline is exhausted.  The processes are started on the
+          first chunk; when the pipeline is closed early, they end after
+          their current chunk (or are terminated after 10 s).
+      verbose (bool): Print the report when the pipeline is exhausted.
+
+  Raises:
+      ValueError: If no stage is given.
+
+  Returns:
+      iterator: Output of the last stage.  Errors of a stage are raised by
+      it.
+
+  Example:
+      >>> source = chunkiter.IterableH5Chunks("test.h5", "data")
+      >>> spectra = lambda chunks: (np.fft.fft(chunk, axis=1) for chunk in chunks)
+      >>> filtered = lambda chunks: chunkiter.sosfilt(sos, chunks)
+      >>> output = chunkiter.pipeline(source, spectra, filtered)
+      >>> chunkiter.chunks_to_h5(output, "output.h5")
+      >>> print(output.report())
+  """
+  if not len(stages): raise ValueError("pipeline needs at least a source")
+  return _Pipeline(stages, queue_size, processes, verbose)
+
+# --- tests ---
+
+def _square(chunks):
+  for chunk in chunks: yield chunk**2
+
+def _running_sum(chunks):
+  total = 0
+  for chunk in chunks:
+    total = total+chunk.sum()
+    yield chunk*0+total
+
+def _slow(chunks):
+  for chunk in chunks:
+    time.sleep(0.02)
+    yield chunk
+
+def _fail(chunks):
+  for chunk in chunks:
+    if chunk[0]==3: raise ArithmeticError("chunk 3")
+    yield chunk
+
+def test_results_and_order():
+  """The output equals the chained generators, including stateful stages, with threads and processes."""
+  import numpy as np
+  chunks = [np.arange(10)+i for i in range(20)]
+  expected = list(_running_sum(_square(iter(chunks))))
+  for processes in (False, True):
+    output = pipeline(chunks, _square, _running_sum, processes=processes)
+    result = list(output)
+    assert len(result)==len(expected) and all(np.array_equal(r, e) for r, e in zip(result, expected))
+    assert [s.chunks for s in output.stats]==[20, 20, 20]
+    assert [s.name for s in output.stats]==["list", "_square", "_running_sum"]
+
+def test_stats():
+  """The slow stage is busy, the stages after it starve and the ones before are blocked."""
+  import numpy as np
+  def fast(chunks):
+    for chunk in chunks: yield chunk+1
+  output = pipeline((np.zeros(4) for i in range(20)), fast, _slow, fast, queue_size=1)
+  for chunk in output: pass
+  source, before, slow, after = output.stats
+  assert slow.busy>0.3 and slow.busy>10*before.busy
+  assert before.blocked>0.2 and after.starved>0.2
+  assert "<- bottleneck" in output.report().splitlines()[3]
+
+def test_errors():
+  """Errors of a stage are raised by the pipeline, and an early stop ends all threads."""
+  import numpy as np
+  for processes in (False, True):
+    result = []
+    try:
+      for chunk in pipeline([np.full(2, i) for i in range(10)], _fail, _square, processes=processes): result.append(int(chunk[0]))
+    except ArithmeticError: pass
+    else: assert False
+    assert result==[0, 1, 4]
+
+  threads = set(threading.enumerate())
+  output = pipeline((np.full(2, i) for i in range(1000)), _square, _square)
+  next(output)
+  output.close()
+  assert not set(threading.enumerate())-threads
+
+  output = pipeline((np.full(2, i) for i in range(1000)), _square, _square, processes=True)
+  assert not multiprocessing.active_children()
+  next(output)
+  processes = multiprocessing.active_children()
+  assert len(processes)==2
+  t_start = time.perf_counter()
+  output.close()
+  assert time.perf_counter()-t_start<1 and [p.exitcode for p in processes]==[0, 0] # ended, not terminated
+
+  try: pipeline()
+  except ValueError: pass
+  else: assert False
+
+if __name__ == "__main__":
+  tests = [test_results_and_order, test_stats, test_errors]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
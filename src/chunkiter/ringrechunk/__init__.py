@@ -0,0 +1,277 @@
+"""
+copy-minimizing rechunking through a ring buffer, yielding views
+"""
+
+import collections
+import numpy as np
+
+__all__ = ['ring_rechunk']
+
+def ring_rechunk(data, chunk_size, overlap_size=0, padding=False, yield_remainder=True, out=None, ring_size=None):
+  """Rechunk a stream of array chunks like :func:`chunkiter.rechunk`, avoiding copies.
+
+  Yields the same output chunks as :func:`chunkiter.rechunk`, but as views
+  instead of newly allocated arrays:
+
+  - an output chunk that lies within one input chunk is a view of that
+    input chunk, without any copy,
+  - the other output chunks are views of a preallocated ring buffer of
+    *ring_size* samples.  Each input sample that is needed is copied into
+    the ring once and stays there for the following overlapping output
+    chunks; when the end of the ring is reached, the samples still needed
+    (at most *chunk_size*) are moved to its front, which adds at most
+    ``chunk_size/(ring_size-chunk_size)`` copies per sample.
+
+  Hence an output chunk is only valid until the next one is requested,
+  like the buffers of ``IterableH5Chunks(..., buffers=n)``, and must not
+  be modified, as it may be a view of the input.  Use :func:`rechunk` if
+  the chunks are kept or modified.
+
+  If *out* is given, each output chunk is written into a buffer provided
+  by the caller instead, e.g. into shared memory or a pinned buffer.
+
+  Args:
+      data: Iterator yielding np.ndarray chunks.
+      chunk_size (int): Desired output chunk size along axis 0.
+      overlap_size (int): Number of overlapping samples between consecutive
+          output chunks.
+      padding (bool): If ``True``, the last chunk is zero-padded to
+          *chunk_size* and the return value is ``(actual_size, chunk)``
+          instead of just ``chunk``.
+      yield_remainder (bool): If ``True`` (default) the last chunk will
+          be returned even if it is smaller than the specificed *chunk_size*.
+      out (np.ndarray or callable, optional): Array of shape
+          ``(chunk_size,)+trailing shape`` that every output chunk is
+          written to (the remainder to its beginning), or a function
+          ``out(shape, dtype)`` returning a buffer for each output chunk.
+      ring_size (int, optional): Samples in the ring buffer, at least
+          *chunk_size*.  Defaults to ``4*chunk_size``.
+
+  Yields:
+      np.ndarray or (int, np.ndarray): Rechunked array chunk.  With
+      ``padding=True``, yields ``(actual_size, chunk)`` tuples.
+
+  Raises:
+      ValueError: If chunk_size <= overlap_size or ring_size < chunk_size.
+
+  Example:
+      >>> import numpy as np, chunkiter
+      >>> source = [np.ones((17, 3)), np.ones((17, 3)), np.ones((16, 3))]
+      >>> for chunk in chunkiter.ring_rechunk(source, 10, overlap_size=5):
+      ...     print(chunk.shape, chunk.base is not None)
+      (10, 3) True
+      ...
+  """
+
+  rechunker = _RingRechunker(chunk_size, overlap_size, padding, yield_remainder, out, ring_size)
+  for chunk in data:
+    yield from rechunker.push(chunk)
+  yield from rechunker.flush()
+
+
+class _RingRechunker(object):
+  """Push-style core of :func:`ring_rechunk`.
+
+  :meth:`push` and :meth:`flush` are generators, as an output chunk in the
+  ring is only valid until the next one is produced.
+  """
+
+  def __init__(self, chunk_size, overlap_size=0, padding=False, yield_remainder=True, out=None, ring_size=None):
+    if not chunk_size-overlap_size>0: raise ValueError("need chunk_size>overlap_size")
+    if ring_size is None: ring_size = 4*chunk_size
+    if ring_size<chunk_size: raise ValueError("need ring_size>=chunk_size")
+
+    self.chunk_size = chunk_size
+    self.hop = chunk_size-overlap_size
+    self.padding = padding
+    self.yield_remainder = yield_remainder
+    self.out = out
+    self.ring_size = ring_size
+
+    self.input_chunks = collections.deque() # (start, chunk) of the input chunks still needed
+    self.input_stop_i = 0
+    self.output_start_i = 0
+
+    self.ring = None
+    self.ring_pos = 0 # ring index of ring_start_i
+    self.ring_start_i = 0 # samples ring_start_i to ring_stop_i are in the ring
+    self.ring_stop_i = 0
+
+  def _fill(self, target, start, stop):
+    # copy samples start to stop of the input into target
+    views = []
+    for chunk_start, chunk in self.input_chunks:
+      lo = max(start, chunk_start)
+      hi = min(stop, chunk_start+chunk.shape[0])
+      if lo<hi: views.append(chunk[lo-chunk_start:hi-chunk_start])
+      if hi>=stop: break
+    np.concatenate(views, axis=0, out=target[:stop-start])
+
+  def _ring(self, start, stop):
+    # view of samples start to stop in the ring, copying in those not there yet
+    chunk = self.input_chunks[0][1]
+    if self.ring is None:
+      self.ring = np.empty((self.ring_size,)+chunk.shape[1:], dtype=chunk.dtype)
+
+    if start>=self.ring_stop_i: # nothing reusable in the ring
+      self.ring_start_i = self.ring_stop_i = start
+      self.ring_pos = 0
+    self.ring_pos += start-self.ring_start_i
+    self.ring_start_i = start
+
+    if self.ring_pos+self.chunk_size>self.ring_size:
+      kept = self.ring_stop_i-self.ring_start_i
+      self.ring[:kept] = self.ring[self.ring_pos:self.ring_pos+kept]
+      self.ring_pos = 0
+
+    offset = self.ring_pos-self.ring_start_i
+    if stop>self.ring_stop_i:
+      self._fill(self.ring[offset+self.ring_stop_i:offset+stop], self.ring_stop_i, stop)
+      self.ring_stop_i = stop
+    return self.ring[offset+start:offset+stop]
+
+  def _output(self, start, stop):
+    # output chunk with samples start to stop, zero-padded to chunk_size if padding is set
+    size = self.chunk_size if self.padding else stop-start
+    chunk = self.input_chunks[0][1]
+    shape, dtype = (size,)+chunk.shape[1:], chunk.dtype
+
+    if self.out is not None:
+      target = self.out(shape, dtype) if callable(self.out) else self.out[:size]
+      self._fill(target, start, stop)
+      target[stop-start:] = 0
+      return target
+
+    chunk_start = self.input_chunks[0][0]
+    if start+size<=chunk_start+chunk.shape[0]: # within the first input chunk
+      return chunk[start-chunk_start:start-chunk_start+size]
+
+    view = self._ring(start, stop)
+    if size>stop-start: # padding of the last chunk, the ring has space for it
+      view = self.ring[self.ring_pos:self.ring_pos+size]
+      view[stop-start:] = 0
+    return view
+
+  def _yield(self, start, stop):
+    if self.padding: yield (stop-start, self._output(start, stop))
+    else: yield self._output(start, stop)
+
+  def push(self, chunk):
+    if chunk.shape[0]==0: return
+    self.input_chunks.append((self.input_stop_i, chunk))
+    self.input_stop_i += chunk.shape[0]
+
+    while self.output_start_i+self.chunk_size<=self.input_stop_i:
+      start = self.output_start_i
+      self.output_start_i += self.hop
+      yield from self._yield(start, start+self.chunk_size)
+
+      # drop unneeded input chunks at head
+      while len(self.input_chunks) and self.output_start_i>=self.input_chunks[0][0]+self.input_chunks[0][1].shape[0]:
+        self.input_chunks.popleft()
+
+  def flush(self):
+    if self.output_start_i>=self.input_stop_i or not self.yield_remainder: return
+    yield from self._yield(self.output_start_i, self.input_stop_i)
+
+# --- tests ---
+
+def _split_random(rng, x, n_splits):
+  cuts = np.sort(rng.integers(0, x.shape[0]+1, n_splits))
+  return np.split(x, cuts)
+
+def test_matches_rechunk():
+  """Output chunks equal those of rechunk for random chunkings, overlaps and options."""
+  from chunkiter.functions import rechunk
+  rng = np.random.default_rng(0)
+  x = rng.standard_normal((1000, 2))
+  for trial in range(60):
+    chunks = _split_random(rng, x, rng.integers(0, 30))
+    chunk_size = int(rng.integers(1, 120))
+    overlap_size = int(rng.integers(0, chunk_size))
+    kwargs = dict(padding=bool(rng.integers(2)), yield_remainder=bool(rng.integers(2)))
+    ring_size = int(rng.integers(chunk_size, 3*chunk_size+1))
+
+    expected = list(rechunk(iter(chunks), chunk_size, overlap_size, **kwargs))
+    result = [(c[0], c[1].copy()) if kwargs["padding"] else c.copy()
+              for c in ring_rechunk(iter(chunks), chunk_size, overlap_size, ring_size=ring_size, **kwargs)]
+    assert len(result)==len(expected), (trial, len(result), len(expected))
+    for r, e in zip(result, expected):
+      if kwargs["padding"]:
+        assert r[0]==e[0]
+        r, e = r[1], e[1]
+      assert r.shape==e.shape and np.array_equal(r, e), trial
+
+def test_zero_copy():
+  """Output chunks within one input chunk are views of it; the others share the ring."""
+  x = np.arange(100)
+  chunks = [x[:50], x[50:]]
+  outputs = [(c.copy(), np.shares_memory(c, x)) for c in ring_rechunk(iter(chunks), 20, overlap_size=10)]
+  assert [o[0][0] for o in outputs]==list(range(0, 100, 10))
+  assert [o[1] for o in outputs]==[True, True, True, True, False, True, True, True, True, True]
+
+def test_out():
+  """Output chunks are written into caller-provided buffers."""
+  from chunkiter.functions import rechunk, _BufferPool
+  x = np.arange(95.)
+  chunks = np.split(x, [7, 40, 41, 80])
+  expected = list(rechunk(iter(chunks), 10, 3))
+
+  out = np.empty(10)
+  result = [(c.copy(), c.base is out or c is out) for c in ring_rechunk(iter(chunks), 10, 3, out=out)]
+  assert all(r[1] for r in result)
+  assert all(np.array_equal(r[0], e) for r, e in zip(result, expected))
+
+  pool = _BufferPool(2)
+  result = [(n, c.copy()) for n, c in ring_rechunk(iter(chunks), 10, 3, out=pool.take, padding=True)]
+  assert result[-1][0]==len(expected[-1])
+  assert np.array_equal(result[-1][1], np.r_[expected[-1], np.zeros(10-len(expected[-1]))])
+
+def test_errors():
+  """Invalid chunk, overlap and ring sizes raise ValueError."""
+  for kwargs in (dict(overlap_size=10), dict(ring_size=5)):
+    try: list(ring_rechunk(iter([np.zeros(20)]), 10, **kwargs))
+    except ValueError: pass
+    else: assert False
+
+# --- timing comparison ---------------------------------------
+
+def test_timing():
+  """Compare wall-clock throughput of ring_rechunk vs rechunk.
+
+  Rechunks 64 MB of float64 for several ratios of output chunk size, overlap
+  and input chunk size, consuming each output chunk with a sum (best of 3).
+  """
+  import time
+  from chunkiter.functions import rechunk
+
+  x = np.random.default_rng(42).standard_normal(8*1024**2)
+  print()
+  print(f"--- Timing comparison ({x.nbytes/1024**2:.0f} MB) ---")
+  print(f"  {'input':>8} {'chunk':>8} {'overlap':>8} {'rechunk':>10} {'ring':>10}")
+  for input_size, chunk_size, overlap_size in [
+    (65536, 4096, 0), (4096, 65536, 0), (65536, 65536, 0), (50000, 65536, 0),
+    (65536, 4096, 2048), (65536, 4096, 4032), (4096, 65536, 32768), (4096, 65536, 64512),
+  ]:
+    chunks = np.split(x, np.arange(input_size, x.size, input_size))
+    times = []
+    for fun in (rechunk, ring_rechunk):
+      best = np.inf
+      for repetition in range(3):
+        t0 = time.perf_counter()
+        total = 0.
+        for chunk in fun(iter(chunks), chunk_size, overlap_size): total += chunk[-1]
+        best = min(best, time.perf_counter()-t0)
+      times.append(best)
+    print(f"  {input_size:>8} {chunk_size:>8} {overlap_size:>8} {x.nbytes/times[0]/1e9:>6.2f}GB/s {x.nbytes/times[1]/1e9:>6.2f}GB/s")
+  print("  ✓ timing comparison ok")
+
+
+if __name__ == "__main__":
+  tests = [test_matches_rechunk, test_zero_copy, test_out, test_errors, test_timing]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
@@ -0,0 +1,397 @@
+"""
+shared-memory ring buffer for handing chunks between processes
+"""
+
+import io
+import os
+import sys
+import mmap
+import time
+import uuid
+
+import numpy as np
+from multiprocessing import shared_memory
+
+try: import _posixshmem
+except ImportError: _posixshmem = None
+
+from ..functions import _stream_header, _read_stream_header
+
+__all__ = ['yielding_chunks_to_shm', 'chunks_to_shm', 'IterableShmChunks']
+
+# layout of the control block at the start of the shared memory (int64 fields); the
+# write counter is only written by the producer, the read counter only by the consumer.
+# The counters are published with plain stores, relying on the stores of one process
+# becoming visible to the other in program order, as on x86 (TSO); weakly-ordered CPUs
+# like ARM or POWER give no such guarantee, so the ring is only supported on x86.
+_MAGIC = 0 # set last by the producer, when the ring is ready
+_SLOTS = 1
+_SLOT_SIZE = 2
+_DATA_OFFSET = 3
+_HEADER_LEN = 4
+_DONE = 5 # set by the producer after the last chunk
+_WRITE = 6 # number of chunks written
+_READ = 8 # number of chunks released by the consumer (on its own cache line)
+_DETACHED = 9 # set by the consumer when it stops before the end of the stream
+_ATTACHED = 10 # set by the consumer when it has attached to the ring
+_CONTROL_SIZE = 256
+_ALIGNMENT = 64
+_MAGIC_VALUE = int.from_bytes(b'CKSHMv01', "little")
+
+def _align(n):
+  return -(-n//_ALIGNMENT)*_ALIGNMENT
+
+def _layout(rows, dtypes, shapes):
+  # offsets of the arrays of a chunk within a slot, and the slot size needed
+  offsets = []
+  pos = _align(8*len(rows))
+  for n, dtype, shape in zip(rows, dtypes, shapes):
+    offsets.append(pos)
+    pos = _align(pos + n*dtype.itemsize*int(np.prod(shape)))
+  return offsets, pos
+
+def _poll(condition, timeout=None):
+  # busy-wait for condition: first only yield the CPU, then sleep with a growing delay up to 1 ms
+  t_start = time.monotonic()
+  polls = 0
+  while not condition():
+    if timeout is not None and time.monotonic()-t_start>timeout: raise TimeoutError("timeout waiting for the other end of the shared-memory ring")
+    time.sleep(0 if polls<10 else 1e-6*2**min(polls-10, 10))
+    polls += 1
+
+class _Segment(object):
+  # a segment attached by shm_open and mmap, like SharedMemory(name) but without registering
+  # it with the resource tracker
+  def __init__(self, name):
+    fd = _posixshmem.shm_open(name if name.startswith("/") else "/"+name, os.O_RDWR, mode=0o600)
+    try: self.mmap = mmap.mmap(fd, os.fstat(fd).st_size)
+    finally: os.close(fd)
+    self.buf = memoryview(self.mmap)
+    self.size = len(self.mmap)
+
+def _attach(name):
+  # attach without registering the segment with the resource tracker: a tracker of another
+  # process would unlink it at exit, and unregistering it afterwards would remove the
+  # registration of the producer if the tracker is shared (same process, fork or spawn),
+  # so that it is not removed if the producer crashes, and its unlink() fails in the tracker
+  if sys.version_info>=(3,13): return shared_memory.SharedMemory(name, track=False)
+  if _posixshmem is None: return shared_memory.SharedMemory(name) # Windows, not tracked
+  return _Segment(name)
+
+class _Mapping(object):
+  # array interface to an attached segment that keeps it mapped as long as arrays viewing
+  # it exist (closing a SharedMemory with exported buffers fails)
+  def __init__(self, shm):
+    self.shm = shm
+    address = np.frombuffer(shm.buf, np.uint8).ctypes.data
+    self.__array_interface__ = dict(shape=(shm.size,), typestr="|u1", data=(address, False), version=3)
+
+def yielding_chunks_to_shm(iterator, name, slots=8, slot_size=None, timeout=None):
+  """Hand chunks to another process through a shared-memory ring buffer, yielding them for further processing.
+
+  Creates a :class:`multiprocessing.shared_memory.SharedMemory` segment
+  named *name* holding *slots* fixed-size slots, copies each chunk into the
+  next free slot and publishes it to the consumer, an
+  :class:`IterableShmChunks` with the same *name*.  There must be exactly
+  one consumer.  When the ring is full, the producer waits for the consumer.
+  At the end of the stream, the producer waits until the consumer has
+  attached and released all chunks and then removes the segment; an empty
+  stream creates a ring without slots, so the consumer still finds its end.
+
+  The ring relies on the memory ordering of x86 CPUs (see the module
+  source) and is not safe on weakly-ordered CPUs like ARM.
+
+  All chunks must have the same dtypes and trailing shapes, like in the
+  binary format version 2.
+
+  Args:
+      iterator: Iterator yielding ``np.ndarray`` chunks (or tuples thereof).
+      name (str): Name of the shared memory segment.
+      slots (int): Number of slots in the ring.
+      slot_size (int, None): Capacity of a slot in bytes.  ``None`` sizes the
+          slots for the first chunk, so later chunks must not be larger.
+      timeout (float, None): Maximum time in seconds to wait for the
+          consumer to free a slot, and at the end of the stream for the
+          consumer to release all chunks.
+
+  Raises:
+      ValueError: If a chunk does not fit into a slot or does not match the
+          dtypes and trailing shapes of the first chunk.
+      BrokenPipeError: If the consumer stopped before the end of the stream.
+      TimeoutError: If the consumer does not free a slot or release all
+          chunks within *timeout*.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Original chunks, unchanged.
+
+  Example:
+      >>> source = chunkiter.IterableH5Chunks("input.h5", "data")
+      >>> chunkiter.chunks_to_shm(source, "acquisition")
+      >>> # in the other process:
+      >>> for chunk in chunkiter.IterableShmChunks("acquisition"):
+      ...     print(chunk.shape)
+  """
+  shm = None
+  try:
+    for data in iterator:
+      arrays = data if type(data)==tuple else (data,)
+      rows = [a.shape[0] for a in arrays]
+
+      if shm is None:
+        dtypes = [a.dtype for a in arrays]
+        shapes = [a.shape[1:] for a in arrays]
+        header = b''.join(bytes(b) for b in _stream_header(arrays))
+        if slot_size is None: slot_size = _layout(rows, dtypes, shapes)[1]
+        slot_size = _align(slot_size)
+        data_offset = _align(_CONTROL_SIZE + len(header))
+
+        shm = shared_memory.SharedMemory(name, create=True, size=data_offset+slots*slot_size)
+        control = np.ndarray(_CONTROL_SIZE//8, np.int64, buffer=shm.buf)
+        control[:] = 0
+        control[[_SLOTS, _SLOT_SIZE, _DATA_OFFSET, _HEADER_LEN]] = slots, slot_size, data_offset, len(header)
+        shm.buf[_CONTROL_SIZE:_CONTROL_SIZE+len(header)] = header
+        control[_MAGIC] = _MAGIC_VALUE
+
+      if [(a.dtype, a.shape[1:]) for a in arrays]!=list(zip(dtypes, shapes)):
+        raise ValueError("chunk does not match the dtypes and trailing shapes of the first chunk")
+      offsets, size = _layout(rows, dtypes, shapes)
+      if size>slot_size: raise ValueError("chunk of {} bytes does not fit into slots of {} bytes".format(size, slot_size))
+
+      # wait for a free slot
+      written = int(control[_WRITE])
+      _poll(lambda: control[_DETACHED] or written-control[_READ]<slots, timeout)
+      if control[_DETACHED]: raise BrokenPipeError("the consumer of the shared-memory ring stopped")
+
+      slot = data_offset + (written%slots)*slot_size
+      np.ndarray(len(rows), np.int64, buffer=shm.buf, offset=slot)[:] = rows
+      for a, offset in zip(arrays, offsets):
+        np.copyto(np.ndarray(a.shape, a.dtype, buffer=shm.buf, offset=slot+offset), a)
+      control[_WRITE] = written+1
+
+      yield data
+
+    if shm is None: # empty stream
+      shm = shared_memory.SharedMemory(name, create=True, size=_CONTROL_SIZE)
+      control = np.ndarray(_CONTROL_SIZE//8, np.int64, buffer=shm.buf)
+      control[:] = 0
+      control[_MAGIC] = _MAGIC_VALUE
+
+    control[_DONE] = 1
+    _poll(lambda: control[_DETACHED] or (control[_ATTACHED] and control[_READ]==control[_WRITE]), timeout)
+
+  finally:
+    if shm is not None:
+      control[_DONE] = 1
+      del control
+      shm.close()
+      shm.unlink()
+
+def chunks_to_shm(*args, **kwargs):
+  """Consume an iterator and hand all chunks to a shared-memory ring buffer (no yielding).
+
+  Convenience wrapper around :func:`yielding_chunks_to_shm`.
+  Same parameters.
+  """
+  for i in yielding_chunks_to_shm(*args, **kwargs): pass
+
+class IterableShmChunks(object):
+  """Iterable reading chunks from a shared-memory ring buffer written by :func:`yielding_chunks_to_shm`.
+
+  Yields zero-copy views into the shared memory.  A yielded chunk stays
+  valid until the next chunk is pulled, when its slot is handed back to the
+  producer; copy it if you need it for longer.  Only one consumer may read a
+  ring, and it can be iterated only once.  Like the producer, it is only
+  supported on x86 CPUs.
+
+  Each instance has an ``identifier`` attribute.
+
+  Args:
+      name (str): Name of the shared memory segment.
+      timeout (float, None): Maximum time in seconds to wait for the producer
+          to create the ring and for each chunk.
+      identifier (str, optional): Identifier hash.  Auto-generated if not given.
+
+  Raises:
+      TimeoutError: If the producer does not deliver within *timeout*.
+
+  Yields:
+      np.ndarray or tuple of np.ndarray: Views of the chunks in shared memory.
+
+  Example:
+      >>> for chunk in chunkiter.IterableShmChunks("acquisition"):
+      ...     total += chunk.sum()
+  """
+  def __init__(self, name, timeout=None, identifier=None):
+    self.name = name
+    self.timeout = timeout
+    self.identifier = identifier if identifier is not None else str(uuid.uuid4())
+
+  def _open(self):
+    shm = None
+    def ready():
+      nonlocal shm
+      if shm is None:
+        try: shm = _attach(self.name)
+        except (FileNotFoundError, ValueError): return False # not created or not yet sized
+      return np.ndarray(1, np.int64, buffer=shm.buf)[_MAGIC]==_MAGIC_VALUE
+    _poll(ready, self.timeout)
+    return shm
+
+  def __iter__(self):
+    memory = np.asarray(_Mapping(self._open()))
+    control = memory[:_CONTROL_SIZE].view(np.int64)
+    control[_ATTACHED] = 1
+    finished = False
+
+    try:
+      slots, slot_size, data_offset, header_len = control[[_SLOTS, _SLOT_SIZE, _DATA_OFFSET, _HEADER_LEN]].tolist()
+      if header_len: # else an empty stream
+        header = io.BytesIO(memory[_CONTROL_SIZE:_CONTROL_SIZE+header_len].tobytes())
+        header.read(5)
+        _, dtypes, shapes, _ = _read_stream_header(header)
+
+      while True:
+        read = int(control[_READ])
+        _poll(lambda: control[_WRITE]>read or control[_DONE], self.timeout)
+        if control[_WRITE]==read: break # done
+
+        slot = data_offset + (read%slots)*slot_size
+        rows = memory[slot:slot+8*len(dtypes)].view(np.int64).tolist()
+        offsets, _ = _layout(rows, dtypes, shapes)
+        arrays = []
+        for n, dtype, shape, offset in zip(rows, dtypes, shapes, offsets):
+          start = slot+offset
+          arrays.append(memory[start:start+n*dtype.itemsize*int(np.prod(shape))].view(dtype).reshape((n,)+shape))
+
+        yield arrays[0] if len(arrays)==1 else tuple(arrays)
+        control[_READ] = read+1
+
+      finished = True
+
+    finally:
+      if not finished: control[_DETACHED] = 1
+
+
+# ============================================================
+# --- tests ---
+# ============================================================
+
+def _produce(name, n, slots):
+  """Producer process for the tests."""
+  chunks_to_shm((np.full((1000, 3), i, np.float32) for i in range(n)), name, slots=slots)
+
+def _name():
+  return "chunkiter-test-{}".format(uuid.uuid4().hex[:12])
+
+def test_threads_tuples():
+  """Tuple chunks of varying length arrive unchanged, through a small ring."""
+  import numpy as np
+  import threading
+  rng = np.random.default_rng(42)
+  chunks = [(rng.standard_normal((n, 3)), np.arange(n, dtype=np.int16)) for n in [50, 0, 17, 50, 1] * 4]
+  name = _name()
+  producer = threading.Thread(target=chunks_to_shm, args=(iter(chunks), name), kwargs=dict(slots=2, slot_size=4096))
+  producer.start()
+  result = [(a.copy(), b.copy()) for a, b in IterableShmChunks(name, timeout=10)]
+  producer.join()
+
+  assert len(result) == len(chunks)
+  for (a, b), (c, d) in zip(result, chunks):
+    assert np.array_equal(a, c) and np.array_equal(b, d) and b.dtype == d.dtype
+
+def test_process():
+  """Chunks are handed to another process; the segment is removed afterwards."""
+  import numpy as np
+  import multiprocessing
+  name = _name()
+  process = multiprocessing.get_context("spawn").Process(target=_produce, args=(name, 20, 3))
+  process.start()
+  received = [int(chunk[0, 0]) for chunk in IterableShmChunks(name, timeout=30)]
+  process.join()
+
+  assert process.exitcode == 0
+  assert received == list(range(20))
+  try:
+    shared_memory.SharedMemory(name)
+    assert False, "expected the segment to be removed"
+  except FileNotFoundError:
+    pass
+
+def test_zero_copy():
+  """Yielded chunks are views into the shared memory."""
+  import numpy as np
+  import threading
+  name = _name()
+  producer = threading.Thread(target=chunks_to_shm, args=((np.ones(100) for i in range(3)), name))
+  producer.start()
+  for chunk in IterableShmChunks(name, timeout=10):
+    assert not chunk.flags.owndata
+  producer.join()
+
+def test_consumer_stops():
+  """The producer gets BrokenPipeError when the consumer stops early."""
+  import numpy as np
+  import threading
+  name = _name()
+  errors = []
+  def produce():
+    try: chunks_to_shm((np.ones(10) for i in range(100)), name, slots=2)
+    except BrokenPipeError as e: errors.append(e)
+  producer = threading.Thread(target=produce)
+  producer.start()
+  for i, chunk in enumerate(IterableShmChunks(name, timeout=10)):
+    if i == 3: break
+  producer.join()
+  assert len(errors) == 1
+
+def test_empty_stream():
+  """An empty stream ends the consumer, and the producer waits for it only up to its timeout."""
+  import numpy as np
+  import threading
+  name = _name()
+  producer = threading.Thread(target=chunks_to_shm, args=(iter([]), name), kwargs=dict(timeout=10))
+  producer.start()
+  assert list(IterableShmChunks(name, timeout=10)) == []
+  producer.join()
+
+  try:
+    chunks_to_shm(iter([]), _name(), timeout=0.1)
+    assert False, "expected TimeoutError"
+  except TimeoutError:
+    pass
+
+def test_resource_tracker():
+  """Attaching, also in the producing process, leaves the registration of the segment by the producer alone."""
+  import subprocess
+  script = "\n".join([
+    "import threading, numpy as np",
+    "from chunkiter.shm import chunks_to_shm, IterableShmChunks",
+    "producer = threading.Thread(target=chunks_to_shm, args=((np.ones(10) for i in range(3)), {!r}), kwargs=dict(timeout=10))",
+    "producer.start()",
+    "assert len(list(IterableShmChunks({!r}, timeout=10)))==3",
+    "producer.join()",
+  ]).format(*[_name()]*2)
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, env=env, timeout=60)
+  assert result.returncode==0 and "Traceback" not in result.stderr, result.stderr
+
+def test_slot_too_small():
+  """Chunks larger than the slots raise ValueError."""
+  import numpy as np
+  name = _name()
+  try:
+    chunks_to_shm(iter([np.ones(10), np.ones(1000)]), name, timeout=0.1)
+    assert False, "expected ValueError"
+  except ValueError:
+    pass
+
+
+if __name__ == "__main__":
+  tests = [test_threads_tuples, test_process, test_zero_copy, test_consumer_stops, test_empty_stream,
+           test_resource_tracker, test_slot_too_small]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
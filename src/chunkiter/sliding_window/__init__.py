@@ -2,7 +2,6 @@
 streaming sliding window extraction
 """
 
-import itertools
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 
@@ -49,83 +48,97 @@ def sliding_window(data, window, step, output_chunksize=None, padding=False, yie
       [[5. 6. 7.]]
   """
 
-  # --- normalize window ---
-  if isinstance(window, (int, np.integer)):
-    window_size = int(window)
-    window_coeffs = None
-  else:
-    window_coeffs = np.asarray(window)
-    window_size = window_coeffs.size
-
-  if window_size < 1:
-    raise ValueError("window size must be positive")
-  if step < 1:
-    raise ValueError("step must be positive")
-
-  # --- determine output_chunksize if not given ---
-  if output_chunksize is None:
-    first_chunk = next(data)
-    data = itertools.chain([first_chunk], data)
+  windows = _SlidingWindows(window, step, output_chunksize, padding, yield_remainder)
+  for chunk in data:
+    yield from windows.push(chunk)
+  yield from windows.flush()
+
+
+class _SlidingWindows(object):
+  """Push-style core of :func:`sliding_window`, shared with the asyncio variant.
+
+  :meth:`push` takes the next input chunk and yields the output chunks it
+  completes; :meth:`flush` yields the remaining output at the end of the
+  stream.  Both are generators, so that only one output chunk is built at
+  a time.
+  """
+
+  def __init__(self, window, step, output_chunksize=None, padding=False, yield_remainder=True):
+    # --- normalize window ---
+    if isinstance(window, (int, np.integer)):
+      self.window_size = int(window)
+      self.window_coeffs = None
+    else:
+      self.window_coeffs = np.asarray(window)
+      self.window_size = self.window_coeffs.size
+
+    if self.window_size < 1:
+      raise ValueError("window size must be positive")
+    if step < 1:
+      raise ValueError("step must be positive")
+    if output_chunksize is not None and output_chunksize < 1:
+      raise ValueError("output_chunksize must be at least 1")
+
+    self.step = step
+    self.output_chunksize = output_chunksize
+    self.padding = padding
+    self.yield_remainder = yield_remainder
+
+    # --- buffer state ---
+    self.input_chunks = []
+    self.input_start_i = 0
+    self.input_stop_i = 0
+    self.output_pos = 0
+
+  def _auto_output_chunksize(self, first_chunk):
+    # approximately match input chunk memory (~1-4 MB)
     input_chunk_bytes = first_chunk.nbytes
     itemsize = first_chunk.dtype.itemsize
 
-    candidate = max(1, int(input_chunk_bytes / (window_size * itemsize)))
-    max_cs = max(1, (4 * 1024**2) // (window_size * itemsize))
-    min_cs = max(1, (1 * 1024**2) // (window_size * itemsize))
-    output_chunksize = min(max(candidate, min_cs), max_cs)
+    candidate = max(1, int(input_chunk_bytes / (self.window_size * itemsize)))
+    max_cs = max(1, (4 * 1024**2) // (self.window_size * itemsize))
+    min_cs = max(1, (1 * 1024**2) // (self.window_size * itemsize))
+    return min(max(candidate, min_cs), max_cs)
 
-  if output_chunksize < 1:
-    raise ValueError("output_chunksize must be at least 1")
+  def _needed_end(self):
+    return self.output_pos + self.window_size + (self.output_chunksize - 1) * self.step
 
-  # --- buffer state ---
-  try:
-    first_for_buffer = next(data)
-  except StopIteration:
-    return
-  input_chunks = [first_for_buffer]
-  input_start_i = 0
-  input_stop_i = first_for_buffer.shape[0]
-  output_pos = 0
-
-  while True:
-    # 1. discard input chunks fully behind output_pos
-    while len(input_chunks) and output_pos > input_start_i + input_chunks[0].shape[0]:
-      input_start_i += input_chunks[0].shape[0]
-      input_chunks.pop(0)
-
-    # 2. fetch more input chunks as needed
-    needed_end = output_pos + window_size + (output_chunksize - 1) * step
-    while len(input_chunks) == 0 or needed_end > input_stop_i:
-      try:
-        next_chunk = next(data)
-        input_chunks.append(next_chunk)
-        input_stop_i += next_chunk.shape[0]
-      except StopIteration:
-        break
+  def push(self, chunk):
+    if self.output_chunksize is None:
+      self.output_chunksize = self._auto_output_chunksize(chunk)
+
+    self.input_chunks.append(chunk)
+    self.input_stop_i += chunk.shape[0]
 
-    if len(input_chunks) == 0:
-      break
+    while self._needed_end() <= self.input_stop_i:
+      yield self._extract(self.output_chunksize)
 
-    # 3. how many windows can we extract?
-    available_end = min(input_stop_i, needed_end)
-    available_len = available_end - output_pos
+  def flush(self):
+    if self.output_chunksize is None:
+      return
 
-    if available_len < window_size:
-      break
+    # at most one partial output chunk is left
+    available_len = self.input_stop_i - self.output_pos
+    if available_len < self.window_size:
+      return
 
-    n_windows = (available_len - window_size) // step + 1
-    n_windows = min(n_windows, output_chunksize)
+    n_windows = min((available_len - self.window_size) // self.step + 1, self.output_chunksize)
+    if n_windows == self.output_chunksize or self.yield_remainder:
+      yield self._extract(n_windows)
 
-    if n_windows == 0:
-      break
+  def _extract(self, n_windows):
+    # --- discard input chunks fully behind output_pos ---
+    while len(self.input_chunks) and self.output_pos >= self.input_start_i + self.input_chunks[0].shape[0]:
+      self.input_start_i += self.input_chunks[0].shape[0]
+      self.input_chunks.pop(0)
 
-    # 4. extract views from the input buffer
-    raw_needed = window_size + (n_windows - 1) * step
+    # --- extract views from the input buffer ---
+    raw_needed = self.window_size + (n_windows - 1) * self.step
     views = []
-    skip = output_pos - input_start_i
+    skip = self.output_pos - self.input_start_i
     collected = 0
 
-    for chunk in input_chunks:
+    for chunk in self.input_chunks:
       rel = chunk[skip:, ...]
       rel = rel[:raw_needed - collected, ...]
       collected += rel.shape[0]
@@ -137,31 +150,28 @@ def sliding_window(data, window, step, output_chunksize=None, padding=False, yie
 
     arr = views[0] if len(views) == 1 else np.concatenate(views)
 
-    # 5. extract windows via as_strided (step-skipping along axis 0)
-    strides = (arr.strides[0] * step, arr.strides[0])
-    windows = as_strided(arr, shape=(n_windows, window_size), strides=strides)
+    # --- extract windows via as_strided (step-skipping along axis 0) ---
+    strides = (arr.strides[0] * self.step, arr.strides[0])
+    windows = as_strided(arr, shape=(n_windows, self.window_size), strides=strides)
 
-    if window_coeffs is not None:
-      windows = windows * window_coeffs
+    if self.window_coeffs is not None:
+      windows = windows * self.window_coeffs
     else:
       windows = windows.copy()
 
-    # 6. yield (with optional padding / remainder handling)
-    if padding:
+    # --- padding ---
+    if self.padding:
       actual_size = n_windows
-      if n_windows < output_chunksize:
-        pad_shape = (output_chunksize - n_windows, window_size)
+      if n_windows < self.output_chunksize:
+        pad_shape = (self.output_chunksize - n_windows, self.window_size)
         windows = np.concatenate([windows, np.zeros(pad_shape, dtype=windows.dtype)], axis=0)
-      if actual_size == output_chunksize or yield_remainder:
-        yield actual_size, windows
+      output = (actual_size, windows)
     else:
-      if n_windows == output_chunksize or yield_remainder:
-        yield windows
-      else:
-        break
+      output = windows
 
-    # 7. advance
-    output_pos += n_windows * step
+    # --- advance ---
+    self.output_pos += n_windows * self.step
+    return output
 
 
 # ============================================================
@@ -310,6 +320,27 @@ def test_varying_chunk_sizes():
   result = np.concatenate(list(sliding_window(iter(chunks), window, step, output_chunksize=7)), axis=0)
   assert np.allclose(result, ref)
 
+def test_empty_chunks_at_window_start():
+  """Empty input chunks where an output chunk starts do not shift the windows."""
+  import numpy as np
+  x = np.arange(37.)
+  chunks = np.split(x, np.cumsum([0, 9, 2, 12, 0, 14, 0])[:-1])
+  ref = _ref_windows(x, 2, 4)
+  result = np.concatenate(list(sliding_window(iter(chunks), 2, 4, output_chunksize=2)), axis=0)
+  assert np.array_equal(result, ref)
+
+def test_one_output_chunk_at_a_time():
+  """Output chunks are built one at a time, not all those an input chunk completes."""
+  import numpy as np
+  import tracemalloc
+  x = np.zeros(2*1024**2)
+  tracemalloc.start()
+  for chunk in sliding_window(iter([x]), 1024, 64, output_chunksize=512):
+    pass
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  assert peak < 4*chunk.nbytes
+
 # --- auto output_chunksize -----------------------------------
 
 def test_output_chunksize_auto():
@@ -585,6 +616,7 @@ if __name__ == "__main__":
            test_empty_input, test_input_shorter_than_window,
            test_exactly_one_window, test_single_chunk_input,
            test_single_element_chunks, test_varying_chunk_sizes,
+           test_empty_chunks_at_window_start, test_one_output_chunk_at_a_time,
            test_output_chunksize_auto, test_exact_multiple,
            test_padding, test_padding_first_is_full,
            test_coefficients_with_padding, test_padding_yield_remainder_false,
@@ -482,6 +482,8 @@ def head(iterator, N=None):
   """Extract the first *N* samples from a chunk iterator.
 
   Returns the concatenated first *N* samples and a unconsumed version of the iterator for further use.
+  Seekable iterables (with a ``range`` method, e.g. :class:`IterableH5Chunks`)
+  only read the chunks needed and are returned as they are.
 
   Args:
       iterator: Iterator yielding np.ndarray chunks.
@@ -498,6 +500,9 @@ def head(iterator, N=None):
       >>> chunkiter.concatenate(rest)
       array([5., 6.])
   """
+  if hasattr(iterator, "range"):
+    return concatenate(iterator.range(0, N)), iterator
+
   peeked = []
   n = 0
   while n<N:
@@ -525,6 +530,9 @@ def start_after(chunks, n, chunk_size="same"):
           An integer value is passed directly to
           :func:`chunkiter.rechunk`.
 
+  Seekable iterables (with a ``range`` method, e.g. :class:`IterableH5Chunks`)
+  start reading directly at the first needed chunk.
+
   Yields:
       np.ndarray: Chunks with the first *n* samples removed.
 
@@ -533,6 +541,16 @@ def start_after(chunks, n, chunk_size="same"):
       >>> list(start_after(chunks, 2))
       [array([3., 4., 5.])]
   """
+  # the size of the first input chunk, taken before seeking, which trims it
+  if chunk_size == "const" and hasattr(chunks, "range"):
+    chunk_size = chunks[0].shape[0]
+  elif chunk_size == "const":
+    first, chunks = peek(chunks)
+    chunk_size = first.shape[0]
+
+  if hasattr(chunks, "range"):
+    chunks, n = chunks.range(n), 0
+
   def _trim(src):
     dropped = 0
     for chunk in src:
@@ -548,15 +566,15 @@ def start_after(chunks, n, chunk_size="same"):
     yield from _trim(chunks)
     return
 
-  peek, chunks = peek(chunks)
-  cs = first.shape[0] if chunk_size == "const" else chunk_size
-
-  yield from rechunk(_trim(chunks), cs)
+  yield from rechunk(_trim(chunks), chunk_size)
 
 
 def stop_after(iterator, N):
   """Yield only the first *N* samples from a chunk iterator.
 
+  Seekable iterables (with a ``range`` method, e.g. :class:`IterableH5Chunks`)
+  never read beyond the *N*-th sample.
+
   Args:
       iterator: Iterator yielding np.ndarray chunks.
       N (int): Maximum number of samples to yield along axis 0.
@@ -570,6 +588,10 @@ def stop_after(iterator, N):
       [array([1., 2., 3.]), array([4.])]
   """
 
+  if hasattr(iterator, "range"):
+    yield from iterator.range(0, N)
+    return
+
   for chunk in iterator:
     if not N>0: return
     r = chunk[:N,...]
@@ -0,0 +1,277 @@
+"""
+out-of-core transpose (corner turn) of chunk streams through a tiled HDF5 file
+"""
+
+import os
+import threading
+
+import numpy as np
+import tables
+
+from ..functions import IterableH5Chunks, multihash, _h5_lock, _open_h5
+
+__all__ = ['transpose']
+
+_TILE_BYTES = 4*1024**2 # approximate size of the HDF5 chunks of the intermediate file
+
+def transpose(iterator, filename, name="data", memory_limit=256*1024**2, chunksize=None, rows=None, complib="blosc:lz4", complevel=5, shuffle=True, verbose=False, **kwargs):
+  """Transpose a stream of row chunks out of core, swapping the first two axes.
+
+  Turns a stream of chunks of an array of shape ``(N, M, ...)`` (e.g. from
+  :class:`IterableH5Chunks`) into chunks of its transpose of shape
+  ``(M, N, ...)``, so that computations along axis 0 of the original data,
+  like an FFT over all rows, can work on chunks again::
+
+      >>> columns = chunkiter.transpose(chunkiter.IterableH5Chunks("test.h5", "data"), "transposed.h5")
+      >>> spectra = (np.fft.fft(chunk, axis=1) for chunk in columns)  # along axis 0 of test.h5
+
+  The data is written in a first pass to a dataset of shape ``(M, N, ...)``
+  in *filename*, tiled into HDF5 chunks of a few MB.  Input rows are
+  collected into bands of whole tile rows, so that each tile is written
+  once; the output chunks returned for the second pass are whole tile
+  rows, so that each tile is read once.  Both bands and output chunks are
+  sized to *memory_limit*, which makes the reads and writes of both passes
+  large.
+
+  The first pass runs when the returned iterable is first used, e.g.
+  iterated.  The returned iterable can then be iterated several times, and
+  otherwise behaves like :class:`IterableH5Chunks`.  Its ``identifier``
+  derives from the identifier of *iterator*, if it has one, so results
+  computed from it can be cached with :func:`cache`.  This identifier is
+  also stored with the data, so that running the same script again reuses
+  the transposed data in *filename* instead of writing it again.  The data
+  is written to a temporary dataset that is renamed to *name* when
+  complete, so an interrupted first pass is redone.
+
+  Args:
+      iterator: Iterator yielding np.ndarray chunks with at least two
+          dimensions.
+      filename (str): HDF5 file for the transposed data.  Remove it when not
+          needed anymore.
+      name (str): Dataset name in *filename*.
+      memory_limit (int): Approximate bytes used by a band of input rows
+          (including its transposed copy) and by an output chunk.
+      chunksize (int, None): Rows per output chunk.  ``None`` uses the
+          largest multiple of the tile height within *memory_limit*, but at
+          least the tile height.
+      rows (int, None): Number of input rows (``N``), to size the tiles so
+          that a tile row fits into *memory_limit*.  Taken from the
+          ``shape`` attribute of *iterator* if not given (as for
+          :class:`IterableH5Chunks`); if unknown, the tiles are square.
+      complib (str): PyTables compression library of the intermediate file.
+      complevel (int): Compression level (0 disables compression).
+      shuffle (bool): Byte shuffle before compression.
+      verbose (bool): Print progress.
+      **kwargs: Further arguments for :class:`IterableH5Chunks`, e.g.
+          *prefetch*.
+
+  Raises:
+      IOError: On first use, if *filename* already contains the dataset
+          *name* with other data, or with data of an *iterator* without
+          identifier.
+      ValueError: On first use, if the chunks have less than two dimensions
+          or differ in their trailing shape.
+
+  Returns:
+      iterable: Chunks of the transposed data, read by an
+      :class:`IterableH5Chunks`.
+  """
+  filters = tables.Filters(complevel=complevel, complib=complib, shuffle=shuffle)
+  return _Transposed(iterator, filename, name, memory_limit, chunksize, rows, filters, verbose, kwargs)
+
+class _Transposed(object):
+  # iterable returned by transpose(): runs the first pass on first use, and then delegates
+  # to the IterableH5Chunks reading the transposed data
+  def __init__(self, iterator, filename, name, memory_limit, chunksize, rows, filters, verbose, kwargs):
+    self.iterator = iterator
+    self.filename = filename
+    self.name = name
+    self.memory_limit = memory_limit
+    self.chunksize = chunksize
+    self.rows = rows
+    self.filters = filters
+    self.verbose = verbose
+    self.kwargs = kwargs
+    self.lock = threading.Lock()
+    self.transposed = None
+
+    identifier = getattr(iterator, "identifier", None)
+    self.data_identifier = multihash("transpose", identifier) if identifier is not None else None
+    if identifier is not None:
+      self.identifier = multihash(self.data_identifier, str(chunksize) if chunksize is not None else "memory_limit {}".format(memory_limit))
+
+  def _chunks(self):
+    with self.lock:
+      if self.transposed is None:
+        chunksize = _first_pass(self.iterator, self.filename, self.name, self.data_identifier, self.memory_limit, self.chunksize, self.rows, self.filters, self.verbose)
+        self.transposed = IterableH5Chunks(self.filename, self.name, chunksize=chunksize, **self.kwargs)
+        if "identifier" in self.__dict__: self.transposed.identifier = self.identifier
+      return self.transposed
+
+  def __getattr__(self, name):
+    if name in ("transposed", "lock") or name.startswith("__"): raise AttributeError(name) # not initialized yet, e.g. while unpickling
+    return getattr(self._chunks(), name)
+
+  def __iter__(self):
+    return iter(self._chunks())
+
+  def __len__(self):
+    return len(self._chunks())
+
+  def __getitem__(self, i):
+    return self._chunks()[i]
+
+  def __reversed__(self):
+    return reversed(self._chunks())
+
+def _first_pass(iterator, filename, name, data_identifier, memory_limit, chunksize, rows, filters, verbose):
+  # write the transposed data unless filename holds it already; returns the output chunk size
+  partial = name+"_partial"
+  with _open_h5(filename, "a") as datafile:
+    with _h5_lock:
+      dataset = datafile.root[name] if name in datafile.root else None
+      stored = getattr(dataset.attrs, "transpose_identifier", None) if dataset is not None else None
+      if dataset is None and partial in datafile.root: datafile.remove_node(datafile.root, partial) # interrupted
+
+    if dataset is None:
+      dataset = _write(iterator, datafile, partial, memory_limit, rows, filters, verbose)
+      with _h5_lock:
+        if data_identifier is not None: dataset.attrs.transpose_identifier = data_identifier
+        datafile.rename_node(datafile.root, name, partial)
+    elif data_identifier is None or stored!=data_identifier:
+      raise IOError("{} in {} already contains other data".format(name, filename))
+    elif verbose:
+      print("* reusing the transposed data in {}".format(filename))
+
+    if chunksize is None: # whole tile rows within memory_limit
+      tile_columns = dataset.chunkshape[0]
+      column_bytes = dataset.dtype.itemsize*int(np.prod(dataset.shape[2:]))
+      chunksize = max(1, memory_limit//max(1, dataset.shape[1]*column_bytes)//tile_columns)*tile_columns
+  return chunksize
+
+def _write(iterator, datafile, name, memory_limit, rows, filters, verbose):
+  # first pass: write the transposed data to a new tiled dataset
+  dataset = None
+  band = None
+  band_rows = 0
+  for chunk_i, chunk in enumerate(iterator):
+    if chunk.ndim<2: raise ValueError("need chunks with at least two dimensions")
+
+    if dataset is None:
+      row_bytes = max(1, chunk[:1].nbytes)
+      column_bytes = chunk.itemsize*int(np.prod(chunk.shape[2:]))
+      if rows is None and type(getattr(iterator, "shape", None))==tuple: rows = iterator.shape[0]
+      if rows is not None: # output chunks of a tile row within memory_limit
+        tile_columns = memory_limit//max(1, rows*column_bytes)
+      else: # square tiles
+        tile_columns = int(np.sqrt(_TILE_BYTES/column_bytes))
+      tile_columns = max(1, min(chunk.shape[1], tile_columns))
+      tile_rows = max(1, min(memory_limit//(2*row_bytes), _TILE_BYTES//(tile_columns*column_bytes))) # the band and its transposed copy
+      band_size = tile_rows*max(1, memory_limit//(2*row_bytes*tile_rows)) # whole tile columns
+
+      atom = tables.Atom.from_dtype(chunk.dtype)
+      shape = (chunk.shape[1], 0)+chunk.shape[2:]
+      chunkshape = (tile_columns, tile_rows)+chunk.shape[2:]
+      with _h5_lock: dataset = datafile.create_earray(datafile.root, name, atom=atom, shape=shape, chunkshape=chunkshape, filters=filters)
+      band = np.empty((band_size,)+chunk.shape[1:], dtype=chunk.dtype)
+
+    if chunk.shape[1:]!=band.shape[1:]: raise ValueError("chunks do not match the trailing shape of the first chunk")
+    if verbose: print("* ...transposing chunk {}".format(chunk_i), end="\r")
+
+    # collect the rows into bands
+    pos = 0
+    while pos<chunk.shape[0]:
+      n = min(chunk.shape[0]-pos, band.shape[0]-band_rows)
+      band[band_rows:band_rows+n] = chunk[pos:pos+n]
+      band_rows += n
+      pos += n
+      if band_rows==band.shape[0]:
+        transposed = np.ascontiguousarray(np.swapaxes(band, 0, 1))
+        with _h5_lock: dataset.append(transposed)
+        band_rows = 0
+
+  if dataset is None: raise ValueError("cannot transpose an empty iterator")
+  if band_rows>0:
+    transposed = np.ascontiguousarray(np.swapaxes(band[:band_rows], 0, 1))
+    with _h5_lock: dataset.append(transposed)
+  if verbose: print()
+  return dataset
+
+# --- tests ---
+
+def test_transpose():
+  """Transposed chunks equal the transposed data, for tiles much smaller than the data."""
+  import tempfile
+  x = np.random.default_rng(0).standard_normal((1000, 300))
+  with tempfile.TemporaryDirectory() as d:
+    chunks = np.array_split(x, 13)
+    columns = transpose(iter(chunks), os.path.join(d, "t.h5"), memory_limit=200000, rows=1000)
+    result = list(columns)
+    assert len(result)>1 and all(c.shape[0]==result[0].shape[0] for c in result[:-1])
+    assert result[0].nbytes<=200000
+    assert np.array_equal(np.concatenate(result), x.T)
+    assert np.array_equal(np.concatenate(list(columns)), x.T)
+
+def test_trailing_dimensions():
+  """Only the first two axes are swapped."""
+  import tempfile
+  x = np.arange(50*7*3).reshape(50, 7, 3).astype(np.complex64)
+  with tempfile.TemporaryDirectory() as d:
+    columns = transpose(iter(np.array_split(x, 4)), os.path.join(d, "t.h5"), memory_limit=1000, chunksize=3)
+    result = list(columns)
+    assert [c.shape[0] for c in result]==[3, 3, 1]
+    assert np.array_equal(np.concatenate(result), np.swapaxes(x, 0, 1))
+
+def test_identifier():
+  """The identifier follows the input, for caching results computed from the transpose, and for reusing it."""
+  import tempfile
+  from chunkiter.functions import chunks_to_h5, cache
+  x = np.arange(400.).reshape(40, 10)
+  with tempfile.TemporaryDirectory() as d:
+    chunks_to_h5(iter(np.split(x, 4)), os.path.join(d, "x.h5"))
+    source = IterableH5Chunks(os.path.join(d, "x.h5"), "data")
+    a = transpose(source, os.path.join(d, "a.h5"), chunksize=5)
+    b = transpose(source, os.path.join(d, "b.h5"), chunksize=5)
+    assert a.identifier==b.identifier!=transpose(source, os.path.join(d, "c.h5"), chunksize=2).identifier
+
+    sums = cache((c.sum(axis=1) for c in a), "sums", a.identifier, cachedir=d, verbose=False)
+    assert np.array_equal(np.concatenate(list(sums)), x.sum(axis=0))
+
+    again = transpose(source, os.path.join(d, "a.h5"), chunksize=5)
+    assert again.identifier==a.identifier
+    sums = cache((c.sum(axis=1) for c in again), "sums", again.identifier, cachedir=d, verbose=False)
+    assert np.array_equal(np.concatenate(list(sums)), x.sum(axis=0))
+
+    for other in (IterableH5Chunks(os.path.join(d, "x.h5"), "data", chunksize=3), iter(np.split(x, 4))):
+      try: list(transpose(other, os.path.join(d, "a.h5")))
+      except IOError: pass
+      else: assert False
+
+def test_lazy_and_interrupted():
+  """The first pass runs on first use, and an interrupted one is redone."""
+  import tempfile
+  x = np.arange(400.).reshape(40, 10)
+  def chunks(fail=False):
+    for i, chunk in enumerate(np.split(x, 4)):
+      if fail and i==2: raise KeyboardInterrupt()
+      yield chunk
+  with tempfile.TemporaryDirectory() as d:
+    filename = os.path.join(d, "t.h5")
+    columns = transpose(chunks(), filename, memory_limit=1000)
+    assert not os.path.exists(filename)
+    assert np.array_equal(np.concatenate(list(columns)), x.T)
+
+    try: list(transpose(chunks(fail=True), os.path.join(d, "u.h5"), memory_limit=1000))
+    except KeyboardInterrupt: pass
+    else: assert False
+    columns = transpose(chunks(), os.path.join(d, "u.h5"), memory_limit=1000)
+    assert np.array_equal(np.concatenate(list(columns)), x.T)
+
+if __name__ == "__main__":
+  tests = [test_transpose, test_trailing_dimensions, test_identifier, test_lazy_and_interrupted]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")
@@ -1,2 +1,272 @@
 #!/usr/bin/env python3
+"""
+tests of chunkiter.functions and chunkiter.tools
+"""
 
+import os
+import tempfile
+
+import numpy as np
+
+import chunkiter
+
+def _h5(d, x, name="x.h5", **kwargs):
+  """Write *x* in chunks of 100 rows to an HDF5 file in *d*."""
+  filename = os.path.join(d, name)
+  chunkiter.chunks_to_h5(iter(np.array_split(x, range(100, len(x), 100))), filename, **kwargs)
+  return filename
+
+# --- HDF5 ---
+
+def test_h5_prefetch_buffers_threads():
+  """Prefetching, buffer reuse and thread-pool decompression yield the same chunks."""
+  x = np.random.default_rng(0).standard_normal((1050, 3))
+  with tempfile.TemporaryDirectory() as d:
+    for complib in ("blosc:lz4", "blosc2:zstd"):
+      filename = _h5(d, x, complib+".h5", complib=complib)
+      for kwargs in (dict(), dict(prefetch=2), dict(buffers=2), dict(threads=3), dict(prefetch=2, buffers=1, threads=2)):
+        chunks = [c.copy() for c in chunkiter.IterableH5Chunks(filename, "data", **kwargs)]
+        assert [len(c) for c in chunks]==[100]*10+[50], kwargs
+        assert np.array_equal(np.concatenate(chunks), x), kwargs
+
+def test_h5_buffers_release():
+  """With buffers, a released chunk's memory is reused for a later chunk."""
+  x = np.arange(1000.)
+  with tempfile.TemporaryDirectory() as d:
+    source = chunkiter.IterableH5Chunks(_h5(d, x), "data", buffers=3)
+    addresses = []
+    for chunk in source:
+      addresses.append(chunk.ctypes.data)
+      source.release(chunk)
+    assert len(set(addresses))==1
+
+def test_h5_prefetch_stops():
+  """An abandoned prefetching iteration ends its thread."""
+  import threading
+  with tempfile.TemporaryDirectory() as d:
+    filename = _h5(d, np.arange(10000.))
+    threads = set(threading.enumerate())
+    chunks = iter(chunkiter.IterableH5Chunks(filename, "data", prefetch=2))
+    next(chunks)
+    chunks.close()
+    assert not set(threading.enumerate())-threads
+
+def test_h5_random_access():
+  """len(), chunks[i], range() and reversed() seek to the requested samples."""
+  x = np.arange(1050.)
+  with tempfile.TemporaryDirectory() as d:
+    source = chunkiter.IterableH5Chunks(_h5(d, x), "data", prefetch=1)
+    assert len(source)==11
+    assert np.array_equal(source[3], x[300:400]) and np.array_equal(source[-1], x[1000:])
+    part = source.range(250, 420)
+    assert [len(c) for c in part]==[50, 100, 20] and np.array_equal(chunkiter.concatenate(part), x[250:420])
+    assert np.array_equal(chunkiter.concatenate(source.range(-75)), x[-75:])
+    backwards = reversed(source)
+    assert np.array_equal(chunkiter.concatenate(backwards), x[::-1])
+    assert np.array_equal(chunkiter.concatenate(backwards.range(10, 60)), x[::-1][10:60])
+    try: source[11]
+    except IndexError: pass
+    else: assert False
+
+def test_h5_writer_options():
+  """Write-behind, parallel compression and appending store the same data."""
+  x = np.random.default_rng(1).standard_normal((1050, 4)).astype(np.float32)
+  with tempfile.TemporaryDirectory() as d:
+    for i, kwargs in enumerate([dict(writebehind=2), dict(threads=2), dict(writebehind=3, threads=2, complib="blosc2:lz4", shuffle="bit")]):
+      filename = _h5(d, x[:600], "{}.h5".format(i), **kwargs)
+      _h5(d, x[600:], "{}.h5".format(i), append=True, **kwargs)
+      assert np.array_equal(chunkiter.concatenate(chunkiter.IterableH5Chunks(filename, "data", threads=2)), x), kwargs
+
+    try: _h5(d, x, "0.h5")
+    except IOError: pass
+    else: assert False
+
+def test_h5_writer_copies():
+  """Chunks modified in place after they have been yielded are written unmodified."""
+  x = np.arange(1000.)
+  with tempfile.TemporaryDirectory() as d:
+    for i, kwargs in enumerate([dict(writebehind=2), dict(threads=2), dict(writebehind=2, threads=2)]):
+      filename = os.path.join(d, "{}.h5".format(i))
+      for chunk in chunkiter.yielding_chunks_to_h5((c.copy() for c in np.split(x, 10)), filename, **kwargs):
+        chunk[...] = 0
+      assert np.array_equal(chunkiter.concatenate(chunkiter.IterableH5Chunks(filename, "data")), x), kwargs
+
+def test_h5_concurrent_readers_and_writers():
+  """Prefetching readers and write-behind writers in several threads at once do not corrupt files."""
+  import threading
+  x = np.random.default_rng(2).standard_normal((5000, 8))
+  with tempfile.TemporaryDirectory() as d:
+    source = _h5(d, x)
+    errors = []
+    def copy(i):
+      try:
+        chunks = chunkiter.IterableH5Chunks(source, "data", prefetch=2, threads=2)
+        chunkiter.chunks_to_h5((c*i for c in chunks), os.path.join(d, "{}.h5".format(i)), writebehind=2)
+      except BaseException as e: errors.append(e)
+    workers = [threading.Thread(target=copy, args=(i,)) for i in range(4)]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    assert not errors, errors
+    for i in range(4):
+      assert np.array_equal(chunkiter.concatenate(chunkiter.IterableH5Chunks(os.path.join(d, "{}.h5".format(i)), "data")), x*i)
+
+def test_apply_lazy_and_close():
+  """apply() starts its input only on the first chunk, and close() stops it."""
+  import threading
+  with tempfile.TemporaryDirectory() as d:
+    source = chunkiter.IterableH5Chunks(_h5(d, np.arange(10000.)), "data", prefetch=2)
+    threads = set(threading.enumerate())
+    applied = chunkiter.apply(lambda chunk: 2*chunk, source)
+    assert not set(threading.enumerate())-threads
+    assert np.array_equal(next(applied), 2*np.arange(100.))
+    assert set(threading.enumerate())-threads
+    applied.close()
+    assert not set(threading.enumerate())-threads
+
+_CRASHING = """
+import os, sys, numpy as np, chunkiter
+def running_sum(chunk, carry):
+  print("computed", flush=True)
+  return chunk+carry, carry+chunk.sum()
+running_sum.has_carry = True
+running_sum.initial_carry = 0.
+def source(crash_at):
+  for i in range(20):
+    if i==crash_at: os._exit(1)
+    yield np.full((1000, 4), float(i))
+r = chunkiter.cache(chunkiter.apply(running_sum, source(int(sys.argv[2]))), "x", cachedir=sys.argv[1], verbose=False, checkpoint_interval=0, **eval(sys.argv[3]))
+np.save(os.path.join(sys.argv[1], "result.npy"), chunkiter.concatenate(r))
+"""
+
+def test_cache_resume_after_crash():
+  """A killed cache() computation resumes after its last checkpoint, also with write-behind and compression threads."""
+  import sys
+  import subprocess
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  run = lambda d, crash_at, kwargs: subprocess.run([sys.executable, "-c", _CRASHING, d, str(crash_at), kwargs], capture_output=True, text=True, env=env, timeout=120)
+  with tempfile.TemporaryDirectory() as d:
+    run(d, -1, "dict()")
+    expected = np.load(os.path.join(d, "result.npy"))
+  for kwargs in ("dict()", "dict(writebehind=2)", "dict(threads=2)", "dict(writebehind=3, threads=2)"):
+    with tempfile.TemporaryDirectory() as d:
+      crashed = run(d, 12, kwargs)
+      assert crashed.returncode==1 and crashed.stdout.count("computed")==12, kwargs
+      resumed = run(d, -1, kwargs)
+      assert resumed.returncode==0, resumed.stderr
+      assert resumed.stdout.count("computed")==8, kwargs # chunks 12 to 19
+      assert np.array_equal(np.load(os.path.join(d, "result.npy")), expected), kwargs
+
+# --- binary format ---
+
+def _binary(chunks, **kwargs):
+  """Serialize *chunks* to an in-memory binary stream."""
+  import io
+  f = io.BytesIO()
+  chunkiter.chunks_to_binaryfile(iter(chunks), f, verbose=False, **kwargs)
+  f.seek(0)
+  return f
+
+def test_binary_round_trip():
+  """All format versions and options read back the written chunks and tuples."""
+  rng = np.random.default_rng(3)
+  chunks = [(rng.standard_normal((n, 3)), np.arange(n, dtype=np.int16)) for n in [5, 0, 17, 1, 64]]
+  for kwargs, reader in [
+    (dict(), dict()),
+    (dict(version=2), dict()),
+    (dict(version=2), dict(buffers=2)),
+    (dict(index=True), dict()),
+    (dict(compression="lz4"), dict()),
+    (dict(compression="zstd", shuffle="bit", threads=2), dict(threads=2, buffers=1)),
+  ]:
+    result = [(a.copy(), b.copy()) for a, b in chunkiter.IterableBinaryFileChunks(_binary(chunks, **kwargs), **reader)]
+    assert len(result)==len(chunks), kwargs
+    for (a, b), (c, e) in zip(result, chunks):
+      assert np.array_equal(a, c) and np.array_equal(b, e) and b.dtype==e.dtype, kwargs
+
+  # version 1 by default, for older readers, which also allows varying dtypes
+  mixed = [np.ones(3), np.ones((3, 2), np.float32)]
+  f = _binary(mixed)
+  assert f.getvalue()[:5]==b'TUPLE' and len(list(chunkiter.IterableBinaryFileChunks(f)))==2
+  assert _binary(mixed[:1], compression="lz4").getvalue()[:5]==b'CHUNK'
+  try: _binary(mixed, version=2)
+  except ValueError: pass
+  else: assert False
+
+def test_binary_buffers():
+  """With buffers=n, a tuple chunk stays valid until n more chunks have been pulled."""
+  chunks = [(np.full(10, float(i)), np.full(3, i)) for i in range(8)]
+  for kwargs in (dict(), dict(version=2), dict(compression="lz4")):
+    for reader in (dict(buffers=2), dict(buffers=2, threads=2)):
+      source = iter(chunkiter.IterableBinaryFileChunks(_binary(chunks, **kwargs), **reader))
+      previous = next(source)
+      for i, chunk in enumerate(source, 1):
+        assert previous[0][0]==i-1 and previous[1][0]==i-1 and chunk[0][0]==i, (kwargs, reader)
+        previous = chunk
+
+def test_binary_require_end():
+  """A truncated stream ends silently, or raises EOFError with require_end."""
+  f = _binary([np.ones(10)]*3, version=2)
+  data = f.getvalue()
+  import io
+  truncated = data[:-8] # without the end marker
+  assert len(list(chunkiter.IterableBinaryFileChunks(io.BytesIO(truncated))))==3
+  try: list(chunkiter.IterableBinaryFileChunks(io.BytesIO(truncated), require_end=True))
+  except EOFError: pass
+  else: assert False
+  assert len(list(chunkiter.IterableBinaryFileChunks(io.BytesIO(data), require_end=True)))==3
+
+def test_memmap():
+  """Indexed files are memory-mapped, with random access like IterableH5Chunks."""
+  x = np.arange(1050.).reshape(525, 2)
+  chunks = np.array_split(x, range(100, 525, 100))
+  with tempfile.TemporaryDirectory() as d:
+    filename = os.path.join(d, "x.bin")
+    with open(filename, "wb") as f: chunkiter.chunks_to_binaryfile(iter(chunks), f, verbose=False, index=True)
+    result = list(chunkiter.IterableMemmapChunks(filename))
+    assert all(isinstance(c, np.memmap) and c.ctypes.data%64==0 for c in result)
+    assert np.array_equal(np.concatenate(result), x)
+
+    with open(filename, "wb") as f:
+      f.write(b"preceding data")
+      chunkiter.chunks_to_binaryfile(iter(chunks), f, verbose=False, index=True)
+    source = chunkiter.IterableMemmapChunks(filename)
+    assert np.array_equal(chunkiter.concatenate(source), x) and len(source)==6
+    assert np.array_equal(source[-1], x[500:])
+    assert np.array_equal(chunkiter.concatenate(source.range(150, 260)), x[150:260])
+    assert np.array_equal(chunkiter.concatenate(reversed(source)), x[::-1])
+
+    with open(os.path.join(d, "plain.bin"), "wb") as f: chunkiter.chunks_to_binaryfile(iter(chunks), f, verbose=False)
+    try: chunkiter.IterableMemmapChunks(os.path.join(d, "plain.bin"))
+    except IOError: pass
+    else: assert False
+
+    with open(os.path.join(d, "empty.bin"), "wb") as f: chunkiter.chunks_to_binaryfile(iter([]), f, verbose=False, index=True)
+    try: chunkiter.IterableMemmapChunks(os.path.join(d, "empty.bin"))
+    except ValueError: pass
+    else: assert False
+
+# --- tools ---
+
+def test_start_after_const():
+  """chunk_size="const" keeps the size of the first input chunk, also for seekable sources."""
+  x = np.arange(1000.)
+  with tempfile.TemporaryDirectory() as d:
+    chunkiter.chunks_to_h5(iter(np.split(x, 10)), os.path.join(d, "x.h5"))
+    source = chunkiter.IterableH5Chunks(os.path.join(d, "x.h5"), "data")
+    for chunks in (source, iter(source)):
+      result = list(chunkiter.start_after(chunks, 250, chunk_size="const"))
+      assert [len(c) for c in result]==[100]*7+[50]
+      assert np.array_equal(np.concatenate(result), x[250:])
+
+if __name__ == "__main__":
+  tests = [test_h5_prefetch_buffers_threads, test_h5_buffers_release, test_h5_prefetch_stops, test_h5_random_access,
+           test_h5_writer_options, test_h5_writer_copies, test_h5_concurrent_readers_and_writers,
+           test_apply_lazy_and_close, test_cache_resume_after_crash,
+           test_binary_round_trip, test_binary_buffers, test_binary_require_end, test_memmap,
+           test_start_after_const]
+
+  for t in tests:
+    t()
+    print(f"{t.__name__} passed")
+
+  print(f"\nAll {len(tests)} tests passed.")